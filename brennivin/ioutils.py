@@ -5,14 +5,34 @@ and the :func:`is_local_port_open` function.
 
 Also defines :class:`Timeout` which is used in IO-heavy areas of brennivin.
 
+Both decorators can report what they are doing to a :class:`CallObserver`,
+such as the in-memory :class:`CallStats` aggregator,
+so you can see how much time is spent in retries and timeouts.
+
+Use a :class:`PortAllocator` to reserve many free local ports at once
+without racing other threads or processes for them.
+
 Members
 =======
 """
 
+import bisect as _bisect
+import os as _os
+import random as _random
+import tempfile as _tempfile
 import threading as _threading
 import time as _time
 import socket as _socket
 
+try:
+    import fcntl as _fcntl
+except ImportError:
+    _fcntl = None
+try:
+    import msvcrt as _msvcrt
+except ImportError:
+    _msvcrt = None
+
 
 EPHEMERAL_PORT_RANGE = 49152, 65535
 
@@ -21,6 +41,149 @@ class Timeout(_socket.timeout, Exception):
     pass
 
 
+class CallObserver(object):
+    """Receives callbacks about calls made through :class:`retry`
+    and :class:`timeout`.
+    All methods do nothing by default, so override only what you need.
+
+    ``func`` is the decorated function,
+    ``attempt`` is the 1-based attempt number,
+    and ``elapsed`` is the number of seconds since the decorated function
+    was called (including time spent in earlier attempts and sleeps).
+    Callbacks are invoked on the calling thread.
+    """
+
+    def attempt_started(self, func, attempt, elapsed):
+        """Called before each attempt."""
+
+    def attempt_failed(self, func, attempt, exc, elapsed):
+        """Called when an attempt raises ``exc``.
+        The exception is re-raised afterwards if it is not retried."""
+
+    def sleeping(self, func, attempt, delay, elapsed):
+        """Called before sleeping for ``delay`` seconds after
+        a failed attempt."""
+
+    def succeeded(self, func, attempt, elapsed):
+        """Called when an attempt returns."""
+
+    def timed_out(self, func, elapsed):
+        """Called when a :class:`timeout` gives up waiting on ``func``.
+        The worker thread may still be running."""
+
+
+_NULL_OBSERVER = CallObserver()
+
+
+def _funcname(func):
+    return '%s.%s' % (getattr(func, '__module__', None),
+                      getattr(func, '__name__', func))
+
+
+class Histogram(object):
+    """A simple histogram of latencies in seconds.
+
+    :param bounds: Sorted upper bounds of each bucket.
+      A value falls into the first bucket whose bound is >= the value.
+      Values larger than the last bound go into an overflow bucket,
+      so there are ``len(bounds) + 1`` buckets in ``counts``.
+    """
+
+    DEFAULT_BOUNDS = (.001, .005, .01, .05, .1, .5, 1, 5, 10, 30, 60)
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        self.counts[_bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def mean(self):
+        """Returns the average value, or 0 if nothing was added."""
+        if not self.count:
+            return 0
+        return self.total / float(self.count)
+
+
+class CallStats(CallObserver):
+    """A thread-safe :class:`CallObserver` that keeps per-function counters
+    and latency histograms in memory.
+
+    Stats for a function are available from :meth:`get`,
+    keyed by ``'<module>.<name>'``, as a dict with the following keys:
+
+    - ``'attempts'``, ``'failures'``, ``'sleeps'``,
+      ``'successes'``, ``'timeouts'``: counters.
+    - ``'sleeptime'``: Total seconds spent sleeping between attempts.
+    - ``'success_latency'``, ``'failure_latency'``, ``'timeout_latency'``:
+      :class:`Histogram` instances of the elapsed time
+      when the callback was invoked.
+
+    :param bounds: Bucket bounds for each :class:`Histogram`.
+    """
+
+    COUNTERS = 'attempts', 'failures', 'sleeps', 'successes', 'timeouts'
+    HISTOGRAMS = 'success_latency', 'failure_latency', 'timeout_latency'
+
+    def __init__(self, bounds=Histogram.DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self._stats = {}
+        self._lock = _threading.Lock()
+
+    def _new_stats(self):
+        stats = dict((c, 0) for c in self.COUNTERS)
+        stats['sleeptime'] = 0
+        for h in self.HISTOGRAMS:
+            stats[h] = Histogram(self.bounds)
+        return stats
+
+    def _record(self, func, counter, histogram=None, elapsed=0, sleeptime=0):
+        name = _funcname(func)
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = self._new_stats()
+            stats[counter] += 1
+            stats['sleeptime'] += sleeptime
+            if histogram:
+                stats[histogram].add(elapsed)
+
+    def attempt_started(self, func, attempt, elapsed):
+        self._record(func, 'attempts')
+
+    def attempt_failed(self, func, attempt, exc, elapsed):
+        self._record(func, 'failures', 'failure_latency', elapsed)
+
+    def sleeping(self, func, attempt, delay, elapsed):
+        self._record(func, 'sleeps', sleeptime=delay)
+
+    def succeeded(self, func, attempt, elapsed):
+        self._record(func, 'successes', 'success_latency', elapsed)
+
+    def timed_out(self, func, elapsed):
+        self._record(func, 'timeouts', 'timeout_latency', elapsed)
+
+    def names(self):
+        """Returns a sorted list of the function names with stats."""
+        with self._lock:
+            return sorted(self._stats)
+
+    def get(self, name):
+        """Returns the stats dict for function ``name``
+        (see class docs for keys), or None if it has no stats."""
+        with self._lock:
+            return self._stats.get(name)
+
+    def reset(self):
+        """Clears all stats."""
+        with self._lock:
+            self._stats.clear()
+
+
 class retry(object):
     """Decorator used for retrying an operation multiple times. After each
     retry, the wait will be multiplied by backoff.
@@ -33,9 +196,11 @@ class retry(object):
         attempts. Must be >= 1.
     :param sleepfunc: The function used to sleep between retries.
       Default to :func:`time.sleep`.
+    :param observer: A :class:`CallObserver` notified of each attempt,
+      failure, sleep, and success.
     """
     def __init__(self, attempts=2, excfilter=(Exception,), wait=0, backoff=1,
-                 sleepfunc=None):
+                 sleepfunc=None, observer=None):
         if attempts < 1:
             raise ValueError('attempts must be greater than or equal to 1.')
         if wait < 0:
@@ -47,25 +212,36 @@ class retry(object):
         self.wait = wait
         self.backoff = backoff
         self.sleep = sleepfunc or _time.sleep
+        self.observer = observer or _NULL_OBSERVER
 
     def __call__(self, func):
-        attemptsLeft = [self.attempts]  # So we can re-use inside of inner.
-        currDelay = [self.wait]
+        observer = self.observer
 
         def inner(*args, **kwargs):
+            start = _time.time()
+            delay = self.wait
+            attempt = 0
             while True:
-                if attemptsLeft[0] == 1:
-                    #If this is the last attempt, no more retrying- just
-                    # return now.
-                    return func(*args, **kwargs)
-                attemptsLeft[0] -= 1
+                attempt += 1
+                observer.attempt_started(func, attempt, _time.time() - start)
                 try:
-                    return func(*args, **kwargs)
-                except self.excFilter:
-                    if currDelay[0]:
-                        self.sleep(currDelay[0])
-                        currDelay[0] *= self.backoff
-                    return inner(*args, **kwargs)
+                    result = func(*args, **kwargs)
+                except BaseException as exc:
+                    observer.attempt_failed(
+                        func, attempt, exc, _time.time() - start)
+                    #If this is the last attempt, or the error isn't
+                    # filtered, no more retrying.
+                    if (attempt >= self.attempts or
+                            not isinstance(exc, self.excFilter)):
+                        raise
+                    if delay:
+                        observer.sleeping(
+                            func, attempt, delay, _time.time() - start)
+                        self.sleep(delay)
+                        delay *= self.backoff
+                    continue
+                observer.succeeded(func, attempt, _time.time() - start)
+                return result
         return inner
 
 
@@ -86,14 +262,19 @@ class timeout(object):
         t.start()
         return t
 
-    def __init__(self, timeoutSecs=5):
+    def __init__(self, timeoutSecs=5, observer=None):
         """Initialize.
 
         timeoutSecs: Seconds to wait before timing out.
+        observer: A :class:`CallObserver` notified of the attempt,
+          and whether it succeeded, failed, or timed out.
         """
         self.timeoutSecs = timeoutSecs
+        self.observer = observer or _NULL_OBSERVER
 
     def __call__(self, func):
+        observer = self.observer
+
         def wrapped(*args, **kwargs):
             innerResult = []
             innerExcRaised = []
@@ -104,13 +285,19 @@ class timeout(object):
                     innerResult.append(result)
                 except Exception as exc:
                     innerExcRaised.append(exc)
+            start = _time.time()
+            observer.attempt_started(func, 1, 0)
             t = type(self).start_thread(inner)
             t.join(timeout=self.timeoutSecs)
             if innerResult:
+                observer.succeeded(func, 1, _time.time() - start)
                 return innerResult[0]
             if innerExcRaised:
                 #Exc raised on thread so just don't return anything.
+                observer.attempt_failed(
+                    func, 1, innerExcRaised[0], _time.time() - start)
                 raise innerExcRaised[0]
+            observer.timed_out(func, _time.time() - start)
             raise Timeout
         return wrapped
 
@@ -129,3 +316,217 @@ def is_local_port_open(port):
     finally:
         sock.close()
     return not isBound
+
+
+def _lock_file(f):
+    if _fcntl:
+        _fcntl.flock(f.fileno(), _fcntl.LOCK_EX)
+    elif _msvcrt:  # pragma: no cover
+        f.seek(0)
+        _msvcrt.locking(f.fileno(), _msvcrt.LK_LOCK, 1)
+
+
+def _unlock_file(f):
+    if _fcntl:
+        _fcntl.flock(f.fileno(), _fcntl.LOCK_UN)
+    elif _msvcrt:  # pragma: no cover
+        f.seek(0)
+        _msvcrt.locking(f.fileno(), _msvcrt.LK_UNLCK, 1)
+
+
+def _default_lockfilename():
+    """Return a lock file path in the temp directory, per user,
+    so other users cannot create or replace it first."""
+    name = 'brennivin_ports.lock'
+    getuid = getattr(_os, 'getuid', None)
+    if getuid is not None:
+        name = 'brennivin_ports.%s.lock' % getuid()
+    return _os.path.join(_tempfile.gettempdir(), name)
+
+
+def _open_lock_file(filename):
+    """Open ``filename`` for reading and writing, creating it readable
+    only by this user, and refusing to follow a symlink."""
+    flags = _os.O_RDWR | _os.O_CREAT | getattr(_os, 'O_NOFOLLOW', 0)
+    fd = _os.open(filename, flags, 0o600)
+    try:
+        return _os.fdopen(fd, 'r+')
+    except Exception:
+        _os.close(fd)
+        raise
+
+
+class PortAllocator(object):
+    """Reserves free local ports in bulk, so many servers can be started
+    in parallel without racing each other for ports
+    (which :func:`is_local_port_open` cannot prevent).
+
+    Ports are reserved by binding a socket to them,
+    which is held until the port is handed off through :meth:`handoff`
+    (which closes the socket so the caller can bind the port)
+    or :meth:`release`.
+    Handed off ports are recorded in a lock file
+    shared by all of the user's allocators on the machine,
+    so other threads and processes will not reserve them again
+    until ``holdsecs`` has passed, giving the caller time to bind them.
+
+    :param portrange: (first, last) inclusive range of ports to hand out.
+    :param lockfilename: Path to the shared lock file.
+      Defaults to a file for the current user in the system
+      temp directory. The file is created readable only by the user,
+      and is not opened if it is a symlink.
+    :param holdsecs: Seconds a handed off port is kept out of circulation.
+    :param host: Address to bind to.
+    """
+
+    DEFAULT_LOCKFILENAME = _default_lockfilename()
+
+    def __init__(self, portrange=EPHEMERAL_PORT_RANGE, lockfilename=None,
+                 holdsecs=30, host='127.0.0.1'):
+        if portrange[0] > portrange[1]:
+            raise ValueError('Invalid port range: %s' % (portrange,))
+        self.portrange = tuple(portrange)
+        self.lockfilename = lockfilename or self.DEFAULT_LOCKFILENAME
+        self.holdsecs = holdsecs
+        self.host = host
+        self._sockets = {}
+        self._lock = _threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _read_registry(self, f):
+        """Return dict of port -> timestamp for entries in the open
+        lock file that have not expired."""
+        f.seek(0)
+        now = _time.time()
+        result = {}
+        for line in f.read().splitlines():
+            try:
+                port, stamp = line.split()
+                port, stamp = int(port), float(stamp)
+            except ValueError:
+                continue
+            if now - stamp < self.holdsecs:
+                result[port] = stamp
+        return result
+
+    def _write_registry(self, f, registry):
+        f.seek(0)
+        f.truncate()
+        f.write(''.join('%s %r\n' % (port, stamp)
+                        for port, stamp in sorted(registry.items())))
+        f.flush()
+
+    def _try_bind(self, port):
+        sock = _socket.socket()
+        try:
+            sock.bind((self.host, port))
+        except _socket.error:
+            sock.close()
+            return None
+        return sock
+
+    def _bind_free(self, taken):
+        """Bind and return a socket on a port in range that is not in
+        ``taken``, or None if the range is exhausted."""
+        first, last = self.portrange
+        # Let the OS pick first, which is cheap and avoids ports in use.
+        sock = self._try_bind(0)
+        if sock is not None:
+            port = sock.getsockname()[1]
+            if first <= port <= last and port not in taken:
+                return sock
+            sock.close()
+        # Fall back to scanning the range from a random offset,
+        # so concurrent allocators do not all contend for the same ports.
+        size = last - first + 1
+        offset = _random.randrange(size)
+        for i in range(size):
+            port = first + (offset + i) % size
+            if port in taken:
+                continue
+            sock = self._try_bind(port)
+            if sock is not None:
+                return sock
+        return None
+
+    def reserve(self, count=1):
+        """Reserve ``count`` ports and return them as a list.
+
+        :raise OSError: If there are not enough free ports in range.
+        """
+        with self._lock:
+            with _open_lock_file(self.lockfilename) as f:
+                _lock_file(f)
+                try:
+                    registry = self._read_registry(f)
+                    taken = set(registry)
+                    taken.update(self._sockets)
+                    reserved = []
+                    for _ in range(count):
+                        sock = self._bind_free(taken)
+                        if sock is None:
+                            break
+                        port = sock.getsockname()[1]
+                        taken.add(port)
+                        reserved.append((port, sock))
+                    if len(reserved) < count:
+                        for _, sock in reserved:
+                            sock.close()
+                        raise OSError(
+                            'Could only reserve %s of %s ports in range %s.'
+                            % (len(reserved), count, self.portrange))
+                    self._sockets.update(reserved)
+                    self._write_registry(f, registry)
+                finally:
+                    _unlock_file(f)
+        return [port for port, _ in reserved]
+
+    def socket(self, port):
+        """Return the bound socket holding reserved ``port``.
+        The socket is no longer owned by the allocator,
+        so the caller can use it directly (such as to listen on),
+        which avoids any race for the port at all.
+        """
+        with self._lock:
+            return self._sockets.pop(port)
+
+    def handoff(self, port):
+        """Stop holding reserved ``port`` so the caller can bind it,
+        and record it in the lock file so no other allocator
+        reserves it for ``holdsecs``.
+        Returns ``port``.
+        """
+        with self._lock:
+            sock = self._sockets.pop(port)
+            with _open_lock_file(self.lockfilename) as f:
+                _lock_file(f)
+                try:
+                    registry = self._read_registry(f)
+                    registry[port] = _time.time()
+                    self._write_registry(f, registry)
+                finally:
+                    _unlock_file(f)
+            sock.close()
+        return port
+
+    def release(self, port):
+        """Give up reserved ``port`` without handing it off."""
+        with self._lock:
+            self._sockets.pop(port).close()
+
+    def reserved(self):
+        """Return a sorted list of ports currently held."""
+        with self._lock:
+            return sorted(self._sockets)
+
+    def close(self):
+        """Release all held ports."""
+        with self._lock:
+            for sock in self._sockets.values():
+                sock.close()
+            self._sockets.clear()
@@ -12,14 +12,31 @@ There are various functions for working with timestamped log filenames
 Use :func:`get_filenames_from_loggers` to get all the logging filenames currently
 registered.
 
+Use :class:`AsyncHandler` to write records from a background thread,
+so slow disks do not slow down the threads doing the logging.
+Use :class:`TimestampedRotatingFileHandler` to roll over timestamped
+log files by size or time.
+
 Members
 =======
 """
 
-import fnmatch as _fnmatch
+import copy as _copy
+import gzip as _gzip
 import logging as _logging
 import os as _os
+import shutil as _shutil
+import threading as _threading
 import time as _time
+import traceback as _traceback
+
+from . import osutils as _osutils
+
+try:
+    import queue as _queue
+except ImportError:  # pragma: no cover
+    # noinspection PyUnresolvedReferences
+    import Queue as _queue
 
 
 try:
@@ -61,17 +78,186 @@ class Fmt(object):
 class MultiLineIndentFormatter(_logging.Formatter):
     """Indents every newline character in a formatted logrecord to have
     the same indentation as the formatted record's header.
+
+    The header is the part of the format string before ``%(message)s``,
+    so its length is found by formatting just that part.
+    Records without newlines are returned as formatted.
     """
     def __init__(self, fmt=None, datefmt=None, sep=' '):
         _logging.Formatter.__init__(self, fmt, datefmt)
         self.sep = sep
+        msgidx = self._fmt.find('%(message)')
+        self._headerfmt = self._fmt[:msgidx] if msgidx > 0 else None
+        self._indents = {}
+
+    def _indent(self, length):
+        try:
+            return self._indents[length]
+        except KeyError:
+            indent = self._indents[length] = '\n' + self.sep * length
+            return indent
 
     def format(self, record):
         formattedRecord = _logging.Formatter.format(self, record)
-        header, footer = formattedRecord.split(record.msg)
-        # noinspection PyTypeChecker
-        s = formattedRecord.replace('\n', '\n' + (self.sep * len(header)))
-        return s
+        if self._headerfmt is None or '\n' not in formattedRecord:
+            return formattedRecord
+        header = self._headerfmt % record.__dict__
+        return formattedRecord.replace('\n', self._indent(len(header)))
+
+
+_STOP = object()
+
+
+class AsyncHandler(_logging.Handler):
+    """Handler that puts records on a bounded queue and hands them to
+    ``target``, another handler, in batches on a background thread.
+
+    Records are collected until there are ``batchsize`` of them,
+    or ``flushinterval`` seconds have passed since the first one,
+    then emitted together.
+    If ``target`` is a plain :class:`logging.StreamHandler` or
+    :class:`logging.FileHandler`, a batch is written and flushed at once,
+    rather than flushing after every record.
+
+    The message and any exception text are formatted on the calling thread,
+    so records do not hold onto arguments or tracebacks.
+
+    :meth:`flush` waits for queued records to be written,
+    and :meth:`close` writes them, stops the thread, and closes ``target``.
+    :func:`logging.shutdown`, which runs at exit, calls both.
+
+    :param target: The :class:`logging.Handler` to write records with.
+    :param maxqueue: Maximum number of records waiting to be written.
+    :param block: What to do when the queue is full.
+      If True, wait for room. If False, drop the record
+      and increment :attr:`dropped`.
+    """
+
+    def __init__(self, target, maxqueue=10000, batchsize=100,
+                 flushinterval=1.0, block=False, level=_logging.NOTSET):
+        _logging.Handler.__init__(self, level)
+        self.target = target
+        self.batchsize = batchsize
+        self.flushinterval = flushinterval
+        self.block = block
+        #: Number of records dropped because the queue was full.
+        self.dropped = 0
+        self._queue = _queue.Queue(maxqueue)
+        self._thread = _threading.Thread(
+            target=self._run, name='AsyncHandlerWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def prepare(self, record):
+        """Return a copy of ``record`` with its args merged into its message
+        and its exception formatted, so it can be formatted later
+        on another thread. ``record`` itself is not changed,
+        since other handlers may still use it."""
+        msg = record.getMessage()
+        record = _copy.copy(record)
+        record.msg = msg
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                formatter = self.target.formatter or _logging.Formatter()
+                record.exc_text = formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if self.block:
+            self._queue.put(record)
+            return
+        try:
+            self._queue.put_nowait(record)
+        except _queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=10):
+        """Wait up to ``timeout`` seconds for queued records to be
+        written and ``target`` to be flushed."""
+        if not self._thread.is_alive():
+            return
+        done = _threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self):
+        """Write queued records, stop the writer thread,
+        and close ``target``."""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self.target.close()
+        _logging.Handler.close(self)
+
+    def _next_batch(self):
+        """Block for a record, then collect more until the batch is full
+        or ``flushinterval`` passes.
+        Return ``(records, markers)``, where markers are flush
+        events or the stop sentinel."""
+        batch = [self._queue.get()]
+        deadline = _time.time() + self.flushinterval
+        while len(batch) < self.batchsize and batch[-1] is not _STOP:
+            remaining = deadline - _time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except _queue.Empty:
+                break
+        records = [r for r in batch if isinstance(r, _logging.LogRecord)]
+        markers = [r for r in batch if not isinstance(r, _logging.LogRecord)]
+        return records, markers
+
+    def _run(self):
+        while True:
+            records, markers = self._next_batch()
+            if records:
+                self._write(records)
+            if markers:
+                try:
+                    self.target.flush()
+                except Exception:  # pragma: no cover
+                    pass
+            for marker in markers:
+                if marker is _STOP:
+                    return
+                marker.set()
+
+    def _write(self, records):
+        target = self.target
+        records = [r for r in records if r.levelno >= target.level]
+        stream = getattr(target, 'stream', None)
+        if (stream is None or type(target).emit not in (
+                _logging.StreamHandler.emit, _logging.FileHandler.emit)):
+            for record in records:
+                target.handle(record)
+            return
+        terminator = getattr(target, 'terminator', '\n')
+        chunks = []
+        for record in records:
+            if not target.filter(record):
+                continue
+            try:
+                chunks.append(target.format(record) + terminator)
+            except Exception:
+                target.handleError(record)
+        if not chunks:
+            return
+        target.acquire()
+        try:
+            stream.write(''.join(chunks))
+            target.flush()
+        except Exception:
+            target.handleError(records[-1])
+        finally:
+            target.release()
 
 
 def timestamped_filename(
@@ -105,6 +291,11 @@ def timestamp(fmt, timestruct=None):
     return _time.strftime(fmt, timestruct or _time.gmtime())
 
 
+def _timestamped_logname(basename, ext, fmt, timestruct, pid):
+    timestamped = timestamp(fmt, timestruct)
+    return '{basename}_{timestamped}_pid{pid}{ext}'.format(**locals())
+
+
 def get_timestamped_logfilename(
         folder, basename=None, ext='.log',
         fmt='%Y-%m-%d-%H-%M-%S', timestruct=None,
@@ -119,10 +310,8 @@ def get_timestamped_logfilename(
     """
     if basename is None:
         basename = _os.path.basename(folder)
-    timestamped = timestamp(fmt, timestruct)
-    pid = _getpid()
-    logname = '{basename}_{timestamped}_pid{pid}{ext}'.format(**locals())
-    logfilename = _os.path.join(folder, logname)
+    logfilename = _os.path.join(folder, _timestamped_logname(
+        basename, ext, fmt, timestruct, _getpid()))
     try:
         remove_old_files(folder, '*{basename}_*{ext}'.format(**locals()), 15)
     except OSError:
@@ -130,6 +319,192 @@ def get_timestamped_logfilename(
     return logfilename
 
 
+class TimestampedRotatingFileHandler(_logging.FileHandler):
+    """File handler that writes to files named like
+    :func:`get_timestamped_logfilename`
+    (``<folder>/<basename>_<timestamp>_pid<pid><ext>``),
+    and starts a new file once the current one reaches ``maxbytes``
+    or is ``interval`` seconds old.
+
+    Rotated files are gzipped (to ``<name><ext>.gz``) and old files
+    are removed on a background thread, so rolling over only costs the
+    logging thread opening a new file.
+    Retention applies, newest first, to gzipped rotated files in ``folder``
+    with the same ``basename`` and ``ext`` (from any process, since
+    compressed files are finished), and to uncompressed files this
+    handler rotated. Uncompressed files from other processes may still
+    be written to and are never removed,
+    nor is the file currently being written.
+
+    ``baseFilename`` is always the current file,
+    so :func:`get_filenames_from_loggers` finds it.
+
+    :param folder: Folder to put files into.
+    :param basename: The prefix of the log filenames.
+      If None, use ``os.path.basename(folder)``.
+    :param maxbytes: Roll over once the file is at least this size.
+      0 for no limit.
+    :param interval: Roll over once the file has been written to
+      for this many seconds. 0 for no limit.
+    :param backupcount: Number of rotated files to keep.
+      None for no limit.
+    :param maxtotalbytes: Remove the oldest rotated files while their
+      total size is larger than this. 0 for no limit.
+    :param compress: If True, gzip rotated files.
+    """
+
+    def __init__(self, folder, basename=None, ext='.log', maxbytes=0,
+                 interval=0, backupcount=15, maxtotalbytes=0, compress=True,
+                 fmt='%Y-%m-%d-%H-%M-%S', encoding=None,
+                 _getpid=_os.getpid, _clock=_time.time):
+        if basename is None:
+            basename = _os.path.basename(folder)
+        self.folder = folder
+        self.basename = basename
+        self.ext = ext
+        self.maxbytes = maxbytes
+        self.interval = interval
+        self.backupcount = backupcount
+        self.maxtotalbytes = maxtotalbytes
+        self.compress = compress
+        self.fmt = fmt
+        self._getpid = _getpid
+        self._clock = _clock
+        self._compressed = _osutils.GlobSet('%s_*_pid*%s.gz' % (basename, ext))
+        # Uncompressed files this handler rotated, only used on the worker
+        self._uncompressed = set()
+        self._jobs = _queue.Queue()
+        self._worker = None
+        _osutils.makedirs(folder)
+        _logging.FileHandler.__init__(
+            self, self._next_filename(), 'a', encoding)
+        self._rolloverat = self._next_rollover()
+
+    def _next_filename(self):
+        name = _timestamped_logname(
+            self.basename, self.ext, self.fmt, None, self._getpid())
+        filename = _os.path.join(self.folder, name)
+        head = filename[:-len(self.ext)] if self.ext else filename
+        counter = 0
+        while (_os.path.exists(filename) or
+               _os.path.exists(filename + '.gz')):
+            counter += 1
+            filename = '%s-%s%s' % (head, counter, self.ext)
+        return _os.path.abspath(filename)
+
+    def _next_rollover(self):
+        if not self.interval:
+            return None
+        return self._clock() + self.interval
+
+    def should_rollover(self):
+        if self.stream is None:
+            return False
+        if self._rolloverat is not None and self._clock() >= self._rolloverat:
+            return True
+        return bool(self.maxbytes) and self.stream.tell() >= self.maxbytes
+
+    def emit(self, record):
+        try:
+            if self.should_rollover():
+                self.rollover()
+        except Exception:
+            self.handleError(record)
+            return
+        _logging.FileHandler.emit(self, record)
+
+    def rollover(self):
+        """Start writing to a new file, and compress and prune old files
+        on the background thread."""
+        oldfilename = self.baseFilename
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        self.baseFilename = self._next_filename()
+        self.stream = self._open()
+        self._rolloverat = self._next_rollover()
+        self._submit(oldfilename)
+
+    def _submit(self, filename):
+        if self._worker is None:
+            self._worker = _threading.Thread(
+                target=self._run, name='TimestampedRotatingFileHandler')
+            self._worker.daemon = True
+            self._worker.start()
+        self._jobs.put(filename)
+
+    def _run(self):
+        while True:
+            filename = self._jobs.get()
+            if filename is _STOP:
+                return
+            try:
+                if self.compress:
+                    self._compress(filename)
+                else:
+                    self._uncompressed.add(filename)
+                self.prune()
+            except Exception:
+                # Same as logging's handleError, without a record
+                if _logging.raiseExceptions:
+                    _traceback.print_exc()
+
+    def _compress(self, filename):
+        if not _os.path.exists(filename):
+            return
+        gzname = filename + '.gz'
+        with open(filename, 'rb') as src:
+            with _osutils.atomic_write(gzname, 'wb', fsync=False) as f:
+                with _gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                    _shutil.copyfileobj(src, gz, 1 << 20)
+        _shutil.copystat(filename, gzname)
+        _os.remove(filename)
+
+    def prune(self):
+        """Remove the oldest rotated files in ``folder`` beyond
+        ``backupcount`` and ``maxtotalbytes``."""
+        paths = [_os.path.join(self.folder, name)
+                 for name in _os.listdir(self.folder)
+                 if self._compressed.match(name)]
+        paths.extend(self._uncompressed)
+        files = []
+        for path in paths:
+            try:
+                st = _os.stat(path)
+            except OSError:
+                self._uncompressed.discard(path)
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        files.sort(reverse=True)
+        total = 0
+        for i, (_, size, path) in enumerate(files):
+            total += size
+            if ((self.backupcount is not None and i >= self.backupcount) or
+                    (self.maxtotalbytes and total > self.maxtotalbytes)):
+                try:
+                    _os.remove(path)
+                except OSError:
+                    pass
+                self._uncompressed.discard(path)
+
+    def wait(self, timeout=None):
+        """Wait for pending compression and pruning to finish."""
+        if self._worker is None:
+            return
+        self._jobs.put(_STOP)
+        self._worker.join(timeout)
+        self._worker = None
+
+    def close(self):
+        """Close the file and wait for background work to finish."""
+        self.acquire()
+        try:
+            self.wait()
+        finally:
+            self.release()
+        _logging.FileHandler.close(self)
+
+
 def get_filenames_from_loggers(loggers=None, _loggingmodule=None):
     """
     Get the filenames of all log files from loggers.
@@ -157,14 +532,17 @@ def remove_old_files(root, namepattern='*', maxfiles=1):
     """Removes the oldest files that match ``namePattern`` inside of ``rootDir``,
     so that only ``maxfiles`` of those matches remain.
 
+    :param namepattern: A glob pattern, sequence of patterns,
+      or :class:`brennivin.osutils.GlobSet`.
     :param maxfiles: Number of files to keep. If 0, remove all files.
     """
     if maxfiles < 0:
         raise ValueError('maxfiles must be >= 0, got %s' % maxfiles)
 
+    match = _osutils.GlobSet.coerce(namepattern).match
     lstFiles = []
     for f in _os.listdir(root):
-        if _fnmatch.fnmatch(f, namepattern):
+        if match(f):
             fileName = _os.path.join(root, f)
             lstFiles.append(fileName)
     lstFiles.sort(key=_os.path.getmtime, reverse=True)
@@ -6,23 +6,64 @@ Members
 =======
 """
 
+import array as _array
 import binascii as _binascii
+import collections as _collections
 import contextlib as _contextlib
 import errno as _errno
 import fnmatch as _fnmatch
+import hashlib as _hashlib
+import json as _json
+import mmap as _mmap
 import ntpath
 import os as _os
+import posixpath as _posixpath
+import re as _re
+import select as _select
 import shutil as _shutil
 import stat as _stat
+import struct as _struct
+import sys as _sys
 import tempfile as _tempfile
 import threading as _threading
+import time as _time
+import zlib as _zlib
+
+from . import compat as _compat, threadutils as _threadutils
+
+try:
+    import concurrent.futures as _futures
+except ImportError:  # pragma: no cover
+    _futures = None
+try:
+    import contextvars as _contextvars
+except ImportError:  # pragma: no cover
+    _contextvars = None
+try:
+    import fcntl as _fcntl
+except ImportError:  # pragma: no cover
+    _fcntl = None
+try:
+    import queue as _queue
+except ImportError:  # pragma: no cover
+    # noinspection PyUnresolvedReferences
+    import Queue as _queue
+
+try:
+    _scandir = _os.scandir
+except AttributeError:  # pragma: no cover
+    try:
+        # noinspection PyUnresolvedReferences,PyPackageRequirements
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
 
 altsep = _os.altsep
 if altsep is None:
     altsep = _os.sep
 
 
-def abspathex(path, relative_to, _ignore_this=False):
+def abspathex(path, relative_to, _ignore_this=False, pathmod=_os.path):
     """Returns a normalized absoluted version of the pathname ``path``,
     relative to ``relativeTo`` directory.
     ``relativeTo`` must be an actual directory.
@@ -31,16 +72,233 @@ def abspathex(path, relative_to, _ignore_this=False):
     :param relative_to: The filename to make path absolute to.
       This path will be made absolute before using it.
     :param _ignore_this: For internal use only.
+    :param pathmod: Path module to join and normalize with,
+      such as :mod:`ntpath` to resolve Windows paths on any platform.
+      The existence of ``relative_to`` is only checked, and symlinks in it
+      resolved, for :mod:`os.path`.
+      Drive-relative paths on another drive, like ``'D:foo'``,
+      raise ``ValueError`` unless the platform can resolve them.
 
-    NOTE: This actually works by changing the cwd temporarily,
-    but will always set it back.
-    That said, there could be some side effects so use with care.
+    This is done with string operations and does not change the cwd,
+    so it is safe to call from several threads at once.
     """
-    absRelativeTo = _os.path.abspath(relative_to)
-    with change_cwd(absRelativeTo):
-        if _ignore_this:
-            raise ArithmeticError
-        return _os.path.abspath(path)
+    base = _abspath_base(relative_to, pathmod)
+    if _ignore_this:
+        raise ArithmeticError
+    return _abspath_join(base, path, pathmod)
+
+
+def abspathex_many(paths, relative_to, pathmod=_os.path):
+    """Like :func:`abspathex` for each of ``paths``,
+    but ``relative_to`` is only resolved and checked once.
+
+    :return: List of absolute paths in the same order as ``paths``.
+    """
+    base = _abspath_base(relative_to, pathmod)
+    return [_abspath_join(base, p, pathmod) for p in paths]
+
+
+def _abspath_base(relative_to, pathmod):
+    if pathmod is not _os.path:
+        return pathmod.abspath(relative_to)
+    # Resolve symlinks like the cwd would, so '..' is relative to
+    # the directory relative_to actually points to.
+    base = _os.path.realpath(relative_to)
+    if not _os.path.isdir(base):
+        code = _errno.ENOTDIR if _os.path.exists(base) else _errno.ENOENT
+        raise OSError(code, _os.strerror(code), relative_to)
+    return base
+
+
+def _abspath_join(base, path, pathmod):
+    joined = pathmod.join(base, path)
+    if not pathmod.isabs(joined):
+        # A drive-relative path on another drive, like 'D:foo',
+        # which only that drive's cwd can resolve.
+        joined = pathmod.abspath(joined)
+        if not pathmod.isabs(joined):
+            raise ValueError(
+                'Cannot make %r absolute without the cwd of its drive.'
+                % path)
+    return pathmod.normpath(joined)
+
+
+_fdatasync = getattr(_os, 'fdatasync', _os.fsync)
+
+
+def _fsync_dir(dirname):
+    """fsync a directory so renames in it are durable.
+    Not possible on Windows, where this does nothing."""
+    if _os.name == 'nt':  # pragma: no cover
+        return
+    fd = _os.open(dirname, _os.O_RDONLY)
+    try:
+        _os.fsync(fd)
+    except OSError as ex:
+        # Some filesystems do not support fsyncing directories
+        if ex.errno not in (_errno.EINVAL, _errno.EBADF):
+            raise
+    finally:
+        _os.close(fd)
+
+
+def _create_temp_beside(filename):
+    """Create a new file next to ``filename`` and return
+    ``(fd, tempname)``. Unlike :func:`tempfile.mkstemp`,
+    the file gets the same default permissions as a regular new file."""
+    dirname, basename = _os.path.split(_os.path.abspath(filename))
+    flags = _os.O_WRONLY | _os.O_CREAT | _os.O_EXCL | getattr(_os, 'O_BINARY', 0)
+    while True:
+        tempname = _os.path.join(dirname, '.%s.%s.tmp' % (
+            basename, _binascii.hexlify(_os.urandom(6)).decode('ascii')))
+        try:
+            return _os.open(tempname, flags, 0o666), tempname
+        except OSError as ex:
+            if ex.errno != _errno.EEXIST:  # pragma: no cover
+                raise
+
+
+@_contextlib.contextmanager
+def atomic_write(filename, mode='w', fsync=True, group=None, **kwargs):
+    """Context manager for writing a file so that readers,
+    and the file after a crash, see either the old or the new contents,
+    never a partial write.
+
+    Yields a file object for a temporary file in the same directory as
+    ``filename``. When the block exits without an error,
+    the temporary file is flushed, fsync'ed if ``fsync`` is True
+    (using ``fdatasync`` where available), and moved over ``filename``,
+    and the directory is fsync'ed so the move is durable.
+    If the block raises, the temporary file is removed and ``filename``
+    is untouched.
+
+    If ``filename`` exists, its permission bits are kept.
+    If ``filename`` is a symlink, the file it points to is replaced,
+    and the link is kept.
+
+    :param mode: File mode, must be ``'w'`` or ``'wb'`` (or ``'wt'``).
+    :param group: A :class:`GroupCommit`. The temporary file is not synced
+      or moved until the group is committed, so many writes can share
+      the cost of syncing.
+    :param kwargs: Passed to :func:`os.fdopen`, such as ``encoding``.
+    """
+    if not mode.startswith('w') or '+' in mode:
+        raise ValueError('atomic_write mode must be w, wb, or wt, got %r'
+                         % mode)
+    filename = _os.path.realpath(filename)
+    fd, tempname = _create_temp_beside(filename)
+    try:
+        with _os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+            f.flush()
+            if fsync and group is None:
+                _fdatasync(f.fileno())
+        try:
+            _shutil.copymode(filename, tempname)
+        except OSError:
+            pass
+        if group is not None:
+            group.add(tempname, filename)
+        else:
+            _replace(tempname, filename)
+            if fsync:
+                _fsync_dir(_os.path.dirname(filename))
+    except BaseException:
+        if _os.path.exists(tempname):
+            _os.remove(tempname)
+        raise
+
+
+class GroupCommit(object):
+    """Batches the syncing and renaming of many :func:`atomic_write` calls
+    so a high rate of small writes stays cheap.
+
+    Files written with ``group=`` this object are left as temporary files
+    until :meth:`commit`, which fsyncs all of them, moves each over its
+    target, then fsyncs each directory once.
+    Commit happens automatically when ``maxpending`` writes are pending,
+    when ``maxdelay`` seconds have passed since the oldest pending write
+    (checked when adding a write), and when used as a context manager
+    and the block exits.
+
+    Until a commit, targets have their old contents.
+    If the same target is written twice, only the latest write is kept.
+    Thread-safe.
+
+    :param fsync: If False, do not fsync files or directories,
+      only move them into place.
+    """
+
+    def __init__(self, maxpending=100, maxdelay=1.0, fsync=True,
+                 clock=None):
+        self.maxpending = maxpending
+        self.maxdelay = maxdelay
+        self.fsync = fsync
+        self._clock = clock or _time.time
+        self._lock = _threading.Lock()
+        self._pending = _collections.OrderedDict()
+        self._oldest = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.commit()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, tempname, filename):
+        """Add a finished temporary file to be moved over ``filename``
+        at the next commit. Usually called by :func:`atomic_write`."""
+        filename = _os.path.abspath(filename)
+        with self._lock:
+            old = self._pending.pop(filename, None)
+            if old is not None:
+                _os.remove(old)
+            self._pending[filename] = tempname
+            now = self._clock()
+            if self._oldest is None:
+                self._oldest = now
+            due = (len(self._pending) >= self.maxpending or
+                   now - self._oldest >= self.maxdelay)
+        if due:
+            self.commit()
+
+    def commit(self):
+        """Sync and move all pending files into place.
+        Return the list of filenames that were committed."""
+        with self._lock:
+            pending = list(self._pending.items())
+            self._pending.clear()
+            self._oldest = None
+        if self.fsync:
+            for _, tempname in pending:
+                fd = _os.open(tempname, _os.O_RDONLY)
+                try:
+                    _fdatasync(fd)
+                finally:
+                    _os.close(fd)
+        dirnames = []
+        for filename, tempname in pending:
+            _replace(tempname, filename)
+            dirname = _os.path.dirname(filename)
+            if dirname not in dirnames:
+                dirnames.append(dirname)
+        if self.fsync:
+            for dirname in dirnames:
+                _fsync_dir(dirname)
+        return [filename for filename, _ in pending]
+
+    def discard(self):
+        """Remove all pending temporary files without committing them."""
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+            self._oldest = None
+        for tempname in pending:
+            if _os.path.exists(tempname):
+                _os.remove(tempname)
 
 
 _changecwd_lock = _threading.Lock()
@@ -83,6 +341,109 @@ def change_environ(key, newvalue):
             _os.environ[key] = oldvalue
 
 
+class _ThreadLocalVar(object):
+    """Minimal stand-in for :class:`contextvars.ContextVar`
+    when it is not available, where each thread is a context."""
+    def __init__(self, name, default=None):
+        self.name = name
+        self._default = default
+        self._local = _threading.local()
+
+    def get(self):
+        return getattr(self._local, 'value', self._default)
+
+    def set(self, value):
+        token = self.get()
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token
+
+
+def _context_var(name):
+    if _contextvars is None:  # pragma: no cover
+        return _ThreadLocalVar(name, None)
+    return _contextvars.ContextVar(name, default=None)
+
+
+_context_env = _context_var('brennivin_osutils_environ')
+_context_cwd = _context_var('brennivin_osutils_cwd')
+
+
+@_contextlib.contextmanager
+def context_environ(key, newvalue):
+    """Like :func:`change_environ`, but the change is only visible
+    in the current :mod:`contextvars` context (such as the current
+    thread, asyncio task, or ``contextvars.Context.run`` call),
+    and ``os.environ`` is not changed.
+
+    Use :func:`get_context_environ` or :func:`context_popen_kwargs`
+    to get the resulting environment, for example to pass to
+    :mod:`subprocess`.
+    Without :mod:`contextvars` (before Python 3.7),
+    each thread is a context.
+    """
+    overlay = dict(_context_env.get() or ())
+    overlay[key] = newvalue
+    token = _context_env.set(overlay)
+    try:
+        yield
+    finally:
+        _context_env.reset(token)
+
+
+@_contextlib.contextmanager
+def context_cwd(cwd):
+    """Like :func:`change_cwd`, but the cwd is only set for the current
+    :mod:`contextvars` context, and the process cwd is not changed,
+    so no lock is needed.
+
+    ``cwd`` is resolved relative to the current context cwd.
+    Use :func:`get_context_cwd`, :func:`context_abspath`,
+    or :func:`context_popen_kwargs` to apply it.
+    """
+    newcwd = abspathex('.', context_abspath(cwd))
+    token = _context_cwd.set(newcwd)
+    try:
+        yield
+    finally:
+        _context_cwd.reset(token)
+
+
+def get_context_environ():
+    """Return a new dict of ``os.environ`` with the changes
+    from :func:`context_environ` applied."""
+    env = dict(_os.environ)
+    for key, value in (_context_env.get() or {}).items():
+        if value is None:
+            env.pop(key, None)
+        else:
+            env[key] = value
+    return env
+
+
+def get_context_cwd():
+    """Return the cwd set by :func:`context_cwd`, or ``os.getcwd()``."""
+    return _context_cwd.get() or _os.getcwd()
+
+
+def context_abspath(path):
+    """Return ``path`` made absolute relative to :func:`get_context_cwd`."""
+    return _abspath_join(get_context_cwd(), path, _os.path)
+
+
+def context_popen_kwargs(**kwargs):
+    """Return ``kwargs`` with ``env`` and ``cwd`` set from the current
+    context (unless already in ``kwargs``), to pass to
+    :class:`subprocess.Popen` and friends."""
+    if _context_env.get():
+        kwargs.setdefault('env', get_context_environ())
+    if _context_cwd.get():
+        kwargs.setdefault('cwd', _context_cwd.get())
+    return kwargs
+
+
 def change_ext(path, ext):
     """Changes the extension of path to be ext.
     If path has no extension, ext will be appended.
@@ -102,32 +463,1394 @@ def copy(src, dst):
     src and dst should be filenames (not directories).
     """
     dirname = _os.path.dirname(dst)
-    if not _os.path.isdir(dirname):
-        _os.makedirs(dirname)
-    _shutil.copy(src, dst)
+    if dirname:
+        makedirs(dirname)
+    _copy_data(src, dst)
+    _shutil.copymode(src, dst)
+
+
+# From linux/fs.h
+_FICLONE = 0x40049409
+# Errors that mean the kernel or filesystem cannot do a particular
+# kind of copy, so we should try the next one.
+_COPY_FALLBACK_ERRNOS = frozenset(
+    getattr(_errno, name) for name in (
+        'ENOSYS', 'EXDEV', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTTY',
+        'EBADF', 'EPERM', 'ETXTBSY', 'ENODATA')
+    if hasattr(_errno, name))
+
+
+def _copy_file_range(infd, outfd, offset, count):
+    return _os.copy_file_range(infd, outfd, count, offset, None)
+
+
+def _sendfile(infd, outfd, offset, count):
+    return _os.sendfile(outfd, infd, offset, count)
+
+
+def _kernel_copies():
+    if hasattr(_os, 'copy_file_range'):
+        yield _copy_file_range
+    if hasattr(_os, 'sendfile') and _sys.platform.startswith('linux'):
+        yield _sendfile
+
+
+def _kernel_copy(func, infd, outfd, size):
+    """Copy all of ``infd`` to ``outfd`` with ``func``.
+    Returns False if nothing was copied because ``func`` is not supported
+    for these files."""
+    blocksize = min(max(size, 1 << 23), 1 << 30)
+    offset = 0
+    while True:
+        try:
+            sent = func(infd, outfd, offset, blocksize)
+        except OSError as ex:
+            if offset == 0 and ex.errno in _COPY_FALLBACK_ERRNOS:
+                return False
+            raise
+        if not sent:
+            return True
+        offset += sent
+
+
+def _copy_data(src, dst, reflink=True):
+    """Copies the contents of ``src`` to ``dst``, in the kernel if possible.
+    Tries, in order, a reflink (``FICLONE``, which shares data blocks
+    on filesystems like btrfs and XFS), ``copy_file_range``,
+    ``sendfile``, and finally a read/write loop."""
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            infd = fsrc.fileno()
+            outfd = fdst.fileno()
+            if reflink and _fcntl is not None:
+                try:
+                    _fcntl.ioctl(outfd, _FICLONE, infd)
+                    return
+                except (IOError, OSError) as ex:
+                    if ex.errno not in _COPY_FALLBACK_ERRNOS:
+                        raise
+            size = _os.fstat(infd).st_size
+            for func in _kernel_copies():
+                if _kernel_copy(func, infd, outfd, size):
+                    return
+            _shutil.copyfileobj(fsrc, fdst, 1 << 20)
+
+
+def copy_file(src, dst, reflink=True):
+    """Copies the contents, permission bits, and times of ``src``
+    to ``dst``, like :func:`shutil.copy2`,
+    but using reflinks, ``copy_file_range``, or ``sendfile``
+    when the platform supports them, so data need not pass through Python.
+    The directory of ``dst`` must exist.
+
+    :param reflink: If False, do not try to reflink
+      (the copy will not share data blocks with ``src``).
+    """
+    _copy_data(src, dst, reflink)
+    _shutil.copystat(src, dst)
+
+
+def _is_unchanged(src, dst):
+    try:
+        dstst = _os.stat(dst)
+    except OSError:
+        return False
+    return _stat_key(_os.stat(src))[:2] == _stat_key(dstst)[:2]
+
+
+def copy_files(pairs, workers=8, skipunchanged=True, reflink=True):
+    """Copies many files with :func:`copy_file` on a thread pool.
+
+    Destination directories are created up front, once each,
+    rather than checked for every file.
+
+    :param pairs: Iterable of ``(src, dst)`` filenames.
+    :param workers: Number of copying threads.
+      If 1, or :mod:`concurrent.futures` is not available,
+      files are copied on the calling thread.
+    :param skipunchanged: If True, do not copy files where ``dst``
+      has the same size and modification time as ``src``.
+      Since :func:`copy_file` copies the modification time,
+      this skips files copied previously and not changed since.
+    :return: List of ``dst`` filenames that were copied.
+    """
+    pairs = list(pairs)
+    for dirname in sorted(set(_os.path.dirname(dst) for _, dst in pairs)):
+        if dirname:
+            makedirs(dirname)
+
+    def copyone(pair):
+        src, dst = pair
+        if skipunchanged and _is_unchanged(src, dst):
+            return None
+        copy_file(src, dst, reflink)
+        return dst
+
+    if workers <= 1 or _futures is None:
+        copied = map(copyone, pairs)
+    else:
+        with _futures.ThreadPoolExecutor(workers) as pool:
+            copied = list(pool.map(copyone, pairs))
+    return [dst for dst in copied if dst is not None]
+
+
+def copy_tree(srcdir, dstdir, include='*', exclude=None, excludedirs=None,
+              **kwargs):
+    """Copies files under ``srcdir`` that are found by :func:`walk_files`
+    to the same relative paths under ``dstdir``, using :func:`copy_files`.
+
+    :param kwargs: Passed to :func:`copy_files`.
+    :return: List of destination filenames that were copied.
+    """
+    prefixlen = len(_os.path.join(srcdir, ''))
+    pairs = [(path, _os.path.join(dstdir, path[prefixlen:]))
+             for path in walk_files(srcdir, include, exclude, excludedirs)]
+    return copy_files(pairs, **kwargs)
 
 
 def crc_from_filename(filename):
     """Returns the 32-bit crc for the file at filename."""
+    return file_digests(filename, ('crc32',))['crc32']
+
+
+class _ZlibChecksum(object):
+    """Gives zlib's checksum functions the ``update`` interface of
+    :mod:`hashlib` objects."""
+    def __init__(self, func, start):
+        self.func = func
+        self.value = start
+
+    def update(self, data):
+        self.value = self.func(data, self.value)
+
+    def result(self):
+        # See python docs for reason for &
+        return self.value & 0xffffffff
+
+
+def _new_checksum(name):
+    if name == 'crc32':
+        return _ZlibChecksum(_binascii.crc32, 0)
+    if name == 'adler32':
+        return _ZlibChecksum(_zlib.adler32, 1)
+    return _hashlib.new(name)
+
+
+def file_digests(filename, algorithms=('crc32',), bufsize=1 << 20,
+                 usemmap=False):
+    """Computes checksums of the file at ``filename`` in a single pass,
+    without reading the whole file into memory.
+
+    :param algorithms: Names of checksums to compute.
+      ``'crc32'`` and ``'adler32'`` give 32-bit ints,
+      and any :mod:`hashlib` algorithm (such as ``'md5'``, ``'sha1'``,
+      ``'sha256'``, or ``'blake2b'``) gives a hex digest string.
+    :param bufsize: Size of the buffer the file is read into.
+      Files smaller than this are read into a buffer of their size.
+    :param usemmap: If True, memory-map the file instead of reading it.
+      Ignored on Python 2.
+    :return: Dict of algorithm name to checksum.
+    """
+    checksums = [(name, _new_checksum(name)) for name in algorithms]
+    updaters = [c.update for _, c in checksums]
     with open(filename, 'rb') as f:
-        data = f.read()
-    # See python docs for reason for &
-    return _binascii.crc32(data) & 0xffffffff
+        size = _os.fstat(f.fileno()).st_size
+        # Python 2 can't take a memoryview of an mmap.
+        if usemmap and size and _compat.PY3K:
+            m = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ)
+            try:
+                view = memoryview(m)
+                try:
+                    for start in range(0, size, bufsize):
+                        chunk = view[start:start + bufsize]
+                        for update in updaters:
+                            update(chunk)
+                        chunk.release()
+                finally:
+                    view.release()
+            finally:
+                m.close()
+        else:
+            # Don't allocate a full buffer for small files. Files that
+            # report a size of 0 (like in /proc) may still have data.
+            buf = bytearray(min(bufsize, size) or bufsize)
+            view = memoryview(buf)
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                chunk = view[:n]
+                for update in updaters:
+                    update(chunk)
+    result = {}
+    for name, c in checksums:
+        if isinstance(c, _ZlibChecksum):
+            result[name] = c.result()
+        else:
+            result[name] = c.hexdigest()
+    return result
+
+
+def _stat_key(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:  # pragma: no cover
+        mtime_ns = int(st.st_mtime * 1e9)
+    return [st.st_size, mtime_ns, st.st_ino]
+
+
+class DigestCache(object):
+    """Cache of file checksums keyed by absolute path,
+    which is valid as long as the file's size, modification time
+    (in nanoseconds), and inode are the same.
+    Used by :func:`batch_digests` so unchanged files are not read again.
+    Thread-safe.
+
+    :param filename: Path to a json file to load the cache from and
+      :meth:`save` it to. If None, the cache is only in memory.
+      If the file is missing or corrupt, start empty.
+    """
+
+    VERSION = 1
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._entries = {}
+        self._lock = _threading.Lock()
+        if filename and _os.path.isfile(filename):
+            try:
+                with open(filename) as f:
+                    data = _json.load(f)
+                if data.get('version') == self.VERSION:
+                    self._entries = data['entries']
+            except (ValueError, KeyError, AttributeError, TypeError):
+                pass
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, path, algorithms, st=None):
+        """Return the cached dict of checksums for ``path`` if it has
+        all of ``algorithms`` and the file has not changed, or None.
+
+        :param st: Result of ``os.stat(path)``, if already available.
+        """
+        path = _os.path.abspath(path)
+        entry = self._entries.get(path)
+        if entry is None:
+            return None
+        if st is None:
+            try:
+                st = _os.stat(path)
+            except OSError:
+                return None
+        if entry[:3] != _stat_key(st):
+            return None
+        digests = entry[3]
+        if not all(a in digests for a in algorithms):
+            return None
+        return dict((a, digests[a]) for a in algorithms)
+
+    def set(self, path, st, digests):
+        """Store ``digests`` for ``path``, whose stat result is ``st``.
+        Existing digests for other algorithms are kept if the file
+        is unchanged."""
+        path = _os.path.abspath(path)
+        key = _stat_key(st)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[:3] == key:
+                entry[3].update(digests)
+            else:
+                self._entries[path] = key + [dict(digests)]
+
+    def prune(self):
+        """Remove entries for files that no longer exist."""
+        with self._lock:
+            for path in list(self._entries):
+                if not _os.path.exists(path):
+                    del self._entries[path]
+
+    def save(self):
+        """Write the cache to ``filename`` by writing a temporary file
+        and moving it over ``filename``."""
+        if not self.filename:
+            raise ValueError('Cache has no filename to save to.')
+        with self._lock:
+            data = {'version': self.VERSION, 'entries': self._entries}
+            makedirs(_os.path.dirname(_os.path.abspath(self.filename)))
+            with atomic_write(self.filename, fsync=False) as f:
+                _json.dump(data, f)
+
+
+def _replace(src, dst):
+    replace = getattr(_os, 'replace', None)
+    if replace is not None:
+        replace(src, dst)
+        return
+    if _os.path.exists(dst):  # pragma: no cover
+        _os.remove(dst)
+    _os.rename(src, dst)
+
+
+def batch_digests(paths, algorithms=('crc32',), workers=8, cache=None,
+                  bufsize=1 << 20):
+    """Computes checksums for many files (see :func:`file_digests`)
+    on a thread pool.
+
+    :param paths: Paths to files.
+    :param workers: Number of threads to read files on.
+      If 1, or :mod:`concurrent.futures` is not available,
+      files are read on the calling thread.
+    :param cache: A :class:`DigestCache`. Files that have not changed since
+      they were cached are not read. New results are added to the cache,
+      but it is not saved.
+    :return: Dict of path to a dict of algorithm name to checksum.
+    """
+    algorithms = tuple(algorithms)
+
+    def digest(path):
+        st = _os.stat(path)
+        if cache is not None:
+            cached = cache.get(path, algorithms, st)
+            if cached is not None:
+                return cached
+        digests = file_digests(path, algorithms, bufsize)
+        if cache is not None:
+            cache.set(path, st, digests)
+        return digests
+
+    paths = list(paths)
+    if workers <= 1 or _futures is None:
+        return dict((p, digest(p)) for p in paths)
+    with _futures.ThreadPoolExecutor(workers) as pool:
+        return dict(zip(paths, pool.map(digest, paths)))
 
 
 def iter_files(directory, pattern='*'):
-    """Returns a generator of files under directory that match pattern."""
-    for root, dirs, files in _os.walk(directory):
-        for basename in files:
-            if _fnmatch.fnmatch(basename, pattern):
-                filename = _os.path.join(root, basename)
-                yield filename
+    """Returns a generator of files under directory that match pattern.
+
+    :param pattern: A glob pattern, sequence of patterns,
+      or :class:`GlobSet`.
+    """
+    return walk_files(directory, pattern)
+
+
+class _ListdirEntry(object):
+    """Stand-in for ``os.DirEntry`` when ``scandir`` is not available."""
+    def __init__(self, root, name):
+        self.name = name
+        self.path = _os.path.join(root, name)
+
+    def is_dir(self):
+        return _os.path.isdir(self.path)
+
+    def is_file(self):
+        return _os.path.isfile(self.path)
+
+    def is_symlink(self):
+        return _os.path.islink(self.path)
+
+    def stat(self):
+        return _os.stat(self.path)
+
+
+def _iter_dir(path):
+    if _scandir is not None:
+        return _scandir(path)
+    return [_ListdirEntry(path, name) for name in _os.listdir(path)]
+
+
+_GLOB_SPECIAL = frozenset('*?[')
+
+
+class GlobSet(object):
+    """A set of glob patterns compiled once, to match many names
+    against, with the same semantics as :func:`fnmatch.fnmatch`.
+
+    Patterns are sorted into buckets so most do not need a regex:
+    literal names are looked up in a set, ``*.ext`` patterns by each of
+    the name's extensions, and ``prefix*`` patterns by the name's prefix.
+    Remaining patterns are combined into a single regex.
+    So matching hundreds of patterns costs about the same as matching one.
+
+    Instances are callable (same as :meth:`match`),
+    so they can be used as :mod:`brennivin.zipfileutils` filters.
+    They can also be passed as patterns to :func:`walk_files`,
+    :func:`iter_files`, :func:`listdirex`,
+    and :func:`brennivin.logutils.remove_old_files`.
+
+    :param patterns: A glob pattern or sequence of glob patterns.
+    """
+
+    def __init__(self, patterns):
+        if isinstance(patterns, _compat.StringTypes):
+            patterns = [patterns]
+        self.patterns = tuple(patterns)
+        self._matchall = []
+        self._literals = {}
+        self._exts = {}
+        self._prefixes = {}
+        self._others = []
+        for i, pattern in enumerate(self.patterns):
+            self._add(i, _os.path.normcase(pattern))
+        self._prefixlens = sorted(self._prefixes)
+        self._othersre = None
+        if self._others:
+            self._othersre = _re.compile('|'.join(
+                '(?:%s)' % r.pattern for (_, r) in self._others))
+
+    def _add(self, i, pattern):
+        if pattern == '*':
+            self._matchall.append(i)
+            return
+        specials = [j for (j, c) in enumerate(pattern) if c in _GLOB_SPECIAL]
+        if not specials:
+            self._literals.setdefault(pattern, []).append(i)
+        elif specials == [0] and pattern.startswith('*.'):
+            self._exts.setdefault(pattern[2:], []).append(i)
+        elif specials == [len(pattern) - 1] and pattern.endswith('*'):
+            prefix = pattern[:-1]
+            self._prefixes.setdefault(len(prefix), {}).setdefault(
+                prefix, []).append(i)
+        else:
+            self._others.append(
+                (i, _re.compile(_fnmatch.translate(pattern))))
+
+    def __repr__(self):
+        return 'GlobSet(%r)' % (self.patterns,)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def _bucket_hits(self, name):
+        """Yield lists of pattern indices matched by the bucketed
+        patterns."""
+        if self._matchall:
+            yield self._matchall
+        hits = self._literals.get(name)
+        if hits:
+            yield hits
+        if self._exts:
+            dot = name.find('.')
+            while dot >= 0:
+                hits = self._exts.get(name[dot + 1:])
+                if hits:
+                    yield hits
+                dot = name.find('.', dot + 1)
+        for length in self._prefixlens:
+            if length > len(name):
+                break
+            hits = self._prefixes[length].get(name[:length])
+            if hits:
+                yield hits
+
+    def match(self, name):
+        """Return True if ``name`` matches any of the patterns."""
+        name = _os.path.normcase(name)
+        for _ in self._bucket_hits(name):
+            return True
+        return bool(self._othersre and self._othersre.match(name))
+    __call__ = match
+
+    def matches(self, name):
+        """Return the list of patterns that ``name`` matches,
+        in the order they were given."""
+        name = _os.path.normcase(name)
+        indices = []
+        for hits in self._bucket_hits(name):
+            indices.extend(hits)
+        if self._othersre and self._othersre.match(name):
+            indices.extend(i for (i, r) in self._others if r.match(name))
+        return [self.patterns[i] for i in sorted(indices)]
+
+    def filter(self, names):
+        """Return the list of ``names`` that match any of the patterns."""
+        return [n for n in names if self.match(n)]
+
+    @classmethod
+    def coerce(cls, patterns):
+        """Return ``patterns`` if it is a :class:`GlobSet`,
+        otherwise a new :class:`GlobSet` of ``patterns``."""
+        if isinstance(patterns, cls):
+            return patterns
+        return cls(patterns)
+
+
+def _coerce_globs(patterns):
+    """:meth:`GlobSet.coerce`, but None stays None."""
+    return None if patterns is None else GlobSet.coerce(patterns)
+
+
+def _scan_dir(root, include, exclude, excludedirs):
+    """List ``root`` and return ``(files, subdirs)``, lists of entries
+    for the files that match and the directories to walk into.
+    Matchers are :class:`GlobSet` instances, or None to not filter.
+    Returns empty lists if ``root`` cannot be listed, like :func:`os.walk`.
+    """
+    files = []
+    subdirs = []
+    try:
+        dirents = _iter_dir(root)
+    except OSError:
+        return files, subdirs
+    try:
+        for entry in dirents:
+            try:
+                isdir = entry.is_dir()
+            except OSError:
+                isdir = False
+            name = entry.name
+            if isdir:
+                if excludedirs is not None and excludedirs.match(name):
+                    continue
+                try:
+                    islink = entry.is_symlink()
+                except OSError:
+                    islink = False
+                if not islink:
+                    subdirs.append(entry)
+                continue
+            if include is not None and not include.match(name):
+                continue
+            if exclude is not None and exclude.match(name):
+                continue
+            files.append(entry)
+    finally:
+        close = getattr(dirents, 'close', None)
+        if close is not None:
+            close()
+    return files, subdirs
+
+
+def walk_files(directory, include='*', exclude=None, excludedirs=None,
+               entries=False):
+    """Returns a generator of files under ``directory``,
+    walking it top-down like :func:`os.walk` does,
+    but using ``os.scandir`` so file types do not need to be looked up
+    again.
+
+    Patterns are matched against file and directory basenames
+    like :func:`fnmatch.fnmatch`. All patterns of each kind are compiled
+    into a single :class:`GlobSet`, and a :class:`GlobSet` can be passed
+    instead of patterns.
+
+    :param include: Glob pattern, or sequence of patterns,
+      that a file's name must match.
+    :param exclude: Pattern or sequence of patterns of files to skip.
+    :param excludedirs: Pattern or sequence of patterns of directories
+      to skip. Matching directories are not walked into at all.
+    :param entries: If True, yield ``os.DirEntry`` instances
+      (whose ``stat()`` results are cached) instead of paths.
+    """
+    matchers = (_coerce_globs(include), _coerce_globs(exclude),
+                _coerce_globs(excludedirs))
+    stack = [directory]
+    while stack:
+        files, subdirs = _scan_dir(stack.pop(), *matchers)
+        for entry in files:
+            yield entry if entries else entry.path
+        stack.extend(d.path for d in reversed(subdirs))
+
+
+class _WalkError(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+_WALK_DONE = object()
+
+
+def walk_files_parallel(directory, include='*', exclude=None,
+                        excludedirs=None, entries=False, workers=8,
+                        maxqueue=1024, sort=False):
+    """Like :func:`walk_files`, but lists directories on a thread pool,
+    which is much faster on network or SSD-backed filesystems.
+
+    By default, files are yielded in whatever order directories finish
+    being listed. Results are passed through a queue of at most
+    ``maxqueue`` directory listings, so listing waits for the caller to
+    catch up.
+
+    If ``sort`` is True, files are yielded in a deterministic order:
+    the same top-down order as :func:`walk_files`, but with files and
+    directories sorted by name. Up to ``maxqueue`` directories are listed
+    ahead of the caller.
+
+    Requires :mod:`concurrent.futures`.
+
+    :param workers: Maximum number of listing threads.
+    """
+    if _futures is None:
+        raise NotImplementedError(
+            'concurrent.futures is required for walk_files_parallel.')
+    matchers = (_coerce_globs(include), _coerce_globs(exclude),
+                _coerce_globs(excludedirs))
+    if sort:
+        walker = _walk_sorted
+    else:
+        walker = _walk_unordered
+    for entry in walker(directory, matchers, workers, maxqueue):
+        yield entry if entries else entry.path
+
+
+def _walk_unordered(directory, matchers, workers, maxqueue):
+    results = _queue.Queue(maxqueue)
+    cancelled = _threading.Event()
+    lock = _threading.Lock()
+    pending = [1]
+    pool = _futures.ThreadPoolExecutor(workers)
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                results.put(item, timeout=.1)
+                return
+            except _queue.Full:
+                pass
+
+    def scan(root):
+        try:
+            if cancelled.is_set():
+                return
+            files, subdirs = _scan_dir(root, *matchers)
+            with lock:
+                pending[0] += len(subdirs)
+            for d in subdirs:
+                try:
+                    pool.submit(scan, d.path)
+                except RuntimeError:
+                    # Pool was shut down because the walk was cancelled.
+                    if not cancelled.is_set():
+                        raise
+            if files:
+                put(files)
+        except Exception:
+            put(_WalkError(_sys.exc_info()))
+        finally:
+            with lock:
+                pending[0] -= 1
+                done = not pending[0]
+            if done:
+                put(_WALK_DONE)
+
+    try:
+        pool.submit(scan, directory)
+        while True:
+            item = results.get()
+            if item is _WALK_DONE:
+                break
+            if isinstance(item, _WalkError):
+                _compat.reraise(*item.exc_info)
+            for entry in item:
+                yield entry
+    finally:
+        cancelled.set()
+        pool.shutdown(True)
+
+
+def _walk_sorted(directory, matchers, workers, maxqueue):
+    def listing(root):
+        files, subdirs = _scan_dir(root, *matchers)
+        files.sort(key=lambda e: e.name)
+        subdirs.sort(key=lambda e: e.name)
+        return files, subdirs
+
+    pool = _futures.ThreadPoolExecutor(workers)
+    stack = [pool.submit(listing, directory)]
+    prefetched = [1]
+    try:
+        while stack:
+            item = stack.pop()
+            if isinstance(item, _futures.Future):
+                prefetched[0] -= 1
+                files, subdirs = item.result()
+            else:
+                files, subdirs = listing(item)
+            children = []
+            for d in subdirs:
+                if prefetched[0] < maxqueue:
+                    children.append(pool.submit(listing, d.path))
+                    prefetched[0] += 1
+                else:
+                    children.append(d.path)
+            children.reverse()
+            stack.extend(children)
+            for entry in files:
+                yield entry
+    finally:
+        for item in stack:
+            if isinstance(item, _futures.Future):
+                item.cancel()
+        pool.shutdown(True)
+
+
+class TreeDiff(_collections.namedtuple(
+        'TreeDiff', ['added', 'removed', 'changed'])):
+    """Result of :meth:`TreeSnapshot.diff`.
+    Each field is a sorted list of relative paths:
+
+    - ``added``: Files only in the newer snapshot.
+    - ``removed``: Files only in the older snapshot.
+    - ``changed``: Files in both whose size, mode, or content differ.
+
+    Evaluates to False if there are no differences.
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+    __nonzero__ = __bool__
+
+
+_PATH_ERRORS = 'surrogateescape' if _compat.PY3K else 'strict'
+
+
+def _int64_typecode():
+    """Return an array typecode for 64-bit ints.
+    Python 2 has no ``'q'``, and ``'l'`` is 32 bits on Windows,
+    so fall back to doubles, which are exact up to 2**53
+    (mtimes in nanoseconds lose some sub-microsecond precision)."""
+    for typecode in ('q', 'l'):
+        try:
+            if _array.array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return 'd'
+
+
+_INT64 = _int64_typecode()
+
+
+def _array_tobytes(arr):
+    if arr.typecode == 'd':
+        # Doubles standing in for int64s are saved as int64s.
+        return _struct.pack('<%dq' % len(arr), *[int(x) for x in arr])
+    if _sys.byteorder == 'big':  # pragma: no cover
+        arr = _array.array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes() if _compat.PY3K else arr.tostring()
+
+
+def _array_frombytes(typecode, data):
+    if typecode == 'd':
+        return _array.array(
+            typecode, _struct.unpack('<%dq' % (len(data) // 8), data))
+    arr = _array.array(typecode)
+    if _compat.PY3K:
+        arr.frombytes(data)
+    else:  # pragma: no cover
+        arr.fromstring(data)
+    if _sys.byteorder == 'big':  # pragma: no cover
+        arr.byteswap()
+    return arr
+
+
+class TreeSnapshot(object):
+    """The files in a directory tree, with each file's relative path,
+    size, modification time (in nanoseconds), mode, and optionally CRC32.
+
+    Information is stored in parallel arrays sorted by path,
+    rather than an object per file,
+    so snapshots of large trees are compact and fast to save and load.
+
+    Create snapshots with :meth:`capture` or :meth:`load`.
+    """
+
+    MAGIC = b'BRTS'
+    VERSION = 1
+    _HEADER = _struct.Struct('<4sBBxxQ')
+    _HASHED = 1
+
+    def __init__(self, paths=(), sizes=(), mtimes=(), modes=(), crcs=None):
+        #: Sorted list of paths, relative to the captured directory.
+        self.paths = list(paths)
+        self.sizes = _array.array(_INT64, sizes)
+        self.mtimes = _array.array(_INT64, mtimes)
+        self.modes = _array.array('I', modes)
+        #: Array of CRC32s, or None if the snapshot was not hashed.
+        self.crcs = None if crcs is None else _array.array('I', crcs)
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def hashed(self):
+        return self.crcs is not None
+
+    def index(self):
+        """Return a dict of relative path to index into the arrays."""
+        return dict((p, i) for (i, p) in enumerate(self.paths))
+
+    @classmethod
+    def capture(cls, directory, include='*', exclude=None, excludedirs=None,
+                hashed=False, workers=8, cache=None):
+        """Snapshot the files under ``directory``,
+        as found by :func:`walk_files`.
+
+        :param hashed: If True, compute the CRC32 of every file
+          using :func:`batch_digests`.
+        :param workers: Passed to :func:`batch_digests`.
+        :param cache: A :class:`DigestCache` passed to :func:`batch_digests`.
+        """
+        prefixlen = len(_os.path.join(directory, ''))
+        rows = []
+        for entry in walk_files(directory, include, exclude, excludedirs,
+                                entries=True):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            size, mtime = _stat_key(st)[:2]
+            rows.append((entry.path[prefixlen:], size, mtime,
+                         _stat.S_IMODE(st.st_mode)))
+        rows.sort()
+        snapshot = cls(*zip(*rows)) if rows else cls()
+        if hashed:
+            snapshot.crcs = _array.array('I', snapshot._crcs_under(
+                directory, range(len(snapshot)), workers, cache))
+        return snapshot
+
+    def _crcs_under(self, directory, indices, workers, cache):
+        paths = [_os.path.join(directory, self.paths[i]) for i in indices]
+        digests = batch_digests(paths, workers=workers, cache=cache)
+        return [digests[p]['crc32'] for p in paths]
+
+    def save(self, filename):
+        """Write the snapshot to a binary file."""
+        flags = self._HASHED if self.hashed else 0
+        pathdata = '\0'.join(self.paths).encode('utf-8', _PATH_ERRORS)
+        with open(filename, 'wb') as f:
+            f.write(self._HEADER.pack(
+                self.MAGIC, self.VERSION, flags, len(self)))
+            arrays = [self.sizes, self.mtimes, self.modes]
+            if self.hashed:
+                arrays.append(self.crcs)
+            for arr in arrays:
+                f.write(_array_tobytes(arr))
+            f.write(pathdata)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a snapshot written by :meth:`save`.
+        Raise ValueError if the file is not a snapshot."""
+        with open(filename, 'rb') as f:
+            data = f.read()
+        header = cls._HEADER
+        if len(data) < header.size:
+            raise ValueError('%s is not a tree snapshot.' % filename)
+        magic, version, flags, count = header.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError('%s is not a tree snapshot.' % filename)
+        pos = header.size
+        arrays = []
+        typecodes = [_INT64, _INT64, 'I']
+        if flags & cls._HASHED:
+            typecodes.append('I')
+        for typecode in typecodes:
+            end = pos + count * _array.array(typecode).itemsize
+            arrays.append(_array_frombytes(typecode, data[pos:end]))
+            pos = end
+        paths = data[pos:].decode('utf-8', _PATH_ERRORS).split('\0')
+        if not count:
+            paths = []
+        if len(paths) != count or any(len(a) != count for a in arrays):
+            raise ValueError('%s is truncated.' % filename)
+        snapshot = cls()
+        snapshot.paths = paths
+        snapshot.sizes, snapshot.mtimes, snapshot.modes = arrays[:3]
+        if flags & cls._HASHED:
+            snapshot.crcs = arrays[3]
+        return snapshot
+
+    def diff(self, other):
+        """Return a :class:`TreeDiff` of changes from this snapshot to
+        ``other``.
+
+        If both snapshots are hashed, files are changed if their size,
+        mode, or CRC differ, so touched but unmodified files are not
+        reported. Otherwise, files are changed if their size, mode,
+        or modification time differ.
+        """
+        hashed = self.hashed and other.hashed
+        otherindex = other.index()
+        removed = []
+        changed = []
+        for i, path in enumerate(self.paths):
+            j = otherindex.pop(path, None)
+            if j is None:
+                removed.append(path)
+                continue
+            if (self.sizes[i] != other.sizes[j] or
+                    self.modes[i] != other.modes[j]):
+                changed.append(path)
+            elif hashed:
+                if self.crcs[i] != other.crcs[j]:
+                    changed.append(path)
+            elif self.mtimes[i] != other.mtimes[j]:
+                changed.append(path)
+        return TreeDiff(sorted(otherindex), removed, changed)
+
+    def diff_tree(self, directory, include='*', exclude=None,
+                  excludedirs=None, workers=8, cache=None):
+        """Return a :class:`TreeDiff` of changes from this snapshot to
+        the files currently under ``directory``.
+
+        If this snapshot is hashed, only files that are new or whose
+        size or modification time changed are hashed again.
+        """
+        live = type(self).capture(directory, include, exclude, excludedirs)
+        if self.hashed:
+            index = self.index()
+            crcs = _array.array('I', [0] * len(live))
+            tohash = []
+            for j, path in enumerate(live.paths):
+                i = index.get(path)
+                if (i is not None and self.sizes[i] == live.sizes[j] and
+                        self.mtimes[i] == live.mtimes[j]):
+                    crcs[j] = self.crcs[i]
+                else:
+                    tohash.append(j)
+            newcrcs = live._crcs_under(directory, tohash, workers, cache)
+            for j, crc in zip(tohash, newcrcs):
+                crcs[j] = crc
+            live.crcs = crcs
+        return self.diff(live)
+
+
+class FileEvent(_collections.namedtuple('FileEvent', ['kind', 'path'])):
+    """A change reported by :class:`DirectoryWatcher`.
+
+    ``kind`` is one of:
+
+    - ``'added'``: ``path`` was created or moved in.
+    - ``'removed'``: ``path`` was deleted or moved out.
+      A directory moved out is reported as an event for each file in it.
+    - ``'changed'``: ``path``'s contents or metadata changed.
+    - ``'rescan'``: Events were lost (the kernel queue overflowed),
+      and ``path``, the watched directory, should be rescanned.
+    """
+    __slots__ = ()
+
+
+ADDED, REMOVED, CHANGED, RESCAN = 'added', 'removed', 'changed', 'rescan'
+
+# (previous kind, new kind) -> coalesced kind, where None drops the event
+_COALESCE = {
+    (ADDED, CHANGED): ADDED,
+    (ADDED, REMOVED): None,
+    (REMOVED, ADDED): CHANGED,
+    (CHANGED, REMOVED): REMOVED,
+    (CHANGED, ADDED): CHANGED,
+    (REMOVED, CHANGED): CHANGED,
+}
+
+
+def _coalesce(pending, kind, path):
+    """Merge an event for ``path`` into ``pending``,
+    an ordered dict of path to kind."""
+    old = pending.pop(path, None)
+    if old is not None:
+        kind = _COALESCE.get((old, kind), kind)
+    if kind is not None:
+        pending[path] = kind
+
+
+_fsencode = getattr(_os, 'fsencode', lambda p: p)
+_fsdecode = getattr(_os, 'fsdecode', lambda p: p)
+
+
+def _load_libc():
+    if not _sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+    except (ImportError, OSError):  # pragma: no cover
+        return None
+    if not hasattr(libc, 'inotify_init1'):  # pragma: no cover
+        return None
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+class _InotifyBackend(object):
+    """Reports events using Linux's inotify, through ctypes."""
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+            IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+            IN_ONLYDIR)
+    _EVENT = _struct.Struct('iIII')
+
+    libc = None
+
+    @classmethod
+    def is_supported(cls):
+        if cls.libc is None:
+            cls.libc = _load_libc() or False
+        return bool(cls.libc)
+
+    def __init__(self, directory, recursive, excludedirs):
+        if not self.is_supported():
+            raise NotImplementedError('inotify is not available.')
+        self.directory = directory
+        self.recursive = recursive
+        self.excludedirs = excludedirs
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise_errno(directory)
+        self.wds = {}
+        # Directory -> set of file paths in it, when recursive,
+        # so a directory moved out can be reported file by file.
+        self.files = {}
+        try:
+            self._watch_tree(directory)
+        except Exception:
+            self.close()
+            raise
+
+    def _raise_errno(self, path):
+        import ctypes
+        code = ctypes.get_errno()
+        msg = _os.strerror(code)
+        if code == _errno.ENOSPC:
+            msg += ' (raise fs.inotify.max_user_watches)'
+        raise OSError(code, msg, path)
+
+    def _watch(self, path):
+        encoded = path
+        if not isinstance(encoded, bytes):
+            encoded = _fsencode(path)
+        wd = self.libc.inotify_add_watch(self.fd, encoded, self.MASK)
+        if wd < 0:
+            self._raise_errno(path)
+        self.wds[wd] = path
+
+    def _unwatch_tree(self, directory):
+        """Stop watching ``directory`` and everything under it,
+        such as when it is moved out of the tree,
+        and return the files known to be under it."""
+        prefix = _os.path.join(directory, '')
+        for wd, root in list(self.wds.items()):
+            if root == directory or root.startswith(prefix):
+                # The IN_IGNORED event that follows is skipped,
+                # since the wd is no longer known.
+                del self.wds[wd]
+                self.libc.inotify_rm_watch(self.fd, wd)
+        files = []
+        for root in list(self.files):
+            if root == directory or root.startswith(prefix):
+                files.extend(self.files.pop(root))
+        return sorted(files)
+
+    def _watch_tree(self, directory, found=None):
+        """Watch ``directory`` and, if recursive, its subdirectories.
+        If ``found`` is a list, append the files already present,
+        since they may have been created before the watch was added."""
+        stack = [directory]
+        while stack:
+            root = stack.pop()
+            try:
+                self._watch(root)
+            except OSError as ex:
+                if ex.errno in (_errno.ENOENT, _errno.ENOTDIR) and \
+                        root != directory:
+                    continue
+                raise
+            if not self.recursive and found is None:
+                continue
+            files, subdirs = _scan_dir(root, None, None, self.excludedirs)
+            if found is not None:
+                found.extend(f.path for f in files)
+            if self.recursive:
+                self.files[root] = set(f.path for f in files)
+                stack.extend(d.path for d in subdirs)
+
+    def read(self, timeout):
+        """Wait up to ``timeout`` seconds and return a list of
+        ``(kind, path)`` tuples."""
+        try:
+            ready = _select.select([self.fd], [], [], timeout)[0]
+        except (OSError, _select.error):  # pragma: no cover
+            return []
+        if not ready:
+            return []
+        try:
+            data = _os.read(self.fd, 1 << 16)
+        except OSError as ex:  # pragma: no cover
+            if ex.errno == _errno.EAGAIN:
+                return []
+            raise
+        return self._parse(data)
+
+    def _parse(self, data):
+        events = []
+        evsize = self._EVENT.size
+        pos = 0
+        while pos + evsize <= len(data):
+            wd, mask, _, namelen = self._EVENT.unpack_from(data, pos)
+            name = data[pos + evsize:pos + evsize + namelen].rstrip(b'\0')
+            pos += evsize + namelen
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((RESCAN, self.directory))
+                continue
+            root = self.wds.get(wd)
+            if root is None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self.wds[wd]
+                continue
+            if not name:
+                continue
+            path = _os.path.join(root, _fsdecode(name))
+            self._handle(mask, path, events)
+        return events
+
+    def _handle(self, mask, path, events):
+        if mask & self.IN_ISDIR:
+            if not self.recursive:
+                return
+            if (self.excludedirs is not None and
+                    self.excludedirs.match(_os.path.basename(path))):
+                return
+            if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                found = []
+                self._watch_tree(path, found)
+                events.extend((ADDED, f) for f in found)
+            elif mask & self.IN_MOVED_FROM:
+                events.extend((REMOVED, f) for f in self._unwatch_tree(path))
+            elif mask & self.IN_DELETE:
+                self.files.pop(path, None)
+            return
+        if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+            self._files_in(path).add(path)
+            events.append((ADDED, path))
+        elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+            self._files_in(path).discard(path)
+            events.append((REMOVED, path))
+        elif mask & (self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_ATTRIB):
+            events.append((CHANGED, path))
+
+    def _files_in(self, path):
+        if not self.recursive:
+            return set()
+        return self.files.setdefault(_os.path.dirname(path), set())
+
+    def close(self):
+        if self.fd >= 0:
+            _os.close(self.fd)
+            self.fd = -1
+
+
+class _PollingBackend(object):
+    """Reports events by diffing a :class:`TreeSnapshot` of the directory
+    every ``interval`` seconds."""
+
+    def __init__(self, directory, recursive, include, exclude, excludedirs,
+                 interval, stopped):
+        self.directory = directory
+        self.interval = interval
+        self.stopped = stopped
+        self.patterns = (include, exclude, '*' if not recursive else excludedirs)
+        self.snapshot = self._capture()
+        self.nextpoll = _time.time() + interval
+
+    def _capture(self):
+        return TreeSnapshot.capture(self.directory, *self.patterns)
+
+    def read(self, timeout):
+        wait = self.nextpoll - _time.time()
+        if wait > timeout:
+            self.stopped.wait(timeout)
+            return []
+        if wait > 0:
+            self.stopped.wait(wait)
+        self.nextpoll = _time.time() + self.interval
+        snapshot = self._capture()
+        diff = self.snapshot.diff(snapshot)
+        self.snapshot = snapshot
+        join = _os.path.join
+        events = []
+        for kind, paths in ((ADDED, diff.added), (REMOVED, diff.removed),
+                            (CHANGED, diff.changed)):
+            events.extend((kind, join(self.directory, p)) for p in paths)
+        return events
+
+    def close(self):
+        pass
+
+
+class DirectoryWatcher(object):
+    """Watches a directory tree for files being added, removed, or changed,
+    without repeatedly listing it.
+
+    On Linux, uses inotify (through :mod:`ctypes`).
+    Elsewhere, or if ``polling`` is True, diffs a :class:`TreeSnapshot`
+    every ``pollinterval`` seconds.
+
+    Events are coalesced per file (for example, a file created then
+    written is one ``'added'`` event, and a file created then deleted
+    is no event) and debounced: they are delivered once no new events
+    have arrived for ``debounce`` seconds, or at most ``maxlatency``
+    seconds after the first pending event.
+
+    Batches of :class:`FileEvent` are delivered on the watcher's thread,
+    through the :attr:`changed` :class:`brennivin.threadutils.Signal`,
+    and through the :meth:`batches` iterator.
+
+    Call :meth:`start` to start watching, and :meth:`stop` to stop.
+    Can be used as a context manager.
+
+    :param include: Glob pattern, or sequence of patterns,
+      that a file's name must match, like :func:`walk_files`.
+    :param exclude: Patterns of file names to ignore.
+    :param excludedirs: Patterns of directory names to not watch.
+    :param recursive: If False, only watch files directly in ``directory``.
+    """
+
+    def __init__(self, directory, include='*', exclude=None,
+                 excludedirs=None, recursive=True, debounce=0.1,
+                 maxlatency=1.0, polling=False, pollinterval=1.0):
+        self.directory = directory
+        self.recursive = recursive
+        self.debounce = debounce
+        self.maxlatency = maxlatency
+        self.polling = polling or not _InotifyBackend.is_supported()
+        self.pollinterval = pollinterval
+        self._include = _coerce_globs(include)
+        self._exclude = _coerce_globs(exclude)
+        self._excludedirs = _coerce_globs(excludedirs)
+        self._queues = []
+        #: Emitted with a list of :class:`FileEvent` on the watcher thread.
+        self.changed = _threadutils.Signal('list of FileEvent')
+        self._stopped = _threading.Event()
+        self._backend = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def start(self):
+        """Start watching. Changes made after this returns are reported."""
+        if self._thread is not None:
+            raise RuntimeError('Watcher already started.')
+        if self.polling:
+            self._backend = _PollingBackend(
+                self.directory, self.recursive, self._include,
+                self._exclude, self._excludedirs, self.pollinterval,
+                self._stopped)
+        else:
+            self._backend = _InotifyBackend(
+                self.directory, self.recursive, self._excludedirs)
+        self._thread = _threading.Thread(
+            target=self._run, name='DirectoryWatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop watching, delivering any pending events first."""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _wanted(self, path):
+        name = _os.path.basename(path)
+        if self._include is not None and not self._include.match(name):
+            return False
+        if self._exclude is not None and self._exclude.match(name):
+            return False
+        return True
+
+    def _run(self):
+        pending = _collections.OrderedDict()
+        first = last = None
+        try:
+            while not self._stopped.is_set():
+                timeout = 0.25
+                if pending:
+                    now = _time.time()
+                    due = min(last + self.debounce, first + self.maxlatency)
+                    timeout = max(0, min(timeout, due - now))
+                raw = self._backend.read(timeout)
+                now = _time.time()
+                for kind, path in raw:
+                    if kind != RESCAN and not self._wanted(path):
+                        continue
+                    _coalesce(pending, kind, path)
+                    if first is None:
+                        first = now
+                    last = now
+                if pending and (now >= last + self.debounce or
+                                now >= first + self.maxlatency):
+                    self._emit(pending)
+                    pending = _collections.OrderedDict()
+                    first = last = None
+            if pending:
+                self._emit(pending)
+        finally:
+            self._backend.close()
+            for q in list(self._queues):
+                q.put(None)
+
+    def _emit(self, pending):
+        self.changed.emit([FileEvent(kind, path)
+                           for (path, kind) in pending.items()])
+
+    def batches(self):
+        """Return a generator that yields each list of :class:`FileEvent`
+        as it is delivered, until the watcher is stopped.
+        Call before :meth:`start` to not miss any batches."""
+        q = _queue.Queue()
+        self._queues.append(q)
+        self.changed.connect(q.put)
+
+        def gen():
+            try:
+                while True:
+                    batch = q.get()
+                    if batch is None:
+                        return
+                    yield batch
+            finally:
+                self.changed.disconnect(q.put)
+                self._queues.remove(q)
+        return gen()
 
 
 def listdirex(path, pattern='*.*'):
-    """Return absolute filepaths in ``path`` that matches ``pattern``."""
+    """Return absolute filepaths in ``path`` that matches ``pattern``.
+
+    :param pattern: A glob pattern, sequence of patterns,
+      or :class:`GlobSet`.
+    """
+    match = GlobSet.coerce(pattern).match
     return [_os.path.join(path, fn) for fn in _os.listdir(path)
-            if _fnmatch.fnmatch(fn, pattern)]
+            if match(fn)]
 
 
 def makedirs(path, mode=0o777):
@@ -169,6 +1892,100 @@ def path_components(path):
     return parts
 
 
+_NT_SEPS = ('\\', '/')
+_NT_SEPS_RE = _re.compile(r'[\\/]+')
+_NT_ROOT_RE = _re.compile(r'[\\/]*')
+
+
+def path_components_many(paths):
+    """Like :func:`path_components` for each of ``paths``,
+    but splitting each path once rather than once per component.
+
+    :return: List of lists of components, in the same order as ``paths``.
+    """
+    splitdrive = ntpath.splitdrive
+    rootmatch = _NT_ROOT_RE.match
+    split = _NT_SEPS_RE.split
+    result = []
+    for path in paths:
+        # Only drive letters and UNC paths have a drive
+        if path[1:2] == ':' or (path[:1] in _NT_SEPS and
+                                path[1:2] in _NT_SEPS):
+            drive, rest = splitdrive(path)
+        else:
+            drive, rest = '', path
+        rootend = rootmatch(rest).end()
+        root = drive + rest[:rootend]
+        rest = rest[rootend:]
+        parts = split(rest) if rest else []
+        if root:
+            parts.insert(0, root)
+        result.append(parts)
+    return result
+
+
+def split3_many(paths):
+    """Like :func:`split3` for each of ``paths``,
+    parsing each path in a single pass.
+
+    :return: Tuple of three lists, ``(dirnames, names without ext, exts)``,
+      each in the same order as ``paths``.
+    """
+    if _os.path is not _posixpath:
+        triples = [split3(p) for p in paths]
+        if not triples:
+            return [], [], []
+        return tuple(list(t) for t in zip(*triples))
+    dirnames = []
+    names = []
+    exts = []
+    for p in paths:
+        sepidx = p.rfind('/') + 1
+        head = p[:sepidx]
+        if head and head.strip('/'):
+            head = head.rstrip('/')
+        dirnames.append(head)
+        dotidx = p.rfind('.', sepidx)
+        if dotidx > sepidx and p[sepidx:dotidx].strip('.'):
+            names.append(p[sepidx:dotidx])
+            exts.append(p[dotidx:])
+        else:
+            names.append(p[sepidx:])
+            exts.append('')
+    return dirnames, names, exts
+
+
+def purename_many(filenames):
+    """Like :func:`purename` for each of ``filenames``."""
+    if _os.path is not _posixpath:
+        return [purename(f) for f in filenames]
+    result = []
+    append = result.append
+    for f in filenames:
+        sepidx = f.rfind('/') + 1
+        dotidx = f.rfind('.', sepidx)
+        if dotidx > sepidx and f[sepidx:dotidx].strip('.'):
+            append(f[sepidx:dotidx])
+        else:
+            append(f[sepidx:])
+    return result
+
+
+def change_ext_many(paths, ext):
+    """Like :func:`change_ext` for each of ``paths``."""
+    if _os.path is not _posixpath:
+        return [change_ext(p, ext) for p in paths]
+    result = []
+    append = result.append
+    for p in paths:
+        sepidx = p.rfind('/') + 1
+        dotidx = p.rfind('.', sepidx)
+        if dotidx > sepidx and p[sepidx:dotidx].strip('.'):
+            p = p[:dotidx]
+        append(p + ext)
+    return result
+
+
 def purename(filename):
     """Returns the basename of a path without the extension."""
     if filename is None:
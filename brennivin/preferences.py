@@ -13,6 +13,8 @@ import os
 import sys
 import traceback
 
+from . import osutils
+
 
 logger = logging.getLogger(__name__)
 
@@ -95,7 +97,7 @@ class Preferences(object):
 
     def save(self):
         """Save the internal data in a pickle file."""
-        with open(self.filename, 'w' + self.openmode()) as f:
+        with osutils.atomic_write(self.filename, 'w' + self.openmode()) as f:
             self.dumper(self.prefs, f)
 
     def load(self):
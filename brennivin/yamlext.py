@@ -62,6 +62,8 @@ Members
 
 import yaml as _yaml
 
+from . import osutils as _osutils
+
 
 __all__ = ['dumps', 'dumpfile', 'dump', 'loads', 'loadfile', 'load', 'PyIO']
 
@@ -76,7 +78,7 @@ class PyIO(object):
         return self.dump(obj, None, **kwargs)
 
     def dumpfile(self, obj, path, **kwargs):
-        with open(path, 'w') as f:
+        with _osutils.atomic_write(path) as f:
             self.dump(obj, f, **kwargs)
 
     def dump(self, obj, stream, **kwargs):
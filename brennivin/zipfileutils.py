@@ -9,12 +9,54 @@ Members
    ``zipfile.ZipFile`` with a context manager (2.6 does not have a context manager.
    Use if your code needs a ZipFile context manager and must run under 2.6.
 
+Pass ``workers`` to :func:`zip_dir`, :func:`write_dir`, or :func:`write_files`
+to compress files on a thread pool (requires :mod:`concurrent.futures`).
+Pass a ``policy``, such as a :class:`CompressionPolicy`, to choose how
+each file is compressed. :func:`zip_dir` uses :data:`DEFAULT_POLICY`,
+which stores already-compressed files (such as images) without
+compressing them again.
+
+Pass ``incremental=True`` to :func:`zip_dir` to only recompress files that
+changed since the archive was last written.
+
+Use a :class:`DedupWriter` to compress identical files only once,
+optionally reusing compressed data across runs with a :class:`PayloadCache`.
+
+Use :func:`unzip_dir` to extract archives, optionally on a thread pool.
+
+Use a :class:`ZipPathResolver` to quickly map many paths that point
+inside of zip files to their archive and member.
+
+Use a :class:`MappedZipFile` to read members without copying them
+into new strings.
+
+Use :func:`diff_zip_files` to find which members were added, removed,
+or changed between two archives,
+or :func:`compare_zip_files` to just raise if they differ.
+
 """
 
+import collections as _collections
+import hashlib as _hashlib
+import json as _json
+import math as _math
+import mmap as _mmap
 import os as _os
+import shutil as _shutil
+import stat as _stat
+import struct as _struct
+import tempfile as _tempfile
+import threading as _threading
+import time as _time
 import zipfile as _zipfile
+import zlib as _zlib
 from zipfile import ZipFile
 
+try:
+    import concurrent.futures as _futures
+except ImportError:
+    _futures = None
+
 if not hasattr(ZipFile, '__enter__'):
     # Patch for 2.6 ZipFile not being a ctxmgr
     class ZipFile27(ZipFile):
@@ -36,8 +78,494 @@ ALL = dochelpers.pretty_func(lambda _: True, 'ALL')
 NONE = dochelpers.pretty_func(lambda _: False, 'NONE')
 
 
+# Size of reads when compressing a file.
+_CHUNKSIZE = 1024 * 64
+# Flag bit for a data descriptor following the member's data.
+_FLAG_DATA_DESCRIPTOR = 0x08
+# Flag bit set by zipfile for lzma members (data includes an EOS marker).
+_FLAG_LZMA_EOS = 0x02
+# Local file header signature and size.
+_LOCAL_HEADER_SIG = b'PK\x03\x04'
+_LOCAL_HEADER_SIZE = 30
+
+
+class CompressionPolicy(object):
+    """Callable that chooses the compression type and level for a file.
+    Calling it with a path returns ``(compress_type, compresslevel)``.
+
+    Files with an extension in ``storedexts`` are stored.
+    Other files have their first ``samplesize`` bytes sampled,
+    and are stored if the sample's entropy is above ``maxentropy``
+    bits per byte, since they would barely shrink.
+    Everything else uses ``compress_type`` and ``compresslevel``.
+
+    :param compress_type: Compression for compressible files,
+      such as ``zipfile.ZIP_DEFLATED``, ``ZIP_BZIP2``, or ``ZIP_LZMA``.
+    :param compresslevel: Level for ``compress_type``, or None for default.
+    :param storedexts: Lowercase extensions (with the dot)
+      of files to always store.
+    :param maxentropy: Sampled entropy above which files are stored.
+      If None, do not sample files.
+    :param samplesize: Number of bytes to sample.
+    :param overrides: Dict of lowercase extension to
+      ``(compress_type, compresslevel)`` that takes precedence
+      over everything else.
+    """
+
+    STORED_EXTS = frozenset([
+        '.7z', '.aac', '.avi', '.bz2', '.docx', '.flac', '.gif', '.gz',
+        '.jar', '.jpeg', '.jpg', '.lz4', '.lzma', '.m4a', '.mkv', '.mov',
+        '.mp3', '.mp4', '.ogg', '.png', '.pptx', '.rar', '.tgz', '.webm',
+        '.webp', '.whl', '.xlsx', '.xz', '.zip', '.zst'])
+
+    def __init__(self, compress_type=_zipfile.ZIP_DEFLATED, compresslevel=None,
+                 storedexts=STORED_EXTS, maxentropy=7.5, samplesize=4096,
+                 overrides=None):
+        self.compress_type = compress_type
+        self.compresslevel = compresslevel
+        self.storedexts = storedexts
+        self.maxentropy = maxentropy
+        self.samplesize = samplesize
+        self.overrides = overrides or {}
+
+    def __repr__(self):
+        return 'CompressionPolicy(%s, %s)' % (
+            self.compress_type, self.compresslevel)
+
+    def __call__(self, path):
+        ext = _os.path.splitext(path)[1].lower()
+        if ext in self.overrides:
+            return self.overrides[ext]
+        if ext in self.storedexts:
+            return _zipfile.ZIP_STORED, None
+        if self.maxentropy is not None:
+            with open(path, 'rb') as f:
+                sample = f.read(self.samplesize)
+            if sample_entropy(sample) > self.maxentropy:
+                return _zipfile.ZIP_STORED, None
+        return self.compress_type, self.compresslevel
+
+
+def sample_entropy(data):
+    """Return the Shannon entropy of ``data`` in bits per byte,
+    from 0 (all bytes the same) to 8 (uniformly random)."""
+    if not data:
+        return 0
+    counts = _collections.Counter(bytearray(data))
+    total = float(len(data))
+    return -sum(c / total * _math.log(c / total, 2)
+                for c in counts.values())
+
+
+DEFAULT_POLICY = CompressionPolicy()
+
+
+def _as_filter(func):
+    """Return ``func`` if it is callable,
+    otherwise a :class:`brennivin.osutils.GlobSet` of the patterns in it."""
+    if callable(func):
+        return func
+    return osutils.GlobSet(func)
+
+
+def _iter_members(fullpaths, include, exclude, subdir, rootpath):
+    """Yield ``(path, arcname)`` for each path to be written to an archive."""
+    include = _as_filter(include)
+    exclude = _as_filter(exclude)
+    for path in fullpaths:
+        if include(path) and not exclude(path):
+            arcname = None
+            if rootpath:
+                arcname = _os.path.relpath(path, rootpath)
+                if subdir:
+                    arcname = _os.path.join(subdir, arcname)
+            yield path, arcname
+
+
+def _zipinfo_from_file(path, arcname):
+    """Return a ZipInfo for ``path`` the same way ``ZipFile.write`` does."""
+    if hasattr(_zipfile.ZipInfo, 'from_file'):
+        return _zipfile.ZipInfo.from_file(path, arcname)
+    st = _os.stat(path)
+    if arcname is None:
+        arcname = path
+    arcname = _os.path.normpath(_os.path.splitdrive(arcname)[1])
+    while arcname[0] in (_os.sep, _os.altsep):
+        arcname = arcname[1:]
+    zinfo = _zipfile.ZipInfo(arcname, _time.localtime(st.st_mtime)[0:6])
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    zinfo.file_size = st.st_size
+    return zinfo
+
+
+def _get_compressor(compress_type, compresslevel=None):
+    """Return a compressor like zipfile uses for ``compress_type``,
+    or None for stored members."""
+    getcompressor = getattr(_zipfile, '_get_compressor', None)
+    if getcompressor is not None:
+        return getcompressor(compress_type, compresslevel)
+    if compress_type == _zipfile.ZIP_DEFLATED:
+        if compresslevel is None:
+            compresslevel = _zlib.Z_DEFAULT_COMPRESSION
+        return _zlib.compressobj(compresslevel, _zlib.DEFLATED, -15)
+    if compress_type == _zipfile.ZIP_STORED:
+        return None
+    raise NotImplementedError(
+        'Compression type %s not supported.' % compress_type)
+
+
+def _compress_file(path, arcname, compress_type, compresslevel, spoolsize,
+                   policy=None):
+    """Compress the file at ``path`` into a spooled temporary file.
+    If ``policy`` is given, it chooses the compression type and level.
+
+    :return: Tuple of ``(zinfo, fileobj, size)``.
+      ``zinfo`` has its CRC and compressed size filled in,
+      and its ``file_size`` from stat (see :func:`_write_compressed`).
+      ``fileobj`` holds the compressed data and is positioned at its start;
+      the caller must close it.
+      ``size`` is the number of bytes actually read.
+    """
+    if policy is not None:
+        compress_type, compresslevel = policy(path)
+    zinfo = _zipinfo_from_file(path, arcname)
+    zinfo.compress_type = compress_type
+    compressor = _get_compressor(compress_type, compresslevel)
+    out = _tempfile.SpooledTemporaryFile(spoolsize)
+    crc = 0
+    size = 0
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(_CHUNKSIZE)
+                if not chunk:
+                    break
+                crc = _zlib.crc32(chunk, crc)
+                size += len(chunk)
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                out.write(chunk)
+        if compressor:
+            out.write(compressor.flush())
+    except Exception:
+        out.close()
+        raise
+    zinfo.CRC = crc & 0xffffffff
+    zinfo.compress_size = out.tell()
+    out.seek(0)
+    return zinfo, out, size
+
+
+def _data_offset(fp, zinfo):
+    """Return the offset of ``zinfo``'s compressed data in the archive
+    file ``fp``, by reading its local file header."""
+    fp.seek(zinfo.header_offset)
+    return _parse_local_header(fp.read(_LOCAL_HEADER_SIZE), zinfo)
+
+
+def _parse_local_header(header, zinfo):
+    """Return the offset of ``zinfo``'s compressed data given the
+    bytes of its local file header."""
+    if len(header) != _LOCAL_HEADER_SIZE or header[:4] != _LOCAL_HEADER_SIG:
+        raise _zipfile.BadZipfile(
+            'Bad local file header for %s' % zinfo.filename)
+    namelen, extralen = _struct.unpack('<HH', header[26:30])
+    return zinfo.header_offset + _LOCAL_HEADER_SIZE + namelen + extralen
+
+
+def _write_compressed(zfile, zinfo, fileobj, file_size=None):
+    """Write a member whose data is already compressed to ``zfile``.
+    The local header written is the same as ``ZipFile.write``
+    would write for the same data.
+
+    :param zinfo: ZipInfo with ``CRC``, ``file_size``, ``compress_size``,
+      and ``compress_type`` set.
+    :param fileobj: File-like object positioned at the start of
+      ``zinfo.compress_size`` bytes of compressed data.
+    :param file_size: Actual uncompressed size, if ``zinfo.file_size``
+      is only an estimate used for choosing zip64 headers.
+    :type zfile: zipfile.ZipFile
+    """
+    if getattr(zfile, '_writing', False):
+        raise ValueError("Can't write to the ZIP file while there is "
+                         "another write handle open on it.")
+    zinfo.flag_bits &= ~_FLAG_DATA_DESCRIPTOR
+    if zinfo.compress_type == getattr(_zipfile, 'ZIP_LZMA', None):
+        zinfo.flag_bits |= _FLAG_LZMA_EOS
+    if not zinfo.external_attr:
+        zinfo.external_attr = 0o600 << 16
+    zip64 = (zinfo.file_size * 1.05 > _zipfile.ZIP64_LIMIT or
+             zinfo.compress_size > _zipfile.ZIP64_LIMIT)
+    if file_size is not None:
+        zinfo.file_size = file_size
+    if zip64 and not getattr(zfile, '_allowZip64', True):
+        raise _zipfile.LargeZipFile('Filesize would require ZIP64 extensions')
+    start_dir = getattr(zfile, 'start_dir', None)
+    if start_dir is not None:
+        zfile.fp.seek(start_dir)
+    zinfo.header_offset = zfile.fp.tell()
+    zfile._writecheck(zinfo)
+    zfile._didModify = True
+    zfile.fp.write(zinfo.FileHeader(zip64))
+    remaining = zinfo.compress_size
+    while remaining:
+        chunk = fileobj.read(min(remaining, _CHUNKSIZE))
+        if not chunk:
+            raise EOFError('Compressed data for %s is truncated.'
+                           % zinfo.filename)
+        zfile.fp.write(chunk)
+        remaining -= len(chunk)
+    if start_dir is not None:
+        zfile.start_dir = zfile.fp.tell()
+    zfile.filelist.append(zinfo)
+    zfile.NameToInfo[zinfo.filename] = zinfo
+
+
+def _copy_member(srczfile, srcinfo, zfile):
+    """Copy the compressed bytes of member ``srcinfo`` in ``srczfile``
+    to ``zfile`` without recompressing them."""
+    zinfo = _zipfile.ZipInfo(srcinfo.filename, srcinfo.date_time)
+    for attr in ('compress_type', 'comment', 'create_system',
+                 'external_attr', 'CRC', 'file_size', 'compress_size'):
+        setattr(zinfo, attr, getattr(srcinfo, attr))
+    srczfile.fp.seek(_data_offset(srczfile.fp, srcinfo))
+    _write_compressed(zfile, zinfo, srczfile.fp)
+
+
+def _find_reusable(reusefrom, zinfo, compress_type, path, checkcrc):
+    """Return the member of ``reusefrom`` that can be copied verbatim
+    in place of compressing the file described by ``zinfo``, or None."""
+    old = reusefrom.NameToInfo.get(zinfo.filename)
+    if old is None:
+        return None
+    # Zip timestamps have 2 second resolution.
+    if (old.compress_type != compress_type or
+            old.file_size != zinfo.file_size or
+            old.external_attr != zinfo.external_attr or
+            old.date_time[:5] != zinfo.date_time[:5] or
+            old.date_time[5] // 2 != zinfo.date_time[5] // 2):
+        return None
+    if checkcrc and old.CRC != osutils.crc_from_filename(path):
+        return None
+    return old
+
+
+def _write_members_parallel(members, zfile, workers, spoolsize, reusefrom,
+                            checkcrc, policy):
+    """Compress ``(path, arcname)`` members on a thread pool
+    and write them to ``zfile`` in order.
+    At most ``workers * 2`` compressed members are pending at once,
+    each holding at most ``spoolsize`` bytes in memory
+    (larger results spill to disk).
+    Members found in ``reusefrom`` are copied in order on this thread."""
+    if _futures is None:
+        raise NotImplementedError(
+            'concurrent.futures is required for parallel zipping.')
+    compress_type = zfile.compression
+    compresslevel = getattr(zfile, 'compresslevel', None)
+    pending = _collections.deque()
+
+    def writenext():
+        item = pending.popleft()
+        if isinstance(item, _zipfile.ZipInfo):
+            _copy_member(reusefrom, item, zfile)
+            return
+        zinfo, fileobj, size = item.result()
+        try:
+            _write_compressed(zfile, zinfo, fileobj, size)
+        finally:
+            fileobj.close()
+
+    with _futures.ThreadPoolExecutor(workers) as pool:
+        try:
+            for path, arcname in members:
+                old = None
+                if reusefrom is not None:
+                    old = _find_reusable(
+                        reusefrom, _zipinfo_from_file(path, arcname),
+                        policy(path)[0] if policy else compress_type,
+                        path, checkcrc)
+                if old is not None:
+                    pending.append(old)
+                else:
+                    pending.append(pool.submit(
+                        _compress_file, path, arcname,
+                        compress_type, compresslevel, spoolsize, policy))
+                if len(pending) >= workers * 2:
+                    writenext()
+            while pending:
+                writenext()
+        finally:
+            futures = [f for f in pending if not isinstance(
+                f, _zipfile.ZipInfo)]
+            for future in futures:
+                future.cancel()
+            for future in futures:
+                if not future.cancelled() and future.exception() is None:
+                    future.result()[1].close()
+
+
+class _RegionReader(object):
+    """File-like object that reads from ``fp`` starting at ``offset``,
+    and puts ``fp``'s position back after each read,
+    so data can be copied from one part of a file to its end."""
+    def __init__(self, fp, offset):
+        self.fp = fp
+        self.offset = offset
+
+    def read(self, size):
+        pos = self.fp.tell()
+        self.fp.seek(self.offset)
+        data = self.fp.read(size)
+        self.offset += len(data)
+        self.fp.seek(pos)
+        return data
+
+
+class PayloadCache(object):
+    """Persistent cache of compressed payloads on disk, keyed by
+    a hash of their uncompressed content (see :class:`DedupWriter`).
+    Entries are written atomically,
+    so a cache directory can be shared between processes.
+
+    :param cachedir: Directory to store payloads in.
+      Created if it does not exist.
+    """
+
+    _HEADER = _struct.Struct('<IQQ')
+
+    def __init__(self, cachedir):
+        self.cachedir = osutils.makedirs(cachedir)
+
+    def _path(self, key):
+        return _os.path.join(self.cachedir, key[:2], key)
+
+    def get(self, key):
+        """Return ``(crc, file_size, compress_size, fileobj)`` for ``key``,
+        where ``fileobj`` is positioned at the start of the compressed data
+        and must be closed by the caller.
+        Return None if ``key`` is not cached."""
+        try:
+            f = open(self._path(key), 'rb')
+        except (IOError, OSError):
+            return None
+        header = f.read(self._HEADER.size)
+        if len(header) != self._HEADER.size:
+            f.close()
+            return None
+        crc, file_size, compress_size = self._HEADER.unpack(header)
+        return crc, file_size, compress_size, f
+
+    def put(self, key, crc, file_size, compress_size, fileobj):
+        """Store ``compress_size`` bytes of compressed data read from
+        ``fileobj`` under ``key``."""
+        path = self._path(key)
+        osutils.makedirs(_os.path.dirname(path))
+        with osutils.atomic_write(path, 'wb', fsync=False) as f:
+            f.write(self._HEADER.pack(crc, file_size, compress_size))
+            _shutil.copyfileobj(fileobj, f, _CHUNKSIZE)
+
+
+class DedupWriter(object):
+    """Writes files to a zip stream,
+    compressing each distinct file content only once.
+
+    Files are hashed before being compressed.
+    When a file has the same content as one already written to the archive,
+    the already-compressed data is copied under a new local header
+    (zip readers require every member to have its own local header,
+    so this saves compression time rather than archive size).
+    Duplicates are recorded in :attr:`duplicates`,
+    and can be written into the archive with :meth:`write_manifest`.
+
+    :param zfile: :class:`ZipFile` opened for writing.
+      Under Python 2 it is write-only, so duplicates are compressed again.
+    :param cache: Optional :class:`PayloadCache` used to look up and store
+      compressed data across archives and runs.
+    :param hashname: Name of the :mod:`hashlib` algorithm to hash files with.
+    :param spoolsize: Compressed data larger than this many bytes
+      is buffered on disk rather than in memory.
+    """
+
+    MANIFEST_NAME = 'dedup_manifest.json'
+
+    def __init__(self, zfile, cache=None, hashname='sha1', spoolsize=1 << 24):
+        self.zfile = zfile
+        self.cache = cache
+        self.hashname = hashname
+        self.spoolsize = spoolsize
+        #: Maps the name of each duplicate member to the name of the first
+        #: member with the same content.
+        self.duplicates = {}
+        self._written = {}
+
+    def _key(self, path, compress_type, compresslevel):
+        hasher = _hashlib.new(self.hashname)
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(_CHUNKSIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+        return '%s-%s-%s-%s' % (
+            hasher.hexdigest(), self.hashname, compress_type, compresslevel)
+
+    def _copy_written(self, first, zinfo):
+        fp = self.zfile.fp
+        pos = fp.tell()
+        try:
+            offset = _data_offset(fp, first)
+        except (IOError, OSError, ValueError):
+            # File isn't readable.
+            return False
+        finally:
+            fp.seek(pos)
+        for attr in ('compress_type', 'CRC', 'compress_size'):
+            setattr(zinfo, attr, getattr(first, attr))
+        zinfo.file_size = first.file_size
+        _write_compressed(self.zfile, zinfo, _RegionReader(fp, offset))
+        return True
+
+    def write(self, path, arcname=None, compress_type=None,
+              compresslevel=None):
+        """Write the file at ``path`` to the archive,
+        like ``ZipFile.write``."""
+        if compress_type is None:
+            compress_type = self.zfile.compression
+        if compresslevel is None:
+            compresslevel = getattr(self.zfile, 'compresslevel', None)
+        key = self._key(path, compress_type, compresslevel)
+        zinfo = _zipinfo_from_file(path, arcname)
+        first = self._written.get(key)
+        if first is not None and self._copy_written(first, zinfo):
+            self.duplicates[zinfo.filename] = first.filename
+            return
+        cached = self.cache and self.cache.get(key)
+        if cached:
+            zinfo.CRC, size, zinfo.compress_size, fileobj = cached
+            zinfo.compress_type = compress_type
+        else:
+            zinfo, fileobj, size = _compress_file(
+                path, arcname, compress_type, compresslevel, self.spoolsize)
+        try:
+            if not cached and self.cache:
+                self.cache.put(
+                    key, zinfo.CRC, size, zinfo.compress_size, fileobj)
+                fileobj.seek(0)
+            _write_compressed(self.zfile, zinfo, fileobj, size)
+        finally:
+            fileobj.close()
+        self._written.setdefault(key, zinfo)
+
+    def write_manifest(self, name=MANIFEST_NAME):
+        """Write :attr:`duplicates` to the archive as a json member."""
+        self.zfile.writestr(
+            name, _json.dumps(self.duplicates, indent=2, sort_keys=True))
+
+
 def write_files(fullpaths, zfile, include=ALL, exclude=NONE,
-                subdir=None, rootpath=None):
+                subdir=None, rootpath=None, workers=1, spoolsize=1 << 24,
+                reusefrom=None, checkcrc=False, dedupe=None, policy=None):
     """
     Zip files to a zip stream.
     See :func:`zip_dir` for arguments.
@@ -50,45 +578,206 @@ def write_files(fullpaths, zfile, include=ALL, exclude=NONE,
       Ie, passing in a branch's root and the absolute paths to files in the
       branch would make the paths in the archive be relative
       to the branch root.
+    :param reusefrom: A :class:`ZipFile` opened for reading,
+      usually an older version of the archive being written.
+      Members in it with the same name, size, mode, and modification time
+      as a file being written have their compressed bytes copied
+      instead of compressing the file again.
+    :param checkcrc: If True, also read files to make sure their CRCs match
+      before reusing members from ``reusefrom``.
+    :param dedupe: A :class:`DedupWriter` for ``zfile``,
+      used to write files that are not reused from ``reusefrom``.
+      Cannot be used with ``workers``.
+    :param policy: Callable that takes a file path and returns
+      ``(compress_type, compresslevel)`` for it,
+      such as a :class:`CompressionPolicy`.
+      If None, use ``zfile``'s compression.
     :type zfile: zipfile.ZipFile
     """
-    for path in fullpaths:
-        if include(path) and not exclude(path):
-            arcname = None
-            if rootpath:
-                arcname = _os.path.relpath(path, rootpath)
-                if subdir:
-                    arcname = _os.path.join(subdir, arcname)
-            zfile.write(path, arcname)
+    members = _iter_members(fullpaths, include, exclude, subdir, rootpath)
+    if dedupe is not None and workers > 1:
+        raise ValueError('dedupe cannot be used with more than 1 worker.')
+    if workers > 1:
+        _write_members_parallel(
+            members, zfile, workers, spoolsize, reusefrom, checkcrc, policy)
+        return
+    compress_type, compresslevel = None, None
+    for path, arcname in members:
+        if policy is not None:
+            compress_type, compresslevel = policy(path)
+        if reusefrom is not None:
+            old = _find_reusable(
+                reusefrom, _zipinfo_from_file(path, arcname),
+                zfile.compression if compress_type is None else compress_type,
+                path, checkcrc)
+            if old is not None:
+                _copy_member(reusefrom, old, zfile)
+                continue
+        if dedupe is not None:
+            dedupe.write(path, arcname, compress_type, compresslevel)
+        elif compresslevel is not None:
+            zfile.write(path, arcname, compress_type, compresslevel)
+        else:
+            zfile.write(path, arcname, compress_type)
 
 
-def write_dir(rootpath, zfile, include=ALL, exclude=NONE, subdir=None):
+def write_dir(rootpath, zfile, include=ALL, exclude=NONE, subdir=None,
+              workers=1, spoolsize=1 << 24, reusefrom=None, checkcrc=False,
+              dedupe=None, policy=None):
     """
     Zip all files under ``rootpath`` to a zip stream.
-    See :func:`zip_dir` for arguments.
+    See :func:`zip_dir` and :func:`write_files` for arguments.
 
     :type zfile: zipfile.ZipFile
     """
     write_files(
-        osutils.iter_files(rootpath), zfile, include, exclude, subdir, rootpath)
+        osutils.iter_files(rootpath), zfile, include, exclude, subdir, rootpath,
+        workers, spoolsize, reusefrom, checkcrc, dedupe, policy)
 
 
-def zip_dir(rootdir, outfile, include=ALL, exclude=NONE, subdir=None):
+def zip_dir(rootdir, outfile, include=ALL, exclude=NONE, subdir=None,
+            workers=1, spoolsize=1 << 24, incremental=False, checkcrc=False,
+            policy=DEFAULT_POLICY):
     """Zip all files under the root directory to a zip file at ``outfile``.
 
     :param outfile: Path to zipfile, or :class:`ZipFile` stream.
     :param include: Include only files that this function returns True for.
+      May also be a glob pattern or sequence of patterns,
+      which are compiled into a :class:`brennivin.osutils.GlobSet`
+      and matched against the full path.
     :param exclude: Include no files that this function returns True for.
+      May also be patterns, like ``include``.
     :param subdir: If provided, nest the ``rootdir`` under this folder in
       the archive. For example, zipping the directory ``spam`` with the files
       ``/spam/eggs/ham.txt`` and ``subdir`` of ``foo``
       would yield the archive file ``foo/eggs/ham.txt``.
+    :param workers: If greater than 1, compress this many files at once
+      on a thread pool. Members are still written in order,
+      and the archive is identical to one written serially.
+    :param spoolsize: When compressing in parallel,
+      compressed data larger than this many bytes is buffered on disk
+      rather than in memory.
+    :param incremental: If True and ``outfile`` exists,
+      copy the compressed bytes of members that have not changed
+      (see ``reusefrom`` in :func:`write_files`)
+      and only compress new or changed files.
+      The new archive is written next to ``outfile`` and then moved over it.
+    :param checkcrc: See :func:`write_files`.
+    :param policy: See :func:`write_files`.
+      By default, files that are already compressed are stored.
     """
     outdir = _os.path.dirname(outfile)
     if not _os.path.exists(outdir):
         _os.makedirs(outdir)
-    with ZipFile(outfile, 'w', _zipfile.ZIP_DEFLATED) as zfile:
-        write_dir(rootdir, zfile, include, exclude, subdir)
+    if not (incremental and _os.path.isfile(outfile)):
+        with ZipFile(outfile, 'w', _zipfile.ZIP_DEFLATED) as zfile:
+            write_dir(rootdir, zfile, include, exclude, subdir,
+                      workers, spoolsize, policy=policy)
+        return
+    with osutils.atomic_write(outfile, 'wb', fsync=False) as f:
+        with ZipFile(outfile) as oldzfile:
+            with ZipFile(f, 'w', _zipfile.ZIP_DEFLATED) as zfile:
+                write_dir(rootdir, zfile, include, exclude, subdir,
+                          workers, spoolsize, oldzfile, checkcrc,
+                          policy=policy)
+
+
+def _member_target(outdir, name):
+    """Return the path member ``name`` extracts to under ``outdir``,
+    sanitized the same way as ``ZipFile.extract``."""
+    arcname = name.replace('/', _os.sep)
+    if _os.altsep:
+        arcname = arcname.replace(_os.altsep, _os.sep)
+    arcname = _os.path.splitdrive(arcname)[1]
+    invalid = ('', _os.curdir, _os.pardir)
+    arcname = _os.sep.join(x for x in arcname.split(_os.sep)
+                           if x not in invalid)
+    return _os.path.join(outdir, arcname)
+
+
+def _extract_to(zfile, zinfo, target):
+    with zfile.open(zinfo) as source:
+        with open(target, 'wb') as dest:
+            _shutil.copyfileobj(source, dest, _CHUNKSIZE)
+
+
+def unzip_dir(zippath, outdir, include=ALL, exclude=NONE, workers=1):
+    """Extract the files in the zip file at ``zippath`` into ``outdir``.
+    Member names are sanitized like ``ZipFile.extractall`` does.
+
+    All directories are created up front in one pass,
+    then files are extracted,
+    on a thread pool if ``workers`` is greater than 1
+    (each thread reads through its own handle to the archive).
+
+    :param include: Extract only files whose destination path
+      this function returns True for.
+      May also be glob patterns, like :func:`zip_dir`.
+    :param exclude: Extract no files whose destination path
+      this function returns True for.
+    :param workers: Number of threads to extract with.
+    :return: List of paths to the extracted files.
+    """
+    include = _as_filter(include)
+    exclude = _as_filter(exclude)
+    with ZipFile(zippath) as zfile:
+        infos = zfile.infolist()
+    dirs = set()
+    tasks = []
+    for zinfo in infos:
+        target = _member_target(outdir, zinfo.filename)
+        if zinfo.filename.endswith('/'):
+            dirs.add(target)
+        elif include(target) and not exclude(target):
+            dirs.add(_os.path.dirname(target))
+            tasks.append((zinfo, target))
+    for d in sorted(dirs):
+        osutils.makedirs(d)
+
+    if workers <= 1 or _futures is None:
+        with ZipFile(zippath) as zfile:
+            for zinfo, target in tasks:
+                _extract_to(zfile, zinfo, target)
+        return [target for _, target in tasks]
+
+    local = _threading.local()
+    opened = []
+    lock = _threading.Lock()
+
+    def extract(task):
+        zfile = getattr(local, 'zfile', None)
+        if zfile is None:
+            zfile = local.zfile = ZipFile(zippath)
+            with lock:
+                opened.append(zfile)
+        _extract_to(zfile, task[0], task[1])
+
+    try:
+        with _futures.ThreadPoolExecutor(workers) as pool:
+            # Biggest first, so one large member doesn't finish last.
+            bysize = sorted(tasks, key=lambda t: t[0].compress_size,
+                            reverse=True)
+            for _ in pool.map(extract, bysize):
+                pass
+    finally:
+        for zfile in opened:
+            zfile.close()
+    return [target for _, target in tasks]
+
+
+def _implicit_dirs(names):
+    """Return the set of directory names (ending in ``/``)
+    that are prefixes of ``names``."""
+    dirs = set()
+    for name in names:
+        end = name.rfind('/', 0, len(name) - 1)
+        while end > 0:
+            dirname = name[:end + 1]
+            if dirname in dirs:
+                break
+            dirs.add(dirname)
+            end = name.rfind('/', 0, end)
+    return dirs
 
 
 def is_inside_zipfile(filepath):
@@ -110,28 +799,487 @@ def is_inside_zipfile(filepath):
     return is_zip
 
 
-def _sorted_infolist(zippath):
-    return sorted(_zipfile.ZipFile(zippath).infolist(),
-                  key = lambda zi: zi.filename)
+class ZipPathResolver(object):
+    """Maps paths like ``/root/archive.zip/dir/file.txt`` to the archive
+    and member they refer to.
+    This is much faster than :func:`is_inside_zipfile` when resolving
+    many paths, because results are cached:
+
+    - Each archive's central directory is read once and its member
+      names are kept in a dict. The index is rebuilt if the
+      archive's modification time or size changes.
+    - Known archives are found by looking up each parent of a path in
+      the cache, before touching the filesystem, so a path inside an
+      indexed archive needs at most one ``stat`` call (to check the
+      archive has not changed), and none within ``checkinterval``.
+    - Directories are remembered so they are not checked again.
+    - If ``checkinterval`` is not 0, up to ``maxmissing`` paths that do
+      not exist are remembered for ``checkinterval`` seconds,
+      forgetting the oldest first.
+
+    :param checkinterval: Seconds to wait before checking whether
+      an indexed archive has changed, or a missing path has appeared,
+      again. If 0, check on every lookup.
+    :param maxmissing: Number of missing paths to remember.
+    """
+
+    _DIRECTORY = 'directory'
+    _NOTZIP = 'notzip'
+
+    def __init__(self, checkinterval=0, maxmissing=10000,
+                 _gettime=_time.time):
+        self.checkinterval = checkinterval
+        self.maxmissing = maxmissing
+        self._gettime = _gettime
+        # Path -> _DIRECTORY,
+        # or [(mtime, size), lastchecked, _NOTZIP or {name: ZipInfo}, dirs]
+        self._entries = {}
+        # Path -> lastchecked, oldest first.
+        self._missing = _collections.OrderedDict()
+        self._lock = _threading.Lock()
+
+    def _stat_entry(self, path):
+        """Return the cache entry for ``path``,
+        or None if it does not exist."""
+        try:
+            st = _os.stat(path)
+        except OSError:
+            return None
+        if _stat.S_ISDIR(st.st_mode):
+            return self._DIRECTORY
+        key = st.st_mtime, st.st_size
+        index = self._NOTZIP
+        dirs = None
+        if _zipfile.is_zipfile(path):
+            try:
+                with ZipFile(path) as zfile:
+                    index = dict(zfile.NameToInfo)
+            except _zipfile.BadZipfile:
+                pass
+            else:
+                dirs = _implicit_dirs(index)
+        return [key, self._gettime(), index, dirs]
+
+    def _entry(self, path):
+        """Return the cache entry for an existing ``path``,
+        refreshing it if needed, or None if it does not exist."""
+        entry = self._entries.get(path)
+        if entry is self._DIRECTORY:
+            return entry
+        now = self._gettime()
+        if entry is not None:
+            if now - entry[1] < self.checkinterval:
+                return entry
+            try:
+                st = _os.stat(path)
+                stillvalid = (st.st_mtime, st.st_size) == entry[0]
+            except OSError:
+                stillvalid = False
+            if stillvalid:
+                entry[1] = now
+                return entry
+        else:
+            lastchecked = self._missing.get(path)
+            if (lastchecked is not None and
+                    now - lastchecked < self.checkinterval):
+                return None
+        entry = self._stat_entry(path)
+        with self._lock:
+            if entry is not None:
+                self._entries[path] = entry
+                self._missing.pop(path, None)
+                return entry
+            self._entries.pop(path, None)
+            if self.checkinterval:
+                self._missing.pop(path, None)
+                self._missing[path] = now
+                while len(self._missing) > self.maxmissing:
+                    self._missing.popitem(last=False)
+        return None
+
+    def _found(self, folders, parts, i, entry):
+        if entry[2] is self._NOTZIP:
+            return None
+        membername = '/'.join(reversed(parts[:i + 1]))
+        return folders[i], entry[2], entry[3], membername
+
+    def _find(self, filepath):
+        """Return ``(archivepath, index, dirs, membername)`` for the archive
+        ``filepath`` is inside of, or None."""
+        folders = []
+        parts = []
+        folderpath, filename = _os.path.split(_os.path.normpath(filepath))
+        while folderpath and filename:
+            folders.append(folderpath)
+            parts.append(filename)
+            folderpath, filename = _os.path.split(folderpath)
+        # Look for a known archive or file using only the cache.
+        for i, folder in enumerate(folders):
+            entry = self._entries.get(folder)
+            if entry is self._DIRECTORY:
+                break
+            if entry is None:
+                continue
+            entry = self._entry(folder)
+            if entry is not None and entry is not self._DIRECTORY:
+                return self._found(folders, parts, i, entry)
+            break
+        # Walk up until something exists, same as is_inside_zipfile.
+        for i, folder in enumerate(folders):
+            entry = self._entry(folder)
+            if entry is None:
+                continue
+            if entry is self._DIRECTORY:
+                return None
+            return self._found(folders, parts, i, entry)
+        return None
+
+    def is_inside_zipfile(self, filepath):
+        """Same as the :func:`is_inside_zipfile` function,
+        but cached."""
+        return self._find(filepath) is not None
+
+    def resolve(self, filepath):
+        """Return ``(archivepath, membername)`` for the member
+        ``filepath`` points to, or None if ``filepath``
+        is not inside a zip file or the member does not exist.
+        If ``filepath`` points to a directory in an archive,
+        ``membername`` ends in a ``/``.
+        Directories without their own entry in the archive,
+        which only exist as prefixes of member names, are included.
+        """
+        found = self._find(filepath)
+        if found is None:
+            return None
+        archivepath, index, dirs, membername = found
+        if membername in index:
+            return archivepath, membername
+        dirname = membername + '/'
+        if dirname in index or dirname in dirs:
+            return archivepath, dirname
+        return None
+
+    def getinfo(self, filepath):
+        """Return the :class:`zipfile.ZipInfo` of the member
+        ``filepath`` points to, or None (see :meth:`resolve`).
+        Also None for directories without their own entry."""
+        found = self._find(filepath)
+        if found is None:
+            return None
+        archivepath, index, dirs, membername = found
+        return index.get(membername) or index.get(membername + '/')
+
+    def invalidate(self, path=None):
+        """Forget cached information about ``path``,
+        or everything if ``path`` is None."""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                self._missing.clear()
+            else:
+                path = _os.path.normpath(path)
+                self._entries.pop(path, None)
+                self._missing.pop(path, None)
+
+
+class MappedZipFile(object):
+    """Reads members of a zip file through a read-only memory map
+    of the archive.
+
+    Members stored without compression can be read as
+    :class:`memoryview` slices of the map, without copying them.
+    Compressed members are decompressed in bounded chunks.
+
+    Memoryviews returned from this object must be released
+    (or garbage collected) before calling :meth:`close`,
+    or :meth:`close` will raise a ``BufferError``.
+
+    Requires Python 3, since Python 2 cannot take a memoryview of an mmap.
+
+    :param path: Path to the zip file.
+    :raise NotImplementedError: On Python 2.
+    """
+
+    def __init__(self, path):
+        if not hasattr(memoryview, 'release'):
+            raise NotImplementedError(
+                'MappedZipFile requires Python 3 memoryviews.')
+        self.path = path
+        with ZipFile(path) as zfile:
+            self._infos = dict(zfile.NameToInfo)
+        self._file = open(path, 'rb')
+        try:
+            self._map = _mmap.mmap(
+                self._file.fileno(), 0, access=_mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        self._view = memoryview(self._map)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """Unmap and close the archive."""
+        if self._map is None:
+            return
+        self._view.release()
+        self._map.close()
+        self._map = None
+        self._file.close()
+
+    def namelist(self):
+        return list(self._infos)
+
+    def getinfo(self, name):
+        """Return the :class:`zipfile.ZipInfo` for member ``name``.
+
+        :raise KeyError: If there is no such member.
+        """
+        return self._infos[name]
+
+    def _raw_range(self, name):
+        """Return ``(zinfo, start, end)`` of the compressed data of
+        member ``name`` in the map."""
+        zinfo = self.getinfo(name)
+        if zinfo.flag_bits & 0x01:
+            raise NotImplementedError(
+                '%s is encrypted, which is not supported.' % name)
+        start = zinfo.header_offset
+        start = _parse_local_header(
+            self._map[start:start + _LOCAL_HEADER_SIZE], zinfo)
+        return zinfo, start, start + zinfo.compress_size
+
+    def read_view(self, name):
+        """Return a memoryview of the data of stored (uncompressed)
+        member ``name``, without copying it.
+        The CRC is not checked.
+
+        :raise ValueError: If the member is compressed.
+        """
+        zinfo, start, end = self._raw_range(name)
+        if zinfo.compress_type != _zipfile.ZIP_STORED:
+            raise ValueError('%s is compressed, use iter_chunks or read.'
+                             % name)
+        return self._view[start:end]
+
+    def iter_chunks(self, name, chunksize=_CHUNKSIZE):
+        """Yield the data of member ``name`` in chunks.
+        Stored members yield memoryviews of up to ``chunksize`` bytes.
+        Deflated members yield decompressed strings of up to ``chunksize``
+        bytes, and their CRC is checked when the last chunk is read.
+        Other compression types are streamed through :mod:`zipfile`.
+
+        No views of the map are held between chunks,
+        so the archive can be closed before the generator is finished.
+        """
+        zinfo, start, end = self._raw_range(name)
+        if zinfo.compress_type == _zipfile.ZIP_STORED:
+            for pos in range(start, end, chunksize):
+                yield self._view[pos:min(pos + chunksize, end)]
+            return
+        if zinfo.compress_type != _zipfile.ZIP_DEFLATED:
+            with ZipFile(self._file) as zfile:
+                with zfile.open(zinfo) as f:
+                    while True:
+                        chunk = f.read(chunksize)
+                        if not chunk:
+                            return
+                        yield chunk
+        decompressor = _zlib.decompressobj(-15)
+        crc = 0
+        pos = start
+        pending = b''
+        while True:
+            if not pending:
+                if pos >= end:
+                    break
+                # Slicing the mmap copies at most chunksize bytes.
+                pending = self._map[pos:min(pos + chunksize, end)]
+                pos += len(pending)
+            chunk = decompressor.decompress(pending, chunksize)
+            pending = decompressor.unconsumed_tail
+            if chunk:
+                crc = _zlib.crc32(chunk, crc)
+                yield chunk
+        chunk = decompressor.flush()
+        if chunk:
+            crc = _zlib.crc32(chunk, crc)
+            yield chunk
+        if crc & 0xffffffff != zinfo.CRC:
+            raise _zipfile.BadZipfile('Bad CRC-32 for file %r' % name)
+
+    def read(self, name):
+        """Return the data of member ``name``.
+        Returns a memoryview (see :meth:`read_view`) for stored members,
+        and decompressed bytes for others."""
+        if self.getinfo(name).compress_type == _zipfile.ZIP_STORED:
+            return self.read_view(name)
+        return b''.join(self.iter_chunks(name))
+
+
+def _sorted_infolist(zfile):
+    return sorted(zfile.infolist(), key=lambda zi: zi.filename)
+
+
+class ZipDiff(_collections.namedtuple(
+        'ZipDiff', ['added', 'removed', 'changed'])):
+    """Result of :func:`diff_zip_files`.
+    Each field is a sorted list of member names:
+
+    - ``added``: Members only in the second archive.
+    - ``removed``: Members only in the first archive.
+    - ``changed``: Members in both archives whose size, CRC,
+      or (if checked) content differ.
+
+    Evaluates to False if there are no differences.
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+    __nonzero__ = __bool__
+
+
+def _merge_join(infos1, infos2):
+    """Yield ``(info1, info2)`` for sorted infolists,
+    where either is None if the name is only in the other list."""
+    i = j = 0
+    len1, len2 = len(infos1), len(infos2)
+    while i < len1 or j < len2:
+        if j == len2:
+            yield infos1[i], None
+            i += 1
+        elif i == len1:
+            yield None, infos2[j]
+            j += 1
+        else:
+            name1, name2 = infos1[i].filename, infos2[j].filename
+            if name1 == name2:
+                yield infos1[i], infos2[j]
+                i += 1
+                j += 1
+            elif name1 < name2:
+                yield infos1[i], None
+                i += 1
+            else:
+                yield None, infos2[j]
+                j += 1
+
+
+def _members_equal(zfile1, zfile2, name):
+    """Return True if member ``name`` decompresses to the same bytes
+    in both archives, reading both in chunks."""
+    with zfile1.open(name) as f1:
+        with zfile2.open(name) as f2:
+            while True:
+                chunk1 = f1.read(_CHUNKSIZE)
+                chunk2 = f2.read(_CHUNKSIZE)
+                if chunk1 != chunk2:
+                    return False
+                if not chunk1:
+                    return True
+
+
+def _find_content_changes(z1, z2, names, workers):
+    """Return the members in ``names`` whose content differs
+    between the archives at ``z1`` and ``z2``.
+    Each worker thread reads through its own pair of file handles."""
+    if workers <= 1 or _futures is None:
+        with ZipFile(z1) as zfile1:
+            with ZipFile(z2) as zfile2:
+                return [n for n in names
+                        if not _members_equal(zfile1, zfile2, n)]
+    local = _threading.local()
+    opened = []
+    lock = _threading.Lock()
+
+    def ischanged(name):
+        handles = getattr(local, 'handles', None)
+        if handles is None:
+            handles = local.handles = ZipFile(z1), ZipFile(z2)
+            with lock:
+                opened.extend(handles)
+        return not _members_equal(handles[0], handles[1], name)
+
+    try:
+        with _futures.ThreadPoolExecutor(workers) as pool:
+            changed = pool.map(ischanged, names)
+            return [n for n, c in zip(names, changed) if c]
+    finally:
+        for zfile in opened:
+            zfile.close()
+
+
+def diff_zip_files(z1, z2, checkcontent=False, workers=1):
+    """Compares the contents of two zip files by joining their
+    sorted central directories.
+    Members are changed if their sizes or CRCs differ.
+
+    :param z1: Path to the first zip file.
+    :param z2: Path to the second zip file.
+    :param checkcontent: If True, also decompress members that look the same
+      and compare their bytes.
+    :param workers: Number of threads to compare content on.
+    :rtype: ZipDiff
+    """
+    with ZipFile(z1) as zfile1:
+        infos1 = _sorted_infolist(zfile1)
+    with ZipFile(z2) as zfile2:
+        infos2 = _sorted_infolist(zfile2)
+    added, removed, changed, same = [], [], [], []
+    for info1, info2 in _merge_join(infos1, infos2):
+        if info1 is None:
+            added.append(info2.filename)
+        elif info2 is None:
+            removed.append(info1.filename)
+        elif (info1.CRC != info2.CRC or
+              info1.file_size != info2.file_size):
+            changed.append(info1.filename)
+        else:
+            same.append(info1.filename)
+    if checkcontent and same:
+        changed.extend(_find_content_changes(z1, z2, same, workers))
+        changed.sort()
+    return ZipDiff(added, removed, changed)
+
+
+def _format_names(infos, maxnames=20):
+    names = repr([zi.filename for zi in infos[:maxnames]])
+    if len(infos) > maxnames:
+        names = '%s, ... %s more]' % (names[:-1], len(infos) - maxnames)
+    return names
 
 
 def compare_zip_files(z1, z2):
     """Compares the contents of two zip files
-    (file paths and crcs).
+    (file paths, sizes, and crcs),
+    stopping at the first difference.
+    Use :func:`diff_zip_files` to find all differences.
 
     :return: None if they are the same.
     :raise FileComparisonError: If the files are different.
       Message contains a string summarizing the difference.
     """
-
-    f1infos = _sorted_infolist(z1)
-    f2infos = _sorted_infolist(z2)
-    f1names = [f.filename for f in f1infos]
-    f2names = [f.filename for f in f2infos]
-    if f1names != f2names:
-        raise FileComparisonError(
-            'File lists differ: %s, %s' % (f1names, f2names))
+    with ZipFile(z1) as zfile1:
+        f1infos = _sorted_infolist(zfile1)
+    with ZipFile(z2) as zfile2:
+        f2infos = _sorted_infolist(zfile2)
+    samenames = len(f1infos) == len(f2infos)
+    if samenames:
+        for f1i, f2i in zip(f1infos, f2infos):
+            if f1i.filename != f2i.filename:
+                samenames = False
+                break
+    if not samenames:
+        raise FileComparisonError('File lists differ: %s, %s' % (
+            _format_names(f1infos), _format_names(f2infos)))
 
     for f1i, f2i in zip(f1infos, f2infos):
         if f1i.CRC != f2i.CRC:
             raise FileComparisonError('%s CRCs different.' % f1i.filename)
+        if f1i.file_size != f2i.file_size:
+            raise FileComparisonError('%s sizes different.' % f1i.filename)
@@ -1,9 +1,10 @@
 import mock
+import os
 import socket
 import time
 import unittest
 
-from brennivin import ioutils, testhelpers
+from brennivin import ioutils, osutils, testhelpers
 
 
 class TestRetry(unittest.TestCase):
@@ -63,6 +64,25 @@ class TestRetry(unittest.TestCase):
         self.assertRaises(FloatingPointError, wrapped)
         self.assertEqual([1, 1], res)
 
+    def testExcFilterBaseException(self):
+        """Test that exceptions not derived from Exception are retried
+        if they are in excFilter, and propagated otherwise."""
+        res = []
+
+        @ioutils.retry(excfilter=(KeyboardInterrupt,), attempts=3)
+        def wrapped():
+            res.append(1)
+            raise KeyboardInterrupt
+        self.assertRaises(KeyboardInterrupt, wrapped)
+        self.assertEqual([1, 1, 1], res)
+
+        @ioutils.retry(attempts=3)
+        def wrapped2():
+            res.append(2)
+            raise KeyboardInterrupt
+        self.assertRaises(KeyboardInterrupt, wrapped2)
+        self.assertEqual([1, 1, 1, 2], res)
+
     def testReturnsWrapped(self):
         """Test that the decorator returns the value from the wrapped
         function."""
@@ -161,6 +181,123 @@ class TestTimeout(unittest.TestCase):
         self.assertEqual(5, wrapped())
 
 
+class RecordingObserver(ioutils.CallObserver):
+    def __init__(self):
+        self.calls = []
+
+    def attempt_started(self, func, attempt, elapsed):
+        self.calls.append(('start', attempt, elapsed))
+
+    def attempt_failed(self, func, attempt, exc, elapsed):
+        self.calls.append(('fail', attempt, elapsed))
+
+    def sleeping(self, func, attempt, delay, elapsed):
+        self.calls.append(('sleep', attempt, delay, elapsed))
+
+    def succeeded(self, func, attempt, elapsed):
+        self.calls.append(('success', attempt, elapsed))
+
+    def timed_out(self, func, elapsed):
+        self.calls.append(('timeout', elapsed))
+
+
+class TestObservers(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(testhelpers.patch_time().__enter__().__exit__)
+
+    def testRetryCallbacks(self):
+        obs = RecordingObserver()
+        attempts = [0]
+
+        @ioutils.retry(3, wait=1, backoff=2, observer=obs)
+        def wrapped():
+            attempts[0] += 1
+            if attempts[0] < 3:
+                raise SystemError
+            return 5
+        self.assertEqual(wrapped(), 5)
+        self.assertEqual(obs.calls, [
+            ('start', 1, 0), ('fail', 1, 0), ('sleep', 1, 1, 0),
+            ('start', 2, 1), ('fail', 2, 1), ('sleep', 2, 2, 1),
+            ('start', 3, 3), ('success', 3, 3)])
+
+    def testRetryFinalFailure(self):
+        obs = RecordingObserver()
+
+        @ioutils.retry(2, observer=obs)
+        def wrapped():
+            raise SystemError
+        self.assertRaises(SystemError, wrapped)
+        self.assertEqual(obs.calls, [
+            ('start', 1, 0), ('fail', 1, 0), ('start', 2, 0), ('fail', 2, 0)])
+
+    def testRetryAttemptsResetPerCall(self):
+        res = []
+
+        @ioutils.retry(2)
+        def wrapped():
+            res.append(0)
+            raise SystemError
+        self.assertRaises(SystemError, wrapped)
+        self.assertRaises(SystemError, wrapped)
+        self.assertEqual(len(res), 4)
+
+    def testTimeoutCallbacks(self):
+        obs = RecordingObserver()
+
+        @ioutils.timeout(.01, observer=obs)
+        def wrapped():
+            return 5
+        self.assertEqual(wrapped(), 5)
+        self.assertEqual(obs.calls, [('start', 1, 0), ('success', 1, 0)])
+
+    def testTimeoutTimedOut(self):
+        obs = RecordingObserver()
+
+        @ioutils.timeout(.01, observer=obs)
+        def wrapped():
+            pass
+        with mock.patch('threading.Thread.start'):
+            with mock.patch('threading.Thread.join'):
+                self.assertRaises(ioutils.Timeout, wrapped)
+        self.assertEqual(obs.calls, [('start', 1, 0), ('timeout', 0)])
+
+    def testCallStats(self):
+        stats = ioutils.CallStats()
+
+        @ioutils.retry(3, wait=.5, observer=stats)
+        def flaky():
+            if len(stats.get(name) or {}) and stats.get(name)['failures'] < 2:
+                raise SystemError
+            return 1
+        name = '%s.flaky' % __name__
+        flaky()
+        self.assertEqual(stats.names(), [name])
+        got = stats.get(name)
+        self.assertEqual(got['attempts'], 3)
+        self.assertEqual(got['failures'], 2)
+        self.assertEqual(got['sleeps'], 2)
+        self.assertEqual(got['successes'], 1)
+        self.assertEqual(got['sleeptime'], 1)
+        self.assertEqual(got['success_latency'].count, 1)
+        self.assertEqual(got['success_latency'].mean(), 1)
+        stats.reset()
+        self.assertIsNone(stats.get(name))
+
+
+class TestHistogram(unittest.TestCase):
+    def testBuckets(self):
+        h = ioutils.Histogram((1, 10))
+        for v in (0, 1, 5, 10, 11):
+            h.add(v)
+        self.assertEqual(h.counts, [2, 2, 1])
+        self.assertEqual(h.mean(), 27 / 5.0)
+
+    def testEmptyMean(self):
+        self.assertEqual(ioutils.Histogram().mean(), 0)
+
+
 class TestIsLocalPortOpen(unittest.TestCase):
     def testIsIt(self):
         found = None
@@ -178,3 +315,86 @@ class TestIsLocalPortOpen(unittest.TestCase):
         finally:
             sock.close()
         self.assertTrue(ioutils.is_local_port_open(found))
+
+
+class TestPortAllocator(unittest.TestCase):
+
+    def setUp(self):
+        self.lockfilename = osutils.mktemp()
+        self.addCleanup(os.remove, self.lockfilename)
+        self.alloc = ioutils.PortAllocator(lockfilename=self.lockfilename)
+        self.addCleanup(self.alloc.close)
+
+    def testReservesUniquePortsInRange(self):
+        ports = self.alloc.reserve(20)
+        self.assertEqual(len(set(ports)), 20)
+        self.assertEqual(sorted(ports), self.alloc.reserved())
+        first, last = ioutils.EPHEMERAL_PORT_RANGE
+        for port in ports:
+            self.assertTrue(first <= port <= last)
+            self.assertFalse(ioutils.is_local_port_open(port))
+
+    def testHandoffFreesPortAndRecordsIt(self):
+        port = self.alloc.reserve()[0]
+        self.assertEqual(self.alloc.handoff(port), port)
+        self.assertTrue(ioutils.is_local_port_open(port))
+        self.assertEqual(self.alloc.reserved(), [])
+        other = ioutils.PortAllocator(lockfilename=self.lockfilename)
+        self.addCleanup(other.close)
+        with open(self.lockfilename) as f:
+            self.assertIn(port, other._read_registry(f))
+
+    def testExpiredHandoffsAreForgotten(self):
+        alloc = ioutils.PortAllocator(
+            lockfilename=self.lockfilename, holdsecs=0)
+        port = alloc.reserve()[0]
+        alloc.handoff(port)
+        with open(self.lockfilename) as f:
+            self.assertEqual(alloc._read_registry(f), {})
+
+    def testSocketTransfersOwnership(self):
+        port = self.alloc.reserve()[0]
+        sock = self.alloc.socket(port)
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.getsockname()[1], port)
+        self.assertEqual(self.alloc.reserved(), [])
+
+    def testRaisesIfRangeExhausted(self):
+        port = self.alloc.reserve()[0]
+        alloc = ioutils.PortAllocator(
+            (port, port), lockfilename=self.lockfilename)
+        self.assertRaises(OSError, alloc.reserve)
+
+    def testCloseReleases(self):
+        ports = self.alloc.reserve(3)
+        self.alloc.close()
+        for port in ports:
+            self.assertTrue(ioutils.is_local_port_open(port))
+
+    def testInvalidRange(self):
+        self.assertRaises(ValueError, ioutils.PortAllocator, (10, 1))
+
+    @unittest.skipUnless(hasattr(os, 'getuid'), 'Requires os.getuid.')
+    def testDefaultLockFileIsPerUser(self):
+        self.assertEqual(
+            os.path.basename(ioutils.PortAllocator.DEFAULT_LOCKFILENAME),
+            'brennivin_ports.%s.lock' % os.getuid())
+
+    @unittest.skipUnless(os.name == 'posix', 'Requires posix permissions.')
+    def testLockFileIsPrivate(self):
+        os.remove(self.lockfilename)
+        self.alloc.reserve()
+        mode = os.stat(self.lockfilename).st_mode & 0o777
+        self.assertEqual(mode & ~0o600, 0)
+
+    @unittest.skipUnless(hasattr(os, 'O_NOFOLLOW'), 'Requires O_NOFOLLOW.')
+    def testDoesNotFollowSymlinks(self):
+        link = self.lockfilename + '.link'
+        os.symlink(self.lockfilename, link)
+        self.addCleanup(os.remove, link)
+        with open(self.lockfilename, 'w') as f:
+            f.write('precious')
+        alloc = ioutils.PortAllocator(lockfilename=link)
+        self.assertRaises(OSError, alloc.reserve)
+        with open(self.lockfilename) as f:
+            self.assertEqual(f.read(), 'precious')
@@ -1,8 +1,14 @@
+import gzip
 import logging
 import os
+import re
+import shutil
 import tempfile
+import threading
 import unittest
 
+import mock
+
 from brennivin import itertoolsext, osutils, logutils
 
 
@@ -29,6 +35,108 @@ class TestMultiLineIndentFormatter(unittest.TestCase):
         ideal = 'loggername Line one\n           Line two sits directly beneath line one'
         self.assertEqual(s, ideal)
 
+    def testMessageWithArgsAndRepeats(self):
+        """Test that the header is found from the format string,
+        not by searching for the message."""
+        fmtr = logutils.MultiLineIndentFormatter('%(levelname)s: %(message)s')
+        rec = logging.LogRecord('WARNING', 30, 'f.py', 1, 'WARNING %s\n%s',
+                                ('a', 'b'), None)
+        self.assertEqual(fmtr.format(rec), 'WARNING: WARNING a\n         b')
+
+    def testSingleLineUnchanged(self):
+        fmtr = logutils.MultiLineIndentFormatter('%(name)s %(message)s')
+        self.assertEqual(fmtr.format(self.createRecord('one line')),
+                         'loggername one line')
+
+    def testIndentsTraceback(self):
+        fmtr = logutils.MultiLineIndentFormatter('%(name)s %(message)s')
+        rec = self.createRecord('msg')
+        rec.exc_text = 'Traceback\nError'
+        self.assertEqual(fmtr.format(rec),
+                         'loggername msg\n           Traceback\n           Error')
+
+
+class TestAsyncHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.logger = logging.getLogger('test_asynchandler_%s' % id(self))
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def addHandler(self, handler):
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+        self.addCleanup(handler.close)
+        return handler
+
+    def testWritesBatchesToFile(self):
+        path = os.path.join(self.tempd, 'a.log')
+        target = logging.FileHandler(path)
+        target.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        target.setLevel(logging.INFO)
+        handler = self.addHandler(logutils.AsyncHandler(
+            target, batchsize=10, flushinterval=0.01))
+        with mock.patch.object(target, 'flush',
+                               side_effect=target.flush) as flush:
+            for i in range(25):
+                self.logger.info('line %s', i)
+            self.logger.debug('filtered out')
+            handler.flush()
+        self.assertLess(flush.call_count, 25)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines, ['INFO line %s' % i for i in range(25)])
+
+    def testFormatsOnCallingThread(self):
+        target = logging.Handler()
+        target.handle = mock.Mock()
+        handler = self.addHandler(logutils.AsyncHandler(target))
+        other = self.addHandler(logging.Handler())
+        other.handle = mock.Mock()
+        arg = ['before']
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            self.logger.exception('arg: %s', arg)
+        arg[0] = 'after'
+        handler.flush()
+        record = target.handle.call_args[0][0]
+        self.assertEqual(record.msg, "arg: ['before']")
+        original = other.handle.call_args[0][0]
+        self.assertIsNot(original, record)
+        self.assertIsNotNone(original.exc_info)
+        self.assertEqual(original.args, (arg,))
+        self.assertIsNone(record.exc_info)
+        self.assertIn('ZeroDivisionError', record.exc_text)
+
+    def testDropsWhenFull(self):
+        release = threading.Event()
+        target = logging.Handler()
+        target.handle = mock.Mock(side_effect=lambda r: release.wait(5))
+        handler = self.addHandler(logutils.AsyncHandler(
+            target, maxqueue=2, batchsize=1, flushinterval=0))
+        for i in range(10):
+            self.logger.info('msg')
+        release.set()
+        handler.flush()
+        self.assertGreater(handler.dropped, 0)
+        self.assertEqual(target.handle.call_count + handler.dropped, 10)
+
+    def testCloseWritesPendingAndClosesTarget(self):
+        target = logging.Handler()
+        target.handle = mock.Mock()
+        target.close = mock.Mock()
+        handler = logutils.AsyncHandler(target, flushinterval=10)
+        self.logger.addHandler(handler)
+        self.logger.info('msg')
+        self.logger.removeHandler(handler)
+        handler.close()
+        self.assertEqual(target.handle.call_count, 1)
+        target.close.assert_called_once_with()
+        handler.flush()  # Does not block once closed
+
 
 class TestGetTimestampedFilename(unittest.TestCase):
 
@@ -48,6 +156,111 @@ class TestGetTimestampedFilename(unittest.TestCase):
         self.assertEqual(ideal, got)
 
 
+class TestTimestampedRotatingFileHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.now = 1000.0
+
+    def makeHandler(self, **kwargs):
+        kwargs.setdefault('_getpid', lambda: 42)
+        kwargs.setdefault('_clock', lambda: self.now)
+        handler = logutils.TimestampedRotatingFileHandler(
+            self.tempd, 'app', **kwargs)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.addCleanup(handler.close)
+        return handler
+
+    def log(self, handler, msg):
+        handler.handle(logging.LogRecord(
+            'name', logging.INFO, 'f.py', 1, msg, None, None))
+
+    def readAll(self):
+        """Return all lines written, oldest file first."""
+        names = sorted(os.listdir(self.tempd), key=lambda n: os.path.getmtime(
+            os.path.join(self.tempd, n)))
+        lines = []
+        for name in names:
+            path = os.path.join(self.tempd, name)
+            opener = gzip.open if name.endswith('.gz') else open
+            with opener(path, 'rb') as f:
+                lines.extend(f.read().decode().splitlines())
+        return names, lines
+
+    def testNaming(self):
+        handler = self.makeHandler()
+        name = os.path.basename(handler.baseFilename)
+        self.assertTrue(re.match(r'app_[\d-]+_pid42\.log$', name), name)
+
+    def testRollsOverBySizeAndCompresses(self):
+        handler = self.makeHandler(maxbytes=10)
+        for i in range(6):
+            self.log(handler, 'message %s' % i)
+            os.utime(handler.baseFilename, (i, i))
+        handler.wait()
+        names, lines = self.readAll()
+        self.assertEqual(lines, ['message %s' % i for i in range(6)])
+        self.assertEqual(len(names), 6)
+        self.assertEqual(len([n for n in names if n.endswith('.log.gz')]), 5)
+        self.assertIn(os.path.basename(handler.baseFilename), names)
+
+    def testRollsOverByTime(self):
+        handler = self.makeHandler(interval=60, compress=False)
+        first = handler.baseFilename
+        self.log(handler, 'a')
+        self.now += 59
+        self.log(handler, 'b')
+        self.assertEqual(handler.baseFilename, first)
+        self.now += 1
+        self.log(handler, 'c')
+        self.assertNotEqual(handler.baseFilename, first)
+        handler.close()
+        with open(first) as f:
+            self.assertEqual(f.read().split(), ['a', 'b'])
+
+    def testRetentionByCountAndBytes(self):
+        handler = self.makeHandler(maxbytes=1, backupcount=2, compress=False)
+        for i in range(5):
+            self.log(handler, 'm%s' % i)
+            os.utime(handler.baseFilename, (i, i))
+        handler.wait()
+        self.assertEqual(self.readAll()[1], ['m2', 'm3', 'm4'])
+
+        handler.backupcount = None
+        handler.maxtotalbytes = 4
+        handler.prune()
+        self.assertEqual(self.readAll()[1], ['m3', 'm4'])
+
+    def testOtherFilesAreIgnored(self):
+        other = os.path.join(self.tempd, 'other_2010_pid1.log')
+        with open(other, 'w') as f:
+            f.write('x')
+        handler = self.makeHandler(maxbytes=1, backupcount=0)
+        self.log(handler, 'a')
+        self.log(handler, 'b')
+        handler.wait()
+        self.assertEqual(sorted(os.listdir(self.tempd)), sorted(
+            ['other_2010_pid1.log', os.path.basename(handler.baseFilename)]))
+
+
+    def testOtherProcessesLiveFilesAreKept(self):
+        for compress in (True, False):
+            live = os.path.join(self.tempd, 'app_2010_pid999.log')
+            with open(live, 'w') as f:
+                f.write('x')
+            os.utime(live, (0, 0))
+            handler = self.makeHandler(
+                maxbytes=1, backupcount=0, compress=compress)
+            self.log(handler, 'a')
+            self.log(handler, 'b')
+            handler.close()
+            self.assertEqual(sorted(os.listdir(self.tempd)), sorted(
+                ['app_2010_pid999.log',
+                 os.path.basename(handler.baseFilename)]))
+            os.remove(handler.baseFilename)
+
+
 class TestGetFilenamesFromLoggers(unittest.TestCase):
     def createMockLogger(self, handlerFilename=None):
         logger = itertoolsext.Bundle()
@@ -175,6 +388,12 @@ class TestRemoveFiles(unittest.TestCase):
         logutils.remove_old_files(self.root, '*spam*')
         self.assertRootContents([f1, f3])
 
+    def testAcceptsGlobSet(self):
+        f1, f2, f3 = self.mk('.log'), self.mk('.txt'), self.mk('.dmp')
+        logutils.remove_old_files(
+            self.root, osutils.GlobSet(['*.log', '*.dmp']), maxfiles=0)
+        self.assertRootContents([f2])
+
     def testErrorOnRemoveIsSwallowedAndCorrectFilesAreLeft(self):
         """Tests that if have 4 files, and remove 2 files, but one of
         those files cannot be removed, we are left with 3 files total."""
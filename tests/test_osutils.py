@@ -1,12 +1,30 @@
+import array
+import errno
+import fnmatch
+import hashlib
 import inspect
+import ntpath
 import os
 from os.path import join
 import shutil
 import stat
+import struct
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import unittest
+import zlib
 
-from brennivin import osutils
+try:
+    import concurrent.futures as futures
+except ImportError:  # pragma: no cover
+    futures = None
+
+import mock
+
+from brennivin import osutils, testhelpers
 
 ROOT = '/'
 if os.name == 'nt':
@@ -34,6 +52,160 @@ class TestAbsPathEx(unittest.TestCase):
         self.assertRaises(ArithmeticError, osutils.abspathex, 'path.py', ROOT, True)
         self.assertEqual(cwd, os.getcwd())
 
+    def testDoesNotChangeCwd(self):
+        with mock.patch('os.chdir') as chdir:
+            result = osutils.abspathex(join('..', 'foo', '.', 'bar'), ROOT)
+        self.assertFalse(chdir.called)
+        self.assertEqual(
+            result, os.path.join(os.path.dirname(ROOT), 'foo', 'bar'))
+
+    def testAbsolutePathWins(self):
+        abspath = os.path.abspath(os.sep + join('spam', 'eggs'))
+        self.assertEqual(osutils.abspathex(abspath, ROOT), abspath)
+
+    def testNotADirectoryRaises(self):
+        self.assertRaises(OSError, osutils.abspathex, 'foo', __file__)
+
+    def testNtDriveSemantics(self):
+        def absnt(path):
+            return osutils.abspathex(path, 'C:\\base\\dir', pathmod=ntpath)
+        self.assertEqual(absnt('foo/bar'), 'C:\\base\\dir\\foo\\bar')
+        self.assertEqual(absnt('..\\foo'), 'C:\\base\\foo')
+        self.assertEqual(absnt('\\foo'), 'C:\\foo')
+        self.assertEqual(absnt('C:foo'), 'C:\\base\\dir\\foo')
+        self.assertEqual(absnt('D:\\foo\\.\\bar'), 'D:\\foo\\bar')
+        self.assertRaises(ValueError, absnt, 'D:foo')
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'Requires os.symlink.')
+    def testResolvesSymlinks(self):
+        tempd = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, tempd)
+        target = join(tempd, 'a', 'b')
+        os.makedirs(target)
+        link = join(tempd, 'link')
+        os.symlink(target, link)
+        self.assertEqual(osutils.abspathex(join('..', 'foo'), link),
+                         join(tempd, 'a', 'foo'))
+        self.assertEqual(osutils.abspathex_many(['foo'], link),
+                         [join(target, 'foo')])
+
+    def testMany(self):
+        paths = ['foo', join('foo', '..', 'bar'), ROOT]
+        self.assertEqual(osutils.abspathex_many(paths, ROOT),
+                         [osutils.abspathex(p, ROOT) for p in paths])
+        self.assertRaises(OSError, osutils.abspathex_many, paths, 'foo')
+
+
+class AtomicWriteTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.filename = join(self.tempd, 'target.txt')
+        with open(self.filename, 'w') as f:
+            f.write('old')
+        os.chmod(self.filename, 0o640)
+
+    def read(self):
+        with open(self.filename) as f:
+            return f.read()
+
+    def testReplacesAndSyncs(self):
+        with mock.patch.object(osutils, '_fsync_dir') as fsyncdir:
+            with osutils.atomic_write(self.filename) as f:
+                f.write('new')
+                self.assertEqual(self.read(), 'old')
+        self.assertEqual(self.read(), 'new')
+        fsyncdir.assert_called_once_with(self.tempd)
+        self.assertEqual(stat.S_IMODE(os.stat(self.filename).st_mode), 0o640)
+        self.assertEqual(os.listdir(self.tempd), ['target.txt'])
+
+    def testNewFileBinary(self):
+        path = join(self.tempd, 'new.bin')
+        with osutils.atomic_write(path, 'wb', fsync=False) as f:
+            f.write(b'\x00\x01')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'\x00\x01')
+
+    def testErrorLeavesTargetUntouched(self):
+        def write():
+            with osutils.atomic_write(self.filename) as f:
+                f.write('new')
+                raise ZeroDivisionError
+        self.assertRaises(ZeroDivisionError, write)
+        self.assertEqual(self.read(), 'old')
+        self.assertEqual(os.listdir(self.tempd), ['target.txt'])
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'Requires os.symlink.')
+    def testWritesThroughSymlink(self):
+        link = join(self.tempd, 'link.txt')
+        os.symlink(self.filename, link)
+        with osutils.atomic_write(link) as f:
+            f.write('new')
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(self.read(), 'new')
+        self.assertEqual(sorted(os.listdir(self.tempd)),
+                         ['link.txt', 'target.txt'])
+
+    def testBadModeRaises(self):
+        def write(mode):
+            with osutils.atomic_write(self.filename, mode):
+                pass
+        self.assertRaises(ValueError, write, 'a')
+        self.assertRaises(ValueError, write, 'w+')
+
+
+class GroupCommitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.now = [0]
+        self.group = osutils.GroupCommit(
+            maxpending=3, maxdelay=10, clock=lambda: self.now[0])
+
+    def write(self, name, data):
+        path = join(self.tempd, name)
+        with osutils.atomic_write(path, group=self.group) as f:
+            f.write(data)
+        return path
+
+    def read(self, name):
+        with open(join(self.tempd, name)) as f:
+            return f.read()
+
+    def testCommitsInBatches(self):
+        with mock.patch.object(osutils, '_fsync_dir') as fsyncdir:
+            self.write('a', '1')
+            self.write('b', '2')
+            self.assertFalse(os.path.exists(join(self.tempd, 'a')))
+            self.assertEqual(len(self.group), 2)
+            self.write('c', '3')
+            self.assertEqual(len(self.group), 0)
+        self.assertEqual([self.read(n) for n in 'abc'], ['1', '2', '3'])
+        fsyncdir.assert_called_once_with(self.tempd)
+
+    def testCommitsAfterDelay(self):
+        self.write('a', '1')
+        self.now[0] = 10
+        self.write('b', '2')
+        self.assertEqual(len(self.group), 0)
+        self.assertEqual(self.read('b'), '2')
+
+    def testSameTargetKeepsLatest(self):
+        with self.group:
+            self.write('a', '1')
+            self.write('a', '2')
+            self.assertEqual(len(self.group), 1)
+        self.assertEqual(self.read('a'), '2')
+        self.assertEqual(os.listdir(self.tempd), ['a'])
+
+    def testDiscard(self):
+        self.write('a', '1')
+        self.group.discard()
+        self.assertEqual(os.listdir(self.tempd), [])
+        self.assertEqual(self.group.commit(), [])
+
 
 class ChangeCwdTests(unittest.TestCase):
     def setUp(self):
@@ -93,6 +265,64 @@ class TestChangeEnviron(unittest.TestCase):
                 pass
 
 
+class ContextEnvironTests(unittest.TestCase):
+
+    def testOverlayDoesNotChangeEnviron(self):
+        os.environ['TESTVALUE'] = 'ABC'
+        self.addCleanup(os.environ.pop, 'TESTVALUE')
+        with osutils.context_environ('TESTVALUE', 'XYZ'):
+            with osutils.context_environ('TESTNEW', 'new'):
+                env = osutils.get_context_environ()
+                self.assertEqual(env['TESTVALUE'], 'XYZ')
+                self.assertEqual(env['TESTNEW'], 'new')
+            with osutils.context_environ('TESTVALUE', None):
+                self.assertNotIn('TESTVALUE', osutils.get_context_environ())
+            self.assertEqual(os.environ['TESTVALUE'], 'ABC')
+            self.assertNotIn('TESTNEW', osutils.get_context_environ())
+        self.assertEqual(osutils.get_context_environ()['TESTVALUE'], 'ABC')
+
+    @unittest.skipIf(futures is None, 'concurrent.futures not available.')
+    def testThreadsAreIsolated(self):
+        barrier = threading.Barrier(4)
+
+        def task(i):
+            with osutils.context_environ('TESTTHREAD', str(i)):
+                barrier.wait(5)
+                return osutils.get_context_environ()['TESTTHREAD']
+        with futures.ThreadPoolExecutor(4) as pool:
+            got = list(pool.map(task, range(4)))
+        self.assertEqual(got, ['0', '1', '2', '3'])
+
+    def testCwd(self):
+        tempd = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, tempd)
+        os.mkdir(join(tempd, 'sub'))
+        cwd = os.getcwd()
+        self.assertEqual(osutils.get_context_cwd(), cwd)
+        with osutils.context_cwd(tempd):
+            with osutils.context_cwd('sub'):
+                self.assertEqual(osutils.get_context_cwd(), join(tempd, 'sub'))
+                self.assertEqual(osutils.context_abspath(join('..', 'a')),
+                                 join(tempd, 'a'))
+            self.assertEqual(osutils.get_context_cwd(), tempd)
+            self.assertEqual(os.getcwd(), cwd)
+            self.assertRaises(OSError, osutils.context_cwd('nope').__enter__)
+        self.assertEqual(osutils.get_context_cwd(), cwd)
+
+    def testPopenKwargs(self):
+        self.assertEqual(osutils.context_popen_kwargs(shell=False),
+                         {'shell': False})
+        tempd = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, tempd)
+        code = 'import os; print(os.getcwd()); print(os.environ["TESTPOPEN"])'
+        with osutils.context_cwd(tempd):
+            with osutils.context_environ('TESTPOPEN', 'spam'):
+                out = subprocess.check_output(
+                    [sys.executable, '-c', code],
+                    **osutils.context_popen_kwargs())
+        self.assertEqual(out.decode().split(), [tempd, 'spam'])
+
+
 class ChangeExtTests(unittest.TestCase):
     """All tests here should include tests on various extension lengths.  This isn't required but would be complete.
         3 char with 3 char
@@ -172,6 +402,65 @@ class TestCopy(unittest.TestCase):
         self.assertRaises(IOError, lambda: osutils.copy(src, self.getRandomTempPath('spam.eggs')))
 
 
+class CopyTreeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.src = join(self.tempd, 'src')
+        self.dst = join(self.tempd, 'dst')
+        self.relpaths = [join('a', 'b', 'f1.txt'), join('a', 'f2.txt'),
+                         'f3.txt', join('c', 'f4.pyc')]
+        for i, rel in enumerate(self.relpaths):
+            path = join(self.src, rel)
+            osutils.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(b'data' * (i * 1000))
+
+    def assertCopied(self, relpaths):
+        for rel in relpaths:
+            testhelpers.assertCrcEqual(
+                self, join(self.dst, rel), join(self.src, rel))
+            self.assertEqual(os.stat(join(self.dst, rel)).st_mtime,
+                             os.stat(join(self.src, rel)).st_mtime)
+
+    def testCopiesTree(self):
+        for workers in (1, 4):
+            shutil.rmtree(self.dst, ignore_errors=True)
+            copied = osutils.copy_tree(self.src, self.dst, workers=workers)
+            self.assertEqual(
+                sorted(copied), sorted(join(self.dst, r) for r in self.relpaths))
+            self.assertCopied(self.relpaths)
+
+    def testFilters(self):
+        copied = osutils.copy_tree(
+            self.src, self.dst, exclude='*.pyc', excludedirs='b')
+        self.assertEqual(sorted(copied), [join(self.dst, 'a', 'f2.txt'),
+                                          join(self.dst, 'f3.txt')])
+
+    def testSkipsUnchanged(self):
+        osutils.copy_tree(self.src, self.dst)
+        changed = join(self.src, 'a', 'f2.txt')
+        with open(changed, 'ab') as f:
+            f.write(b'more')
+        self.assertEqual(osutils.copy_tree(self.src, self.dst),
+                         [join(self.dst, 'a', 'f2.txt')])
+        self.assertCopied(self.relpaths)
+        self.assertEqual(
+            len(osutils.copy_tree(self.src, self.dst, skipunchanged=False)), 4)
+
+    def testFallsBackToUserspace(self):
+        err = OSError(errno.ENOSYS, 'nope')
+        with mock.patch.object(osutils, '_kernel_copies',
+                               return_value=[mock.Mock(side_effect=err)]):
+            osutils.copy_tree(self.src, self.dst, reflink=False)
+        self.assertCopied(self.relpaths)
+
+    def testKernelCopyErrorAfterStartRaises(self):
+        func = mock.Mock(side_effect=[10, OSError(errno.ENOSYS, 'nope')])
+        self.assertRaises(OSError, osutils._kernel_copy, func, 0, 1, 100)
+
+
 class CrcFromFilenameTests(unittest.TestCase):
 
     def testKnown(self):
@@ -183,6 +472,382 @@ class CrcFromFilenameTests(unittest.TestCase):
         self.assertEqual(osutils.crc_from_filename(f), 907060870)
 
 
+class FileDigestsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(10000) + b'hello' * 1000
+        self.path = osutils.mktemp()
+        self.addCleanup(os.remove, self.path)
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.ideal = {
+            'crc32': zlib.crc32(self.data) & 0xffffffff,
+            'adler32': zlib.adler32(self.data) & 0xffffffff,
+            'md5': hashlib.md5(self.data).hexdigest(),
+            'sha256': hashlib.sha256(self.data).hexdigest()}
+
+    def testAllAtOnce(self):
+        for kwargs in [{}, {'bufsize': 7}, {'usemmap': True},
+                       {'usemmap': True, 'bufsize': 999}]:
+            got = osutils.file_digests(self.path, list(self.ideal), **kwargs)
+            self.assertEqual(got, self.ideal)
+
+    def testDefaultIsCrc(self):
+        self.assertEqual(osutils.file_digests(self.path),
+                         {'crc32': self.ideal['crc32']})
+        self.assertEqual(osutils.crc_from_filename(self.path),
+                         self.ideal['crc32'])
+
+    def testEmpty(self):
+        with open(self.path, 'wb'):
+            pass
+        for usemmap in [False, True]:
+            got = osutils.file_digests(
+                self.path, ['crc32', 'adler32', 'sha1'], usemmap=usemmap)
+            self.assertEqual(got, {'crc32': 0, 'adler32': 1,
+                                   'sha1': hashlib.sha1().hexdigest()})
+
+    def testBufferIsSizedToSmallFiles(self):
+        with mock.patch.object(osutils, 'bytearray', create=True,
+                               side_effect=bytearray) as m:
+            got = osutils.file_digests(self.path, list(self.ideal))
+        self.assertEqual(got, self.ideal)
+        m.assert_called_once_with(len(self.data))
+
+    def testZeroSizedFilesUseFullBuffer(self):
+        fakest = mock.Mock(st_size=0)
+        with mock.patch('os.fstat', return_value=fakest):
+            with mock.patch.object(osutils, 'bytearray', create=True,
+                                   side_effect=bytearray) as m:
+                got = osutils.file_digests(self.path, list(self.ideal),
+                                           bufsize=4096)
+        self.assertEqual(got, self.ideal)
+        m.assert_called_once_with(4096)
+
+    def testMmapIgnoredOnPy2(self):
+        with mock.patch.object(osutils._compat, 'PY3K', False):
+            with mock.patch('mmap.mmap') as m:
+                got = osutils.file_digests(
+                    self.path, list(self.ideal), usemmap=True)
+        self.assertEqual(got, self.ideal)
+        self.assertFalse(m.called)
+
+
+class BatchDigestsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.paths = []
+        for i in range(10):
+            path = join(self.tempd, 'f%s' % i)
+            with open(path, 'wb') as f:
+                f.write(b'spam' * i)
+            self.paths.append(path)
+        self.cachefile = join(self.tempd, 'cache', 'digests.json')
+
+    def ideal(self, path):
+        with open(path, 'rb') as f:
+            return {'crc32': zlib.crc32(f.read()) & 0xffffffff}
+
+    def digestAndCountReads(self, cache, workers=4, algorithms=('crc32',)):
+        with mock.patch.object(osutils, 'file_digests',
+                               side_effect=osutils.file_digests) as m:
+            got = osutils.batch_digests(
+                self.paths, algorithms, workers=workers, cache=cache)
+        return got, m.call_count
+
+    def testNoCache(self):
+        for workers in (1, 4):
+            got = osutils.batch_digests(self.paths, workers=workers)
+            self.assertEqual(got, dict((p, self.ideal(p)) for p in self.paths))
+
+    def testCacheSkipsUnchanged(self):
+        cache = osutils.DigestCache(self.cachefile)
+        self.assertEqual(self.digestAndCountReads(cache)[1], 10)
+        cache.save()
+        with open(self.paths[3], 'wb') as f:
+            f.write(b'changed')
+        cache = osutils.DigestCache(self.cachefile)
+        self.assertEqual(len(cache), 10)
+        got, reads = self.digestAndCountReads(cache, workers=1)
+        self.assertEqual(reads, 1)
+        self.assertEqual(got, dict((p, self.ideal(p)) for p in self.paths))
+
+    def testMissingAlgorithmRecomputed(self):
+        cache = osutils.DigestCache()
+        self.digestAndCountReads(cache)
+        got, reads = self.digestAndCountReads(cache, algorithms=['md5'])
+        self.assertEqual(reads, 10)
+        self.assertEqual(
+            cache.get(self.paths[2], ['crc32', 'md5']),
+            {'crc32': self.ideal(self.paths[2])['crc32'],
+             'md5': hashlib.md5(b'spam' * 2).hexdigest()})
+
+    def testCorruptCacheIgnored(self):
+        osutils.makedirs(os.path.dirname(self.cachefile))
+        with open(self.cachefile, 'w') as f:
+            f.write('{not json')
+        self.assertEqual(len(osutils.DigestCache(self.cachefile)), 0)
+
+    def testPruneAndSaveWithoutFilename(self):
+        cache = osutils.DigestCache()
+        self.digestAndCountReads(cache)
+        os.remove(self.paths[0])
+        cache.prune()
+        self.assertEqual(len(cache), 9)
+        self.assertRaises(ValueError, cache.save)
+
+
+class TreeSnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.root = join(self.tempd, 'root')
+        for rel in ['a.txt', join('sub', 'b.txt'), join('sub', 'c.pyc')]:
+            self.write(rel, rel.encode('utf-8'))
+
+    def write(self, rel, data, mtime=None):
+        path = join(self.root, rel)
+        osutils.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        st = os.stat(path)
+        if mtime is None:
+            mtime = st.st_mtime_ns
+        os.utime(path, ns=(st.st_atime_ns, mtime))
+        return path
+
+    def testCapture(self):
+        snap = osutils.TreeSnapshot.capture(self.root, exclude='*.pyc')
+        self.assertEqual(snap.paths, ['a.txt', join('sub', 'b.txt')])
+        self.assertEqual(list(snap.sizes), [5, len(join('sub', 'b.txt'))])
+        self.assertFalse(snap.hashed)
+        hashed = osutils.TreeSnapshot.capture(self.root, hashed=True)
+        self.assertEqual(hashed.crcs[0], zlib.crc32(b'a.txt') & 0xffffffff)
+
+    def testSaveLoadRoundTrip(self):
+        for hashed in (False, True):
+            snap = osutils.TreeSnapshot.capture(self.root, hashed=hashed)
+            filename = join(self.tempd, 'snap.bin')
+            snap.save(filename)
+            loaded = osutils.TreeSnapshot.load(filename)
+            for attr in ('paths', 'sizes', 'mtimes', 'modes', 'crcs'):
+                self.assertEqual(getattr(loaded, attr), getattr(snap, attr))
+            self.assertFalse(snap.diff(loaded))
+
+    def testInt64TypecodeFallback(self):
+        realarray = array.array
+
+        def py2array(typecode, *args):
+            if typecode == 'q':
+                raise ValueError('bad typecode')
+            if typecode == 'l':
+                return realarray('i', *args)
+            return realarray(typecode, *args)
+        with mock.patch('array.array', py2array):
+            self.assertEqual(osutils._int64_typecode(), 'd')
+
+    def testSavesSameFormatWithDoubles(self):
+        # Whole seconds in nanoseconds are exact as doubles.
+        for rel in ['a.txt', join('sub', 'b.txt'), join('sub', 'c.pyc')]:
+            self.write(rel, b'data', mtime=1500000000 * 10 ** 9)
+        snap = osutils.TreeSnapshot.capture(self.root, hashed=True)
+        filename = join(self.tempd, 'snap.bin')
+        snap.save(filename)
+        with mock.patch.object(osutils, '_INT64', 'd'):
+            dsnap = osutils.TreeSnapshot.capture(self.root, hashed=True)
+            self.assertEqual(dsnap.sizes.typecode, 'd')
+            self.assertEqual(list(dsnap.sizes), list(snap.sizes))
+            dfilename = join(self.tempd, 'dsnap.bin')
+            dsnap.save(dfilename)
+            loaded = osutils.TreeSnapshot.load(filename)
+            self.assertEqual(loaded.mtimes.typecode, 'd')
+            self.assertEqual(list(loaded.mtimes), list(snap.mtimes))
+            self.assertFalse(loaded.diff(dsnap))
+        with open(filename, 'rb') as f, open(dfilename, 'rb') as df:
+            self.assertEqual(f.read(), df.read())
+
+    def testSaveLoadEmpty(self):
+        filename = join(self.tempd, 'snap.bin')
+        osutils.TreeSnapshot().save(filename)
+        self.assertEqual(len(osutils.TreeSnapshot.load(filename)), 0)
+
+    def testLoadBadFileRaises(self):
+        filename = join(self.tempd, 'bad.bin')
+        with open(filename, 'wb') as f:
+            f.write(b'not a snapshot at all')
+        self.assertRaises(ValueError, osutils.TreeSnapshot.load, filename)
+
+    def testDiff(self):
+        before = osutils.TreeSnapshot.capture(self.root)
+        self.write('new.txt', b'new')
+        os.remove(join(self.root, 'sub', 'c.pyc'))
+        self.write('a.txt', b'A.TXT', mtime=before.mtimes[0] + 10 ** 9)
+        diff = osutils.TreeSnapshot.capture(self.root).diff(before)
+        self.assertEqual(diff, ([join('sub', 'c.pyc')], ['new.txt'], ['a.txt']))
+        self.assertEqual(before.diff_tree(self.root),
+                         (['new.txt'], [join('sub', 'c.pyc')], ['a.txt']))
+
+    def testHashedDiffIgnoresTouch(self):
+        before = osutils.TreeSnapshot.capture(self.root, hashed=True)
+        self.write('a.txt', b'a.txt', mtime=before.mtimes[0] + 10 ** 9)
+        with mock.patch.object(osutils, 'batch_digests',
+                               side_effect=osutils.batch_digests) as m:
+            self.assertFalse(before.diff_tree(self.root))
+        self.assertEqual(m.call_args[0][0], [join(self.root, 'a.txt')])
+        self.write('a.txt', b'A.TXT')
+        self.assertEqual(before.diff_tree(self.root), ([], [], ['a.txt']))
+
+
+class CoalesceTests(unittest.TestCase):
+
+    def coalesce(self, *kinds):
+        pending = {}
+        for kind in kinds:
+            osutils._coalesce(pending, kind, 'p')
+        return pending.get('p')
+
+    def testCoalesce(self):
+        A, R, C = osutils.ADDED, osutils.REMOVED, osutils.CHANGED
+        self.assertEqual(self.coalesce(A, C, C), A)
+        self.assertEqual(self.coalesce(A, C, R), None)
+        self.assertEqual(self.coalesce(R, A), C)
+        self.assertEqual(self.coalesce(C, R), R)
+        self.assertEqual(self.coalesce(C, C), C)
+
+
+class DirectoryWatcherTests(unittest.TestCase):
+
+    polling = True
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.existing = self.write('existing.txt')
+
+    def write(self, *parts):
+        path = join(self.tempd, *parts)
+        osutils.makedirs(os.path.dirname(path))
+        with open(path, 'a') as f:
+            f.write('data')
+        return path
+
+    def watch(self, make_changes, **kwargs):
+        """Start a watcher, call ``make_changes``, stop the watcher
+        after a while, and return the coalesced events by path."""
+        kwargs.setdefault('debounce', 0.05)
+        watcher = osutils.DirectoryWatcher(
+            self.tempd, polling=self.polling, pollinterval=0.05, **kwargs)
+        batches = watcher.batches()
+        with watcher:
+            make_changes()
+            time.sleep(0.5)
+        result = {}
+        for batch in batches:
+            for event in batch:
+                osutils._coalesce(result, event.kind, event.path)
+        return result
+
+    def testReportsChanges(self):
+        def change():
+            self.write('new.txt')
+            self.write('sub', 'deeper', 'new2.txt')
+            os.remove(self.existing)
+        self.assertEqual(self.watch(change), {
+            join(self.tempd, 'new.txt'): osutils.ADDED,
+            join(self.tempd, 'sub', 'deeper', 'new2.txt'): osutils.ADDED,
+            self.existing: osutils.REMOVED})
+
+    def testModified(self):
+        def change():
+            time.sleep(0.1)
+            self.write('existing.txt')
+        self.assertEqual(self.watch(change), {self.existing: osutils.CHANGED})
+
+    def testFilters(self):
+        def change():
+            self.write('new.txt')
+            self.write('new.pyc')
+            self.write('skip', 'new.txt')
+            self.write('sub', 'new.txt')
+        self.assertEqual(
+            self.watch(change, exclude='*.pyc', excludedirs='skip'),
+            {join(self.tempd, 'new.txt'): osutils.ADDED,
+             join(self.tempd, 'sub', 'new.txt'): osutils.ADDED})
+
+    def testNotRecursive(self):
+        os.mkdir(join(self.tempd, 'sub'))
+
+        def change():
+            self.write('new.txt')
+            self.write('sub', 'new.txt')
+        self.assertEqual(self.watch(change, recursive=False),
+                         {join(self.tempd, 'new.txt'): osutils.ADDED})
+
+    def testDirectoryMovedOut(self):
+        self.write('sub', 'b.txt')
+        self.write('sub', 'deeper', 'c.txt')
+        self.write('sub', 'c.pyc')
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+
+        def change():
+            os.rename(join(self.tempd, 'sub'), join(outside, 'sub'))
+        self.assertEqual(self.watch(change, include='*.txt'), {
+            join(self.tempd, 'sub', 'b.txt'): osutils.REMOVED,
+            join(self.tempd, 'sub', 'deeper', 'c.txt'): osutils.REMOVED})
+
+    def testSignalAndDebounce(self):
+        batches = []
+        watcher = osutils.DirectoryWatcher(
+            self.tempd, polling=self.polling, pollinterval=0.05,
+            debounce=0.05)
+        watcher.changed.connect(batches.append)
+        with watcher:
+            self.write('a.txt')
+            self.write('a.txt')
+            time.sleep(0.5)
+        self.assertEqual(batches, [[osutils.FileEvent(
+            osutils.ADDED, join(self.tempd, 'a.txt'))]])
+
+    def testStartTwiceRaises(self):
+        watcher = osutils.DirectoryWatcher(self.tempd, polling=self.polling)
+        with watcher:
+            self.assertRaises(RuntimeError, watcher.start)
+
+
+@unittest.skipUnless(osutils._InotifyBackend.is_supported(),
+                     'inotify not available.')
+class InotifyDirectoryWatcherTests(DirectoryWatcherTests):
+
+    polling = False
+
+    def testOverflowRequestsRescan(self):
+        backend = osutils._InotifyBackend(self.tempd, True, None)
+        self.addCleanup(backend.close)
+        data = struct.pack('iIII', -1, backend.IN_Q_OVERFLOW, 0, 0)
+        self.assertEqual(backend._parse(data),
+                         [(osutils.RESCAN, self.tempd)])
+
+    def testMovedOutDirectoryIsUnwatched(self):
+        self.write('sub', 'deeper', 'a.txt')
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        backend = osutils._InotifyBackend(self.tempd, True, None)
+        self.addCleanup(backend.close)
+        self.assertEqual(len(backend.wds), 3)
+        os.rename(join(self.tempd, 'sub'), join(outside, 'sub'))
+        self.assertEqual(
+            backend.read(1),
+            [(osutils.REMOVED, join(self.tempd, 'sub', 'deeper', 'a.txt'))])
+        self.assertEqual(list(backend.wds.values()), [self.tempd])
+        with open(join(outside, 'sub', 'deeper', 'b.txt'), 'w') as f:
+            f.write('data')
+        self.assertEqual(backend.read(0.1), [])
+
+
 class IterFilesTests(unittest.TestCase):
 
     def testReturnsGenerator(self):
@@ -202,6 +867,133 @@ class IterFilesTests(unittest.TestCase):
         self.assertTrue(thispy in files)
 
 
+class WalkFilesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        for relpath in ['a.py', 'b.txt', 'c.pyc',
+                        join('sub', 'd.py'), join('sub', 'e.txt'),
+                        join('sub', 'deep', 'f.py'),
+                        join('.git', 'g.py'), join('build', 'h.py')]:
+            path = join(self.tempd, relpath)
+            osutils.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(relpath)
+
+    def rel(self, paths):
+        return sorted(os.path.relpath(p, self.tempd) for p in paths)
+
+    def testMatchesOsWalk(self):
+        ideal = []
+        for root, dirs, files in os.walk(self.tempd):
+            ideal.extend(join(root, f) for f in files)
+        self.assertEqual(list(osutils.walk_files(self.tempd)), ideal)
+
+    def testMultiplePatterns(self):
+        got = osutils.walk_files(
+            self.tempd, include=['*.py', '*.txt'], exclude='d.*')
+        self.assertEqual(self.rel(got), [
+            join('.git', 'g.py'), 'a.py', 'b.txt', join('build', 'h.py'),
+            join('sub', 'deep', 'f.py'), join('sub', 'e.txt')])
+
+    def testSameSemanticsAsGlobSet(self):
+        self.assertEqual(list(osutils.walk_files(self.tempd, include=[])), [])
+        self.assertEqual(
+            list(osutils.walk_files(self.tempd, include=['*.py', '*.txt'])),
+            list(osutils.walk_files(
+                self.tempd, include=osutils.GlobSet(['*.py', '*.txt']))))
+        self.assertEqual(
+            list(osutils.walk_files(self.tempd, exclude=[])),
+            list(osutils.walk_files(self.tempd)))
+
+    def testPrunesDirs(self):
+        with mock.patch.object(osutils, '_iter_dir',
+                               side_effect=osutils._iter_dir) as m:
+            got = list(osutils.walk_files(
+                self.tempd, '*.py', excludedirs=['.git', 'build', 'dee*']))
+        self.assertEqual(self.rel(got), ['a.py', join('sub', 'd.py')])
+        self.assertEqual(m.call_count, 2)
+
+    def testEntries(self):
+        got = list(osutils.walk_files(self.tempd, 'a.py', entries=True))
+        self.assertEqual(len(got), 1)
+        self.assertEqual(got[0].name, 'a.py')
+        self.assertEqual(got[0].path, join(self.tempd, 'a.py'))
+        self.assertEqual(got[0].stat().st_size, 4)
+
+    def testListdirFallback(self):
+        with testhelpers.Patcher(osutils, '_scandir', None):
+            got = list(osutils.walk_files(
+                self.tempd, '*.py', excludedirs='.git', entries=True))
+        self.assertEqual(self.rel(e.path for e in got), [
+            'a.py', join('build', 'h.py'), join('sub', 'd.py'),
+            join('sub', 'deep', 'f.py')])
+        self.assertTrue(got[0].is_file())
+
+    def testMissingDirectory(self):
+        self.assertEqual(list(osutils.walk_files(join(self.tempd, 'no'))), [])
+
+
+class WalkFilesParallelTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        for i in range(30):
+            path = join(self.tempd, 'd%s' % (i % 4), 'e%s' % (i % 3),
+                        'f%02d.%s' % (i, 'py' if i % 2 else 'txt'))
+            osutils.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write('x')
+        osutils.makedirs(join(self.tempd, 'skip'))
+        with open(join(self.tempd, 'skip', 'a.py'), 'w') as f:
+            f.write('x')
+
+    def testSameFilesAsSerial(self):
+        for workers, maxqueue in [(1, 1), (4, 2), (8, 1024)]:
+            got = osutils.walk_files_parallel(
+                self.tempd, '*.py', excludedirs='skip',
+                workers=workers, maxqueue=maxqueue)
+            ideal = osutils.walk_files(self.tempd, '*.py', excludedirs='skip')
+            self.assertEqual(sorted(got), sorted(ideal))
+
+    def testSorted(self):
+        ideal = []
+        for root, dirs, files in os.walk(self.tempd):
+            dirs.sort()
+            ideal.extend(join(root, f) for f in sorted(files))
+        for maxqueue in (1, 3, 1024):
+            got = list(osutils.walk_files_parallel(
+                self.tempd, workers=3, maxqueue=maxqueue, sort=True))
+            self.assertEqual(got, ideal)
+
+    def testEntries(self):
+        got = list(osutils.walk_files_parallel(
+            self.tempd, 'a.py', entries=True))
+        self.assertEqual([e.path for e in got], [join(self.tempd, 'skip', 'a.py')])
+
+    def testStopEarly(self):
+        for sort in (False, True):
+            gen = osutils.walk_files_parallel(
+                self.tempd, workers=2, maxqueue=1, sort=sort)
+            self.assertTrue(next(gen))
+            gen.close()
+
+    def testErrorsPropagate(self):
+        def badscan(*_):
+            raise ZeroDivisionError()
+        with testhelpers.Patcher(osutils, '_scan_dir', badscan):
+            for sort in (False, True):
+                self.assertRaises(
+                    ZeroDivisionError, list,
+                    osutils.walk_files_parallel(self.tempd, sort=sort))
+
+    def testMissingDirectory(self):
+        self.assertEqual(
+            list(osutils.walk_files_parallel(join(self.tempd, 'no'))), [])
+
+
 class ListDirExTests(unittest.TestCase):
     def testGivenPatternFindsOnlyMatches(self):
         files = list(osutils.listdirex(THISDIR, '*osutils.py'))
@@ -216,6 +1008,45 @@ class ListDirExTests(unittest.TestCase):
         self.assertFalse(thispy in files)
 
 
+class GlobSetTests(unittest.TestCase):
+
+    PATTERNS = ['*', '*.py', '*.tar.gz', '*.', 'README', 'test_*', 'a?c',
+                '[ab]*.txt', '*osutils*', '*.p[yx]', '.*', 'x*y*z']
+    NAMES = ['', 'a.py', 'a.tar.gz', 'tar.gz', '.gz', 'a.', 'README',
+             'README.md', 'test_osutils.py', 'abc', 'a.txt', 'c.txt',
+             'osutils', '.bashrc', 'xyz', 'xy', 'x.y.z', 'foo.px', 'a/b.py']
+
+    def testMatchesLikeFnmatch(self):
+        for i in range(len(self.PATTERNS)):
+            patterns = self.PATTERNS[i:]
+            globs = osutils.GlobSet(patterns)
+            for name in self.NAMES:
+                ideal = [p for p in patterns if fnmatch.fnmatch(name, p)]
+                self.assertEqual(globs.matches(name), ideal, (name, patterns))
+                self.assertEqual(globs.match(name), bool(ideal))
+
+    def testManyExtensions(self):
+        globs = osutils.GlobSet(['*.ext%s' % i for i in range(500)])
+        self.assertEqual(globs.matches('foo.ext42'), ['*.ext42'])
+        self.assertFalse(globs('foo.ext500'))
+        self.assertEqual(globs.filter(['a.ext1', 'b.txt', 'c.ext499']),
+                         ['a.ext1', 'c.ext499'])
+
+    def testCoerce(self):
+        globs = osutils.GlobSet('*.py')
+        self.assertIs(osutils.GlobSet.coerce(globs), globs)
+        self.assertEqual(osutils.GlobSet.coerce(['*.py']).patterns, ('*.py',))
+
+    def testAcceptedByListdirexAndIterFiles(self):
+        globs = osutils.GlobSet(['*osutils.py', '*logutils.py'])
+        names = sorted(os.path.basename(f)
+                       for f in osutils.listdirex(THISDIR, globs))
+        self.assertEqual(names, ['test_logutils.py', 'test_osutils.py'])
+        names = sorted(os.path.basename(f)
+                       for f in osutils.iter_files(THISDIR, globs))
+        self.assertEqual(names, ['test_logutils.py', 'test_osutils.py'])
+
+
 class MakeDirsTests(unittest.TestCase):
     thisdir = os.path.dirname(__file__)
 
@@ -331,6 +1162,61 @@ class PurenameTests(unittest.TestCase):
         self.assertEqual('spam.eggs', osutils.purename(join('foo', 'spam.eggs.bar')))
 
 
+class BatchPathTests(unittest.TestCase):
+
+    PATHS = ['', '.', '..', '/', '//', 'foo', 'foo/', 'foo//bar', '/foo',
+             '\\foo', 'c:', 'c:/', 'c:foo', 'c:\\users\\mary major\\f',
+             '\\\\server\\share\\x.y', 'res:/foo/bar.red', '.txt', '.spam.eggs.ham',
+             '..foo', 'foo/..bar', 'foo/.bar.baz', 'a.b/c', 'a.b/c.d.e',
+             'foo//', join(ROOT, 'foo', 'bar.baz')]
+
+    def testPathComponentsMany(self):
+        self.assertEqual(osutils.path_components_many(self.PATHS),
+                         [osutils.path_components(p) for p in self.PATHS])
+
+    def testSplit3Many(self):
+        dirnames, names, exts = osutils.split3_many(self.PATHS)
+        self.assertEqual(list(zip(dirnames, names, exts)),
+                         [osutils.split3(p) for p in self.PATHS])
+        self.assertEqual(osutils.split3_many([]), ([], [], []))
+
+    def testPurenameMany(self):
+        self.assertEqual(osutils.purename_many(self.PATHS),
+                         [osutils.purename(p) for p in self.PATHS])
+
+    def testChangeExtMany(self):
+        self.assertEqual(osutils.change_ext_many(self.PATHS, '.new'),
+                         [osutils.change_ext(p, '.new') for p in self.PATHS])
+
+
+@unittest.skipUnless(os.environ.get('BRENNIVIN_BENCHMARK'),
+                     'Set BRENNIVIN_BENCHMARK=1 to run benchmarks.')
+class BatchPathBenchmark(unittest.TestCase):
+    """Compares the batch path functions to calling the single-path
+    functions in a loop, and prints the timings."""
+
+    def bench(self, name, single, batch):
+        import timeit
+        paths = [join('srv', 'build', str(i % 50), 'sub%s' % (i % 7),
+                      'file_%s.tar.gz' % i) for i in range(100000)]
+        tsingle = min(timeit.repeat(lambda: single(paths), number=1, repeat=3))
+        tbatch = min(timeit.repeat(lambda: batch(paths), number=1, repeat=3))
+        print('%s: loop %.3fs, batch %.3fs (%.1fx)' % (
+            name, tsingle, tbatch, tsingle / tbatch))
+
+    def testBenchmark(self):
+        self.bench('path_components',
+                   lambda ps: [osutils.path_components(p) for p in ps],
+                   osutils.path_components_many)
+        self.bench('split3', lambda ps: [osutils.split3(p) for p in ps],
+                   osutils.split3_many)
+        self.bench('purename', lambda ps: [osutils.purename(p) for p in ps],
+                   osutils.purename_many)
+        self.bench('change_ext',
+                   lambda ps: [osutils.change_ext(p, '.z') for p in ps],
+                   lambda ps: osutils.change_ext_many(ps, '.z'))
+
+
 class SetReadOnlyTests(unittest.TestCase):
 
     def setUp(self):
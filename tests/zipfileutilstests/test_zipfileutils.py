@@ -1,3 +1,4 @@
+import json
 import os
 import shutil
 import sys
@@ -129,3 +130,608 @@ class TestCompareZipFiles(unittest.TestCase):
 
         with testhelpers.Patcher(zipfile.ZipFile, 'infolist', infolist):
             zu.compare_zip_files(create_zip(), create_zip())
+
+    def testDifferentSizesRaise(self):
+        f1 = self.createZip([['f1.txt', '1']])
+        f2 = self.createZip([['f1.txt', '1']])
+        with zu.ZipFile(f2) as z:
+            info = z.getinfo('f1.txt')
+        info.file_size = 2
+        with testhelpers.Patcher(zu, '_sorted_infolist', lambda zf: (
+                [info] if zf.filename == f2 else zf.infolist())):
+            self.assertAssertsWithMsg(f1, f2, 'f1.txt sizes different.')
+
+    def testLongFileListsTruncated(self):
+        f1 = self.createZip([['%03d' % i, '1'] for i in range(25)])
+        f2 = self.createZip([['f1.txt', '1']])
+        names = ', '.join("'%03d'" % i for i in range(20))
+        self.assertAssertsWithMsg(
+            f1, f2, "File lists differ: [%s, ... 5 more], ['f1.txt']" % names)
+
+
+class TestParallelZipDir(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.srcdir = os.path.join(self.tempd, 'src')
+        for i in range(20):
+            path = os.path.join(self.srcdir, 'd%s' % (i % 3), 'f%s.txt' % i)
+            osutils.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(os.urandom(i * 100) + b'spam' * i * 1000)
+
+    def zip(self, name, **kwargs):
+        path = os.path.join(self.tempd, name)
+        zu.zip_dir(self.srcdir, path, **kwargs)
+        return path
+
+    def readbytes(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def testIdenticalToSerial(self):
+        serial = self.zip('serial.zip')
+        parallel = self.zip('parallel.zip', workers=4)
+        self.assertEqual(self.readbytes(serial), self.readbytes(parallel))
+
+    def testSpillsToDisk(self):
+        serial = self.zip('serial.zip')
+        parallel = self.zip('parallel.zip', workers=3, spoolsize=10)
+        self.assertEqual(self.readbytes(serial), self.readbytes(parallel))
+        with zu.ZipFile(parallel) as zfile:
+            self.assertIsNone(zfile.testzip())
+
+    def testFilteredAndSubdir(self):
+        with zu.ZipFile(os.path.join(self.tempd, 'a.zip'), 'w',
+                        zipfile.ZIP_DEFLATED) as zfile:
+            zu.write_dir(self.srcdir, zfile, exclude=lambda p: 'd1' in p,
+                         subdir='nested', workers=2)
+            names = sorted(zfile.namelist())
+        self.assertTrue(names)
+        for name in names:
+            self.assertTrue(name.startswith('nested/'))
+            self.assertNotIn('d1', name)
+
+    def testErrorPropagates(self):
+        def badfiles():
+            yield os.path.join(self.srcdir, 'd0', 'f0.txt')
+            yield os.path.join(self.srcdir, 'missing.txt')
+        with zu.ZipFile(os.path.join(self.tempd, 'a.zip'), 'w') as zfile:
+            self.assertRaises(
+                (IOError, OSError), zu.write_files, badfiles(), zfile,
+                workers=2)
+
+
+class TestIncrementalZipDir(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.srcdir = os.path.join(self.tempd, 'src')
+        self.zippath = os.path.join(self.tempd, 'out', 'a.zip')
+        for i in range(5):
+            self.writefile('f%s.txt' % i, b'spam' * 100 * i, i)
+
+    def writefile(self, name, data, mtime=0):
+        path = os.path.join(self.srcdir, name)
+        osutils.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        stamp = 1400000000 + mtime * 10
+        os.utime(path, (stamp, stamp))
+
+    def readbytes(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def assertMatchesFreshZip(self):
+        fresh = os.path.join(self.tempd, 'fresh.zip')
+        zu.zip_dir(self.srcdir, fresh)
+        self.assertEqual(self.readbytes(self.zippath), self.readbytes(fresh))
+
+    def zipAndCountWrites(self, **kwargs):
+        with mock.patch.object(zipfile.ZipFile, 'write',
+                               autospec=True,
+                               side_effect=zipfile.ZipFile.write) as m:
+            zu.zip_dir(self.srcdir, self.zippath, incremental=True, **kwargs)
+        return m.call_count
+
+    def testCreatesIfMissing(self):
+        self.assertEqual(self.zipAndCountWrites(), 5)
+        self.assertMatchesFreshZip()
+
+    def testOnlyChangedFilesCompressed(self):
+        zu.zip_dir(self.srcdir, self.zippath)
+        self.writefile('f2.txt', b'eggs', 50)
+        self.writefile('new.txt', b'ham', 2)
+        self.assertEqual(self.zipAndCountWrites(), 2)
+        self.assertMatchesFreshZip()
+        with zu.ZipFile(self.zippath) as z:
+            self.assertEqual(z.read('f2.txt'), b'eggs')
+            self.assertIsNone(z.testzip())
+
+    def testRemovedFilesDropped(self):
+        zu.zip_dir(self.srcdir, self.zippath)
+        os.remove(os.path.join(self.srcdir, 'f1.txt'))
+        self.assertEqual(self.zipAndCountWrites(), 0)
+        self.assertMatchesFreshZip()
+
+    def testCheckCrc(self):
+        zu.zip_dir(self.srcdir, self.zippath)
+        # Same size and mtime, different contents.
+        self.writefile('f1.txt', b'eggs' * 100, 1)
+        self.assertEqual(self.zipAndCountWrites(), 0)
+        self.assertEqual(self.zipAndCountWrites(checkcrc=True), 1)
+        self.assertMatchesFreshZip()
+
+    def testParallel(self):
+        zu.zip_dir(self.srcdir, self.zippath)
+        self.writefile('f3.txt', b'eggs', 50)
+        zu.zip_dir(self.srcdir, self.zippath, incremental=True, workers=3)
+        self.assertMatchesFreshZip()
+
+    def testFailureKeepsOldArchive(self):
+        zu.zip_dir(self.srcdir, self.zippath)
+        before = self.readbytes(self.zippath)
+        self.writefile('f3.txt', b'eggs', 50)
+        with mock.patch.object(zu, 'write_dir', side_effect=ArithmeticError):
+            self.assertRaises(ArithmeticError, zu.zip_dir, self.srcdir,
+                              self.zippath, incremental=True)
+        self.assertEqual(self.readbytes(self.zippath), before)
+        self.assertEqual(os.listdir(os.path.dirname(self.zippath)),
+                         [os.path.basename(self.zippath)])
+
+
+class TestDiffZipFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+
+    def createZip(self, files):
+        path = osutils.mktemp('.zip', dir=self.tempd)
+        with zu.ZipFile(path, 'w') as z:
+            for fpath, fstr in files:
+                z.writestr(fpath, fstr)
+        return path
+
+    def testEqual(self):
+        files = [['a', '1'], ['b', '2']]
+        diff = zu.diff_zip_files(self.createZip(files), self.createZip(files))
+        self.assertFalse(diff)
+        self.assertEqual(diff, ([], [], []))
+
+    def testAddedRemovedChanged(self):
+        z1 = self.createZip([['a', '1'], ['b', '2'], ['c', '3'], ['e', '5']])
+        z2 = self.createZip([['b', '2'], ['c', '4'], ['d', '4'], ['e', '5']])
+        diff = zu.diff_zip_files(z1, z2)
+        self.assertTrue(diff)
+        self.assertEqual(diff.added, ['d'])
+        self.assertEqual(diff.removed, ['a'])
+        self.assertEqual(diff.changed, ['c'])
+
+    def testCheckContent(self):
+        z1 = self.createZip([['a', 'spam'], ['b', 'eggs']])
+        z2 = self.createZip([['a', 'spam'], ['b', 'eggs']])
+        # Colliding CRCs are hard to come by, so pretend 'b' differs.
+        orig = zu._members_equal
+        with testhelpers.Patcher(
+                zu, '_members_equal',
+                lambda zf1, zf2, name: name != 'b' and orig(zf1, zf2, name)):
+            for workers in (1, 3):
+                diff = zu.diff_zip_files(
+                    z1, z2, checkcontent=True, workers=workers)
+                self.assertEqual(diff.changed, ['b'])
+        self.assertFalse(zu.diff_zip_files(z1, z2, checkcontent=True))
+
+    def testMembersEqual(self):
+        z1 = self.createZip([['a', 'spam' * 100000]])
+        z2 = self.createZip([['a', 'spam' * 99999 + 'eggs']])
+        with zu.ZipFile(z1) as zf1:
+            with zu.ZipFile(z2) as zf2:
+                self.assertTrue(zu._members_equal(zf1, zf1, 'a'))
+                self.assertFalse(zu._members_equal(zf1, zf2, 'a'))
+
+
+class TestZipPathResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.zippath = os.path.join(self.tempd, 'a.zip')
+        self.createZip(['dir/', 'dir/f.txt', 'g.txt'])
+        self.resolver = zu.ZipPathResolver()
+
+    def createZip(self, names):
+        with zu.ZipFile(self.zippath, 'w') as z:
+            for name in names:
+                z.writestr(name, name)
+
+    def testResolves(self):
+        self.assertEqual(
+            self.resolver.resolve(os.path.join(self.zippath, 'dir', 'f.txt')),
+            (self.zippath, 'dir/f.txt'))
+        self.assertEqual(
+            self.resolver.resolve(os.path.join(self.zippath, 'g.txt')),
+            (self.zippath, 'g.txt'))
+        self.assertEqual(
+            self.resolver.resolve(os.path.join(self.zippath, 'dir')),
+            (self.zippath, 'dir/'))
+        info = self.resolver.getinfo(os.path.join(self.zippath, 'g.txt'))
+        self.assertEqual(info.filename, 'g.txt')
+
+    def testMissingMember(self):
+        path = os.path.join(self.zippath, 'nope.txt')
+        self.assertIsNone(self.resolver.resolve(path))
+        self.assertIsNone(self.resolver.getinfo(path))
+        self.assertTrue(self.resolver.is_inside_zipfile(path))
+
+    def testNotInsideZip(self):
+        for path in [os.path.join(self.tempd, 'a.txt'),
+                     os.path.join(self.tempd, 'nope', 'a.txt'),
+                     os.path.join(self.zippath + 'x', 'a.txt')]:
+            self.assertIsNone(self.resolver.resolve(path))
+            self.assertFalse(self.resolver.is_inside_zipfile(path))
+
+    def testNotAZip(self):
+        notzip = os.path.join(self.tempd, 'b.zip')
+        with open(notzip, 'w') as f:
+            f.write('spam')
+        self.assertFalse(
+            self.resolver.is_inside_zipfile(os.path.join(notzip, 'a.txt')))
+
+    def testMatchesFunction(self):
+        test_path = os.path.join(IDEAL_ALL, "testdir", "testfile.txt")
+        self.assertTrue(self.resolver.is_inside_zipfile(test_path))
+        self.assertEqual(
+            self.resolver.resolve(os.path.join(IDEAL_ALL, 'subdir', 'a.fake')),
+            (IDEAL_ALL, 'subdir/a.fake'))
+
+    def testIndexesOnce(self):
+        path = os.path.join(self.zippath, 'g.txt')
+        with mock.patch.object(zipfile.ZipFile, '_RealGetContents',
+                               autospec=True,
+                               side_effect=zipfile.ZipFile._RealGetContents
+                               ) as m:
+            for _ in range(3):
+                self.resolver.resolve(path)
+        self.assertEqual(m.call_count, 1)
+
+    def testReindexesWhenArchiveChanges(self):
+        path = os.path.join(self.zippath, 'new.txt')
+        self.assertIsNone(self.resolver.resolve(path))
+        self.createZip(['dir/', 'dir/f.txt', 'g.txt', 'new.txt'])
+        self.assertEqual(self.resolver.resolve(path),
+                         (self.zippath, 'new.txt'))
+
+    def testCheckInterval(self):
+        now = [0]
+        resolver = zu.ZipPathResolver(10, _gettime=lambda: now[0])
+        path = os.path.join(self.zippath, 'new.txt')
+        self.assertIsNone(resolver.resolve(path))
+        self.createZip(['new.txt'])
+        self.assertIsNone(resolver.resolve(path))
+        now[0] = 11
+        self.assertEqual(resolver.resolve(path), (self.zippath, 'new.txt'))
+
+    def testImplicitDirectories(self):
+        self.createZip(['d1/d2/f.txt'])
+        self.assertEqual(
+            self.resolver.resolve(os.path.join(self.zippath, 'd1')),
+            (self.zippath, 'd1/'))
+        self.assertEqual(
+            self.resolver.resolve(os.path.join(self.zippath, 'd1', 'd2')),
+            (self.zippath, 'd1/d2/'))
+        self.assertIsNone(
+            self.resolver.getinfo(os.path.join(self.zippath, 'd1')))
+        self.assertIsNone(
+            self.resolver.resolve(os.path.join(self.zippath, 'd1', 'd')))
+
+    def testStatsOnceInsideKnownArchive(self):
+        self.resolver.resolve(os.path.join(self.zippath, 'g.txt'))
+        path = os.path.join(self.zippath, 'd1', 'd2', 'd3', 'f.txt')
+        with mock.patch('os.stat', side_effect=os.stat) as m:
+            self.assertIsNone(self.resolver.resolve(path))
+        self.assertEqual(m.call_count, 1)
+
+    def testNoStatsWithinCheckInterval(self):
+        now = [0]
+        resolver = zu.ZipPathResolver(10, _gettime=lambda: now[0])
+        resolver.resolve(os.path.join(self.zippath, 'g.txt'))
+        notzip = os.path.join(self.tempd, 'nope', 'd1', 'a.txt')
+        resolver.resolve(notzip)
+        with mock.patch('os.stat', side_effect=os.stat) as m:
+            for path in [os.path.join(self.zippath, 'd1', 'd2', 'f.txt'),
+                         os.path.join(self.zippath, 'dir', 'f.txt'),
+                         notzip]:
+                resolver.resolve(path)
+        self.assertEqual(m.call_count, 0)
+
+    def testInvalidate(self):
+        now = [0]
+        resolver = zu.ZipPathResolver(10, _gettime=lambda: now[0])
+        path = os.path.join(self.zippath, 'new.txt')
+        self.assertIsNone(resolver.resolve(path))
+        self.createZip(['new.txt'])
+        resolver.invalidate(self.zippath)
+        self.assertEqual(resolver.resolve(path), (self.zippath, 'new.txt'))
+        resolver.invalidate()
+        self.assertFalse(resolver._entries)
+        self.assertFalse(resolver._missing)
+
+    def testMissingPathsNotCachedWithoutInterval(self):
+        for i in range(10):
+            self.resolver.resolve(os.path.join(self.tempd, str(i), 'a.txt'))
+        self.assertFalse(self.resolver._missing)
+        self.assertEqual(list(self.resolver._entries), [self.tempd])
+
+    def testMissingPathsAreBounded(self):
+        now = [0]
+        resolver = zu.ZipPathResolver(10, maxmissing=5,
+                                      _gettime=lambda: now[0])
+        paths = [os.path.join(self.tempd, str(i), 'a.txt') for i in range(10)]
+        for path in paths:
+            resolver.resolve(path)
+        self.assertEqual(list(resolver._missing),
+                         [os.path.dirname(p) for p in paths[-5:]])
+
+
+class TestMappedZipFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.zippath = os.path.join(self.tempd, 'a.zip')
+        self.data = os.urandom(1000) + b'spam' * 100000
+        with zu.ZipFile(self.zippath, 'w') as z:
+            z.writestr('stored', self.data, zipfile.ZIP_STORED)
+            z.writestr('deflated', self.data, zipfile.ZIP_DEFLATED)
+            z.writestr('bzipped', self.data, zipfile.ZIP_BZIP2)
+            z.writestr('empty', b'', zipfile.ZIP_DEFLATED)
+        self.mzf = zu.MappedZipFile(self.zippath)
+        self.addCleanup(self.mzf.close)
+
+    def testReadView(self):
+        view = self.mzf.read_view('stored')
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(view.tobytes(), self.data)
+        view.release()
+
+    def testReadViewCompressedRaises(self):
+        self.assertRaises(ValueError, self.mzf.read_view, 'deflated')
+
+    def testRead(self):
+        for name in 'stored', 'deflated', 'bzipped':
+            got = self.mzf.read(name)
+            self.assertEqual(bytes(got), self.data)
+            if isinstance(got, memoryview):
+                got.release()
+        self.assertEqual(self.mzf.read('empty'), b'')
+
+    def testChunksAreBounded(self):
+        for name in 'stored', 'deflated', 'bzipped':
+            chunks = list(self.mzf.iter_chunks(name, 1000))
+            self.assertTrue(all(len(c) <= 1000 for c in chunks))
+            self.assertEqual(b''.join(chunks), self.data)
+            del chunks
+
+    def testBadCrcRaises(self):
+        self.mzf.getinfo('deflated').CRC ^= 1
+        self.assertRaises(
+            zipfile.BadZipfile, list, self.mzf.iter_chunks('deflated'))
+
+    def testCloseWithUnfinishedChunks(self):
+        gens = [self.mzf.iter_chunks(name, 1000)
+                for name in ('stored', 'deflated', 'bzipped')]
+        for gen in gens:
+            chunk = next(gen)
+            if isinstance(chunk, memoryview):
+                chunk.release()
+        self.mzf.close()
+
+    def testCloseInsideWithKeepsError(self):
+        def readsome():
+            with zu.MappedZipFile(self.zippath) as mzf:
+                gen = mzf.iter_chunks('deflated', 1000)
+                next(gen)
+                raise ArithmeticError
+        self.assertRaises(ArithmeticError, readsome)
+
+    def testMissing(self):
+        self.assertRaises(KeyError, self.mzf.read, 'nope')
+
+    def testNamelistAndClose(self):
+        self.assertEqual(sorted(self.mzf.namelist()),
+                         ['bzipped', 'deflated', 'empty', 'stored'])
+        self.mzf.close()
+        self.mzf.close()
+
+
+class TestDedupWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.srcdir = os.path.join(self.tempd, 'src')
+        self.cachedir = os.path.join(self.tempd, 'cache')
+        self.writefile('a/license.txt', b'spam' * 1000)
+        self.writefile('b/license.txt', b'spam' * 1000)
+        self.writefile('c/license.txt', b'spam' * 1000)
+        self.writefile('unique.txt', b'eggs' * 1000)
+
+    def writefile(self, name, data):
+        path = os.path.join(self.srcdir, name)
+        osutils.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def zip(self, name, cache=None):
+        path = os.path.join(self.tempd, name)
+        with mock.patch.object(zu, '_compress_file',
+                               side_effect=zu._compress_file) as m:
+            with zu.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zfile:
+                dedupe = zu.DedupWriter(zfile, cache)
+                zu.write_dir(self.srcdir, zfile, dedupe=dedupe)
+                dedupe.write_manifest()
+        return path, dedupe, m.call_count
+
+    def testCompressesEachContentOnce(self):
+        path, dedupe, compresscount = self.zip('a.zip')
+        self.assertEqual(compresscount, 2)
+        self.assertEqual(len(dedupe.duplicates), 2)
+        self.assertEqual(set(dedupe.duplicates.values()),
+                         set(['a/license.txt', 'b/license.txt',
+                              'c/license.txt']) -
+                         set(dedupe.duplicates.keys()))
+        with zu.ZipFile(path) as zfile:
+            self.assertIsNone(zfile.testzip())
+            self.assertEqual(zfile.read('c/license.txt'), b'spam' * 1000)
+            manifest = json.loads(
+                zfile.read(zu.DedupWriter.MANIFEST_NAME).decode('utf-8'))
+        self.assertEqual(manifest, dedupe.duplicates)
+
+    def testMatchesPlainZip(self):
+        path = self.zip('a.zip')[0]
+        plain = os.path.join(self.tempd, 'plain.zip')
+        zu.zip_dir(self.srcdir, plain)
+        diff = zu.diff_zip_files(path, plain, checkcontent=True)
+        self.assertEqual(diff, ([], [zu.DedupWriter.MANIFEST_NAME], []))
+
+    def testPayloadCacheReusedAcrossRuns(self):
+        cache = zu.PayloadCache(self.cachedir)
+        self.assertEqual(self.zip('a.zip', cache)[2], 2)
+        path, _, compresscount = self.zip('b.zip', cache)
+        self.assertEqual(compresscount, 0)
+        with zu.ZipFile(path) as zfile:
+            self.assertIsNone(zfile.testzip())
+            self.assertEqual(zfile.read('unique.txt'), b'eggs' * 1000)
+
+    def testPayloadCacheMissing(self):
+        cache = zu.PayloadCache(self.cachedir)
+        self.assertIsNone(cache.get('abcdef'))
+
+    def testNotWithWorkers(self):
+        with zu.ZipFile(os.path.join(self.tempd, 'a.zip'), 'w') as zfile:
+            self.assertRaises(
+                ValueError, zu.write_dir, self.srcdir, zfile,
+                workers=2, dedupe=zu.DedupWriter(zfile))
+
+
+class TestCompressionPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.srcdir = os.path.join(self.tempd, 'src')
+        self.text = self.writefile('a.txt', b'spam and eggs ' * 1000)
+        self.image = self.writefile('b.PNG', b'spam and eggs ' * 1000)
+        self.random = self.writefile('c.bin', os.urandom(10000))
+        self.empty = self.writefile('d.txt', b'')
+
+    def writefile(self, name, data):
+        path = os.path.join(self.srcdir, name)
+        osutils.makedirs(self.srcdir)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def testDefault(self):
+        policy = zu.CompressionPolicy()
+        self.assertEqual(policy(self.text), (zipfile.ZIP_DEFLATED, None))
+        self.assertEqual(policy(self.image), (zipfile.ZIP_STORED, None))
+        self.assertEqual(policy(self.random), (zipfile.ZIP_STORED, None))
+        self.assertEqual(policy(self.empty), (zipfile.ZIP_DEFLATED, None))
+
+    def testOptions(self):
+        policy = zu.CompressionPolicy(
+            zipfile.ZIP_BZIP2, 9, storedexts=(), maxentropy=None,
+            overrides={'.txt': (zipfile.ZIP_DEFLATED, 1)})
+        self.assertEqual(policy(self.text), (zipfile.ZIP_DEFLATED, 1))
+        self.assertEqual(policy(self.image), (zipfile.ZIP_BZIP2, 9))
+        self.assertEqual(policy(self.random), (zipfile.ZIP_BZIP2, 9))
+
+    def testSampleEntropy(self):
+        self.assertEqual(zu.sample_entropy(b''), 0)
+        self.assertEqual(zu.sample_entropy(b'aaaa'), 0)
+        self.assertEqual(zu.sample_entropy(b'abab'), 1)
+        self.assertEqual(zu.sample_entropy(bytearray(range(256))), 8)
+
+    def assertCompressTypes(self, zippath):
+        with zu.ZipFile(zippath) as zfile:
+            types = dict((zi.filename, zi.compress_type)
+                         for zi in zfile.infolist())
+            self.assertIsNone(zfile.testzip())
+        self.assertEqual(types, {
+            'a.txt': zipfile.ZIP_DEFLATED, 'b.PNG': zipfile.ZIP_STORED,
+            'c.bin': zipfile.ZIP_STORED, 'd.txt': zipfile.ZIP_DEFLATED})
+
+    def testZipDirUsesDefault(self):
+        zippath = os.path.join(self.tempd, 'a.zip')
+        zu.zip_dir(self.srcdir, zippath)
+        self.assertCompressTypes(zippath)
+
+    def testParallel(self):
+        zippath = os.path.join(self.tempd, 'a.zip')
+        zu.zip_dir(self.srcdir, zippath, workers=2)
+        self.assertCompressTypes(zippath)
+
+    def testWriteFilesUsesZipCompressionByDefault(self):
+        with zu.ZipFile(os.path.join(self.tempd, 'a.zip'), 'w',
+                        zipfile.ZIP_DEFLATED) as zfile:
+            zu.write_dir(self.srcdir, zfile)
+            types = set(zi.compress_type for zi in zfile.infolist())
+        self.assertEqual(types, set([zipfile.ZIP_DEFLATED]))
+
+    def testIncrementalReusesWithPolicy(self):
+        zippath = os.path.join(self.tempd, 'a.zip')
+        zu.zip_dir(self.srcdir, zippath)
+        with mock.patch.object(zipfile.ZipFile, 'write') as m:
+            zu.zip_dir(self.srcdir, zippath, incremental=True)
+        self.assertFalse(m.called)
+        self.assertCompressTypes(zippath)
+
+
+class TestUnzipDir(unittest.TestCase):
+
+    def setUp(self):
+        self.tempd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.outdir = os.path.join(self.tempd, 'out')
+
+    def testRoundTrip(self):
+        for workers in (1, 3):
+            outdir = os.path.join(self.outdir, str(workers))
+            got = zu.unzip_dir(IDEAL_ALL, outdir, workers=workers)
+            self.assertEqual(len(got), 4)
+            testhelpers.assertFoldersEqual(self, outdir, TESTROOT)
+
+    def testFilters(self):
+        got = zu.unzip_dir(IDEAL_ALL, self.outdir,
+                           include=lambda p: p.endswith('.fake'),
+                           exclude=lambda p: 'subdir' in p, workers=2)
+        self.assertEqual(
+            sorted(os.path.relpath(p, self.outdir) for p in got),
+            ['b.fake', 'b3.fake'])
+        self.assertFalse(os.path.exists(os.path.join(self.outdir, 'subdir')))
+
+    def testGlobFilters(self):
+        got = zu.unzip_dir(IDEAL_ALL, self.outdir, include='*.fake',
+                           exclude=osutils.GlobSet(['*subdir*']))
+        self.assertEqual(
+            sorted(os.path.relpath(p, self.outdir) for p in got),
+            ['b.fake', 'b3.fake'])
+
+    def testDirectoryMembersAndSanitizing(self):
+        zippath = os.path.join(self.tempd, 'a.zip')
+        with zu.ZipFile(zippath, 'w') as z:
+            z.writestr('empty/', '')
+            z.writestr('../../evil.txt', 'evil')
+            z.writestr('/abs/f.txt', 'abs')
+        got = zu.unzip_dir(zippath, self.outdir, workers=2)
+        self.assertTrue(os.path.isdir(os.path.join(self.outdir, 'empty')))
+        self.assertEqual(sorted(got), [
+            os.path.join(self.outdir, 'abs', 'f.txt'),
+            os.path.join(self.outdir, 'evil.txt')])
+        with open(os.path.join(self.outdir, 'evil.txt')) as f:
+            self.assertEqual(f.read(), 'evil')